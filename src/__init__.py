@@ -13,6 +13,7 @@ from src.routes.history import router as histo_router
 from src.routes.token import router as token_router
 from src.routes.transaction import router as transaction_router
 from src.routes.user import router as user_router
+from src.utils.queue import asset_queue, pnl_scheduler
 
 
 @asynccontextmanager
@@ -24,6 +25,9 @@ async def lifespan(app: FastAPI):
 
     yield
 
+    await asset_queue.stop()  # Termine les recalculs d'assets en attente
+    await pnl_scheduler.stop()  # Lance les calculs de PnL encore en attente
+
     # Exécute le checkpoint WAL pour forcer la sauvegarde de la db
     async with engine.begin() as conn:
         await conn.execute(text('PRAGMA wal_checkpoint(FULL);'))
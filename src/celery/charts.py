@@ -1,9 +1,14 @@
 import asyncio
 import uuid
 
-from src.utils.calculations import get_current_total_pnl
+from src.utils.calculations import get_current_total_pnl, get_current_total_pnls
 
 
 def get_total_pnl(user_id: uuid.UUID, fiat: str):
     # return get_current_total_pnl(user_id=user_id, fiat=fiat)
     return asyncio.run(get_current_total_pnl(user_id=user_id, fiat=fiat))
+
+
+def get_total_pnls(user_id: uuid.UUID, fiats: list[str]):
+    """Calcule le PnL de plusieurs fiats dans une seule exécution de tâche, sur un seul chargement du ledger."""
+    return asyncio.run(get_current_total_pnls(user_id=user_id, fiats=fiats))
@@ -6,6 +6,7 @@ from sqlmodel import select
 from src.celery.dtao import fetch_cg_ids_on_coingecko_async_task
 from src.db.main import get_session
 from src.db.models import SmallToken, Token
+from src.utils.cache import TOKEN_PRICES, bump_version
 
 
 async def get_small_tokens():
@@ -71,6 +72,7 @@ async def write_to_db(raw_data):
                     session.add(existing_tok)
                 else:
                     session.add(db_tok)
+            await bump_version(session, TOKEN_PRICES)  # Invalide les snapshots d'assets en cache
             await session.commit()
 
             # Delete old entries
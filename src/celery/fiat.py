@@ -5,6 +5,8 @@ import pandas as pd
 from sqlmodel import delete, select
 from src.db.main import get_session
 from src.db.models import FiatHistory, Token
+from src.utils.cache import TOKEN_PRICES, bump_version
+from src.utils.fx import fx_table
 from src.utils.tvdatafeed import get_history_ohlc_mutliple_symbols
 from tvDatafeed import Interval
 
@@ -98,6 +100,7 @@ async def write_realtime_to_db(fiat_list):
             fiat_to_update.sqlmodel_update(corresponding_fiat)
             session.add(fiat_to_update)
 
+        await bump_version(session, TOKEN_PRICES)
         await session.commit()
 
 
@@ -136,6 +139,7 @@ async def get_all_fiat_history_in_db():
         await session.commit()
         session.add_all(fiat_histories)
         await session.commit()
+        await fx_table.load(session)
         print(f'{len(fiat_histories)} entrées insérées dans FiatHistory')
 
 
@@ -197,6 +201,7 @@ async def get_daily_fiat_history_async_task():
         if fiat_histories:
             session.add_all(fiat_histories)
             await session.commit()
+            await fx_table.load(session)  # Rafraîchit la table des cours en mémoire
             print(f'{len(fiat_histories)} nouvelles entrées ajoutées à FiatHistory')
         else:
             print('Aucune nouvelle entrée à ajouter.')
@@ -1,20 +1,24 @@
+import asyncio
 import logging
 import time
+from datetime import datetime, timedelta
 from io import StringIO
 
 import pandas as pd
 import requests
 from fastapi import HTTPException, status
 from src.config import settings
-from src.utils.calculations import get_cash_in_usd
-from src.utils.tvdatafeed import get_history_ohlc_single_symbol
+from src.utils.calculations import get_cash_in
+from src.utils.price_history import get_price_history
+from src.utils.ratelimit import taostats_bucket
+from src.utils.tvdatafeed import get_stored_history_ohlc
 
 # Setup logger
 logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
-def compute_pf_history(df_qty_json, tv_list_data, transactions):
+async def compute_pf_history(df_qty_json, tv_list_data, transactions):
     """
     Calcule l'historique de valeur du portefeuille (avec df_qty) via Celery.
 
@@ -27,7 +31,21 @@ def compute_pf_history(df_qty_json, tv_list_data, transactions):
     first_date_qty = df_qty.index[0]
     last_date_qty = df_qty.index[-2]
     all_histories = []
-    ignored_tokens = []
+    date_ranges = {}
+    fetches = []
+    semaphore = asyncio.Semaphore(settings.HISTORY_FETCH_CONCURRENCY)
+
+    async def fetch_history(token, ticker, exchange):
+        # Historiques lus dans le store local : seules les dernières barres sont téléchargées
+        async with semaphore:
+            try:
+                if exchange == 'taostats.io':
+                    return token, await get_dtao_history(ticker)
+                return token, await get_stored_history_ohlc(ticker, exchange)
+            except Exception as err:
+                # Un token en échec est ignoré sans interrompre les autres téléchargements
+                print(f'[History Error] {token} ({exchange}) : {err}')
+                return token, None
 
     for token in df_qty.columns:
         dates = df_qty.index[df_qty[token] > 0]
@@ -47,20 +65,24 @@ def compute_pf_history(df_qty_json, tv_list_data, transactions):
             ticker = ticker_obj['ticker'] if ticker_obj else None
             exchange = ticker_obj['exchange'] if ticker_obj else None
 
-            if exchange == 'taostats.io':
-                token_full_history = get_dtao_history(ticker)
-            else:
-                token_full_history = get_history_ohlc_single_symbol(ticker, exchange)
-                if token_full_history is None:
-                    ignored_tokens.append(token)
-                    continue
+            date_ranges[token] = (first_date, last_date)
+            fetches.append(fetch_history(token, ticker, exchange))
 
-            token_history = token_full_history.loc[first_date:last_date, ['close']].copy()
-            token_history['token'] = token
-            token_history = token_history.reset_index()
-            all_histories.append(token_history)
+    # Téléchargements en parallèle (débit limité par source), traités dans leur ordre d'arrivée
+    missing_tokens = set()
+    for next_history in asyncio.as_completed(fetches):
+        token, token_full_history = await next_history
+        if token_full_history is None:
+            missing_tokens.add(token)
+            continue
+
+        first_date, last_date = date_ranges[token]
+        token_history = token_full_history.loc[first_date:last_date, ['close']].copy()
+        token_history['token'] = token
+        token_history = token_history.reset_index()
+        all_histories.append(token_history)
 
-            time.sleep(0.5)
+    ignored_tokens = [token for token in df_qty.columns if token in missing_tokens]
 
     if not all_histories:
         return {'result': [], 'ignored_tokens': ignored_tokens}
@@ -89,7 +111,7 @@ def compute_pf_history(df_qty_json, tv_list_data, transactions):
     # Ajout du cash in
 
     # print(df_totals)
-    # get_cash_in_usd(transactions, df_totals)
+    # get_cash_in(transactions, df_totals)
 
     # Fin ajout du cash in
 
@@ -99,9 +121,7 @@ def compute_pf_history(df_qty_json, tv_list_data, transactions):
     return {'result': result, 'ignored_tokens': ignored_tokens}
 
 
-def get_dtao_history(ticker: str):
-    BASE_URL = 'https://taostats.io/api/dtao/udf/history'
-
+async def get_dtao_history(ticker: str):
     digits = ''.join(filter(str.isdigit, ticker))
     if not digits:
         print(f'Ticker invalide : {ticker}')
@@ -109,11 +129,37 @@ def get_dtao_history(ticker: str):
     number = int(digits)
     symbol = f'SUB-{number}'
 
+    df = await get_price_history(symbol, 'taostats.io', '1D', lambda last_date: fetch_dtao_bars(symbol, last_date))
+    if df is None:
+        return None
+
+    df_tao = await get_stored_history_ohlc('TAOUSDT', 'MEXC')
+
+    df.index = pd.to_datetime(df.index).normalize()
+    df_tao.index = pd.to_datetime(df_tao.index).normalize()
+
+    df_combined = df.join(df_tao[['close']], rsuffix='_tao', how='left')
+    df_combined['close'] = df_combined['close'] * df_combined['close_tao']
+
+    df = df_combined
+    df = df[~df.index.duplicated(keep='first')]
+
+    return df
+
+
+def fetch_dtao_bars(symbol: str, since: datetime | None = None):
+    """Barres journalières (en TAO) d'un subnet depuis `since` (10 ans d'historique par défaut)."""
+    BASE_URL = 'https://taostats.io/api/dtao/udf/history'
+
     to_ts = int(time.time())
-    from_ts = to_ts - 10 * 365 * 24 * 3600  # 10 ans
+    if since is not None:
+        from_ts = int((since - timedelta(days=1)).timestamp())  # Recouvrement avec la dernière barre stockée
+    else:
+        from_ts = to_ts - 10 * 365 * 24 * 3600  # 10 ans
 
     params = {'symbol': symbol, 'resolution': '1D', 'from': from_ts, 'to': to_ts}
 
+    taostats_bucket.acquire()
     try:
         resp = requests.get(BASE_URL, params=params)
         resp.raise_for_status()
@@ -125,32 +171,17 @@ def get_dtao_history(ticker: str):
             detail=f"Erreur lors de la récupération de l'historique du dtao {symbol}",
         )
 
-    if data and data.get('s') == 'ok' and data.get('t'):
-        df = pd.DataFrame(
-            {
-                'datetime': pd.to_datetime(data['t'], unit='s').normalize(),
-                'symbol': symbol.replace('SUB-', 'SN'),
-                'open': data['o'],
-                'high': data['h'],
-                'low': data['l'],
-                'close': data['c'],
-                'volume': data['v'],
-            }
-        )
-    else:
+    if not (data and data.get('s') == 'ok' and data.get('t')):
         return None
 
-    df.set_index('datetime', inplace=True)
-
-    df_tao = get_history_ohlc_single_symbol('TAOUSDT', 'MEXC')
-
-    df.index = pd.to_datetime(df.index).normalize()
-    df_tao.index = pd.to_datetime(df_tao.index).normalize()
-
-    df_combined = df.join(df_tao[['close']], rsuffix='_tao', how='left')
-    df_combined['close'] = df_combined['close'] * df_combined['close_tao']
-
-    df = df_combined
-    df = df[~df.index.duplicated(keep='first')]
-
-    return df
+    df = pd.DataFrame(
+        {
+            'datetime': pd.to_datetime(data['t'], unit='s').normalize(),
+            'open': data['o'],
+            'high': data['h'],
+            'low': data['l'],
+            'close': data['c'],
+            'volume': data['v'],
+        }
+    )
+    return df.set_index('datetime')
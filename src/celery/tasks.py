@@ -4,7 +4,7 @@ import logging
 from celery import Celery
 from celery.result import AsyncResult
 from celery.schedules import crontab
-from src.celery.charts import get_total_pnl
+from src.celery.charts import get_total_pnl, get_total_pnls
 from src.celery.coingecko import coingecko_async_task
 from src.celery.fiat import fiat_realtime_async_task, get_daily_fiat_history_async_task
 from src.celery.histo import compute_pf_history
@@ -56,7 +56,7 @@ def daily_fiat_history_task():
 
 @app.task(name='compute_pf_history_task')
 def compute_pf_history_task(df_qty_json, tv_list_data, transactions):
-    return compute_pf_history(df_qty_json, tv_list_data, transactions)
+    return asyncio.run(compute_pf_history(df_qty_json, tv_list_data, transactions))
 
 
 @app.task(name='get_total_pnl_task')
@@ -64,6 +64,11 @@ def get_total_pnl_task(user_id, fiat='fiat_usd'):
     return get_total_pnl(user_id, fiat)
 
 
+@app.task(name='get_total_pnls_task')
+def get_total_pnls_task(user_id, fiats):
+    return get_total_pnls(user_id, fiats)
+
+
 # Tache journalière pour archiver la valeur du portefeuille ?
 
 # Nettoyer la db token si pas utilisé et délai plus de X heures
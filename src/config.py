@@ -10,6 +10,10 @@ class Settings(BaseSettings):
     JWT_REFRESH_EXPIRATION_IN_HOURS: int
     STABLECOINS: list[str]
     FIATS: list[str]
+    PNL_DEBOUNCE_SECONDS: float = 5  # Fenêtre de calme avant de lancer le calcul du PnL d'un utilisateur
+    HISTORY_FETCH_CONCURRENCY: int = 8  # Historiques de prix téléchargés en parallèle
+    TRADINGVIEW_REQUESTS_PER_SECOND: float = 2
+    TAOSTATS_REQUESTS_PER_SECOND: float = 2
 
     model_config = SettingsConfigDict(env_file='.env', env_file_encoding='utf-8', extra='ignore')
 
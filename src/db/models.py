@@ -1,9 +1,10 @@
+import json
 import uuid
 from datetime import datetime
 from typing import Optional
 
-from sqlmodel import Field, Relationship, SQLModel, UniqueConstraint
-from src.schemes.asset import AssetBase
+from sqlmodel import Field, Index, Relationship, SQLModel, UniqueConstraint
+from src.schemes.asset import AssetBase, AssetWalletBase
 from src.schemes.history import UserHistoryBase
 from src.schemes.token import TokenBase
 from src.schemes.transaction import TransactionBase
@@ -20,6 +21,9 @@ class User(UserBase, table=True):
     calc_method_tax: str = Field(default='fifo')
     tax_principle: str = Field(default='pv')
     history_init: bool = Field(default=False)
+    history_dirty_date: datetime | None = None  # Plus ancienne transaction modifiée depuis le dernier historique
+    ledger_version: int = Field(default=0)  # Incrémentée à chaque écriture de transactions
+    assets_version: int = Field(default=0)  # Version du ledger reflétée par les assets
     cash_in_usd: float = Field(default=0.0)
     cash_in_eur: float = Field(default=0.0)
     cash_in_cad: float = Field(default=0.0)
@@ -30,6 +34,8 @@ class User(UserBase, table=True):
     transactions: list['Transaction'] = Relationship(back_populates='user', cascade_delete=True)
     assets: list['Asset'] = Relationship(back_populates='user', cascade_delete=True)
     pf_history: list['UserPfHistory'] = Relationship(back_populates='user', cascade_delete=True)
+    cash_in_checkpoints: list['CashInCheckpoint'] = Relationship(back_populates='user', cascade_delete=True)
+    asset_lots: list['AssetLot'] = Relationship(back_populates='user', cascade_delete=True)
 
 
 class Token(TokenBase, table=True):
@@ -43,13 +49,37 @@ class Asset(AssetBase, table=True):
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     token: Token = Relationship()
     user: User = Relationship(back_populates='assets')
+    last_trx_date: datetime | None = None  # Date de la dernière transaction appliquée aux lots
     updated_at: datetime = Field(default_factory=datetime.now, sa_column_kwargs={'onupdate': datetime.now})
 
+    wallets: list['AssetWallet'] = Relationship(back_populates='asset', cascade_delete=True)
+
+    @property
+    def qty_by_wallet(self) -> str:
+        # Même format que l'ancienne colonne JSON, pour l'API
+        return json.dumps({w.wallet: w.qty for w in self.wallets})
+
+
+class AssetWallet(AssetWalletBase, table=True):
+    __tablename__ = 'asset_wallets'  # type: ignore
+    __table_args__ = (Index('ix_asset_wallets_user_wallet', 'user_id', 'wallet'),)
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    asset_id: uuid.UUID = Field(index=True, foreign_key='assets.id', ondelete='CASCADE')
+    user_id: uuid.UUID = Field(foreign_key='users.uid', ondelete='CASCADE')
+    token_id: str
+
+    asset: Asset = Relationship(back_populates='wallets')
+
 
 class Transaction(TransactionBase, table=True):
     __tablename__ = 'transactions'  # type: ignore
+    __table_args__ = (
+        Index('ix_transactions_user_content_hash', 'user_id', 'content_hash'),
+        Index('ix_transactions_user_date', 'user_id', 'date'),  # Pagination par curseur (date DESC, id DESC)
+    )
     id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
     user_id: uuid.UUID | None = Field(default=None, index=True, foreign_key='users.uid', ondelete='CASCADE')
+    content_hash: str | None = None  # Empreinte du contenu, pour ignorer les doublons à l'import
 
     user: User = Relationship(back_populates='transactions')
 
@@ -79,6 +109,14 @@ class SmallToken(SQLModel, table=True):
     id: str = Field(primary_key=True)
 
 
+class CacheVersion(SQLModel, table=True):
+    """Compteur de version d'une donnée partagée (ex. prix des tokens), lu par les caches en mémoire."""
+
+    __tablename__ = 'cache_versions'  # type: ignore
+    name: str = Field(primary_key=True)
+    version: int = 0
+
+
 class FiatHistory(SQLModel, table=True):
     __tablename__ = 'fiat_history'  # type: ignore
     id: str = Field(primary_key=True)
@@ -90,6 +128,21 @@ class FiatHistory(SQLModel, table=True):
     close: float
 
 
+class PriceHistory(SQLModel, table=True):
+    """Barres OHLC téléchargées (TradingView, taostats), gardées pour ne plus retélécharger que la fin."""
+
+    __tablename__ = 'price_history'  # type: ignore
+    ticker: str = Field(primary_key=True)
+    exchange: str = Field(primary_key=True)
+    interval: str = Field(primary_key=True)
+    date: datetime = Field(primary_key=True)
+    open: float
+    high: float
+    low: float
+    close: float
+    volume: float | None = None
+
+
 class DtaoCgList(SQLModel, table=True):
     __tablename__ = 'dtao_list'
     cg_id: str = Field(primary_key=True)
@@ -102,3 +155,34 @@ class UserPfHistory(UserHistoryBase, table=True):
     user_id: uuid.UUID | None = Field(default=None, index=True, foreign_key='users.uid', ondelete='CASCADE')
 
     user: User = Relationship(back_populates='pf_history')
+
+
+class CashInCheckpoint(SQLModel, table=True):
+    """Cash in d'un utilisateur dans une fiat à la fin d'une journée déjà traitée."""
+
+    __tablename__ = 'cash_in_checkpoints'
+    __table_args__ = (Index('ix_cash_in_checkpoints_user_fiat_date', 'user_id', 'fiat', 'date'),)
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    user_id: uuid.UUID = Field(foreign_key='users.uid', ondelete='CASCADE')
+    fiat: str
+    date: datetime
+    cash_in: float
+
+    user: User = Relationship(back_populates='cash_in_checkpoints')
+
+
+class AssetLot(SQLModel, table=True):
+    """Lot ouvert d'un token pour une méthode de CALC_METHODS (un seul lot agrégé pour le prix moyen pondéré)."""
+
+    __tablename__ = 'asset_lots'
+    __table_args__ = (Index('ix_asset_lots_user_token_method_seq', 'user_id', 'token_id', 'method', 'seq'),)
+    id: uuid.UUID = Field(default_factory=uuid.uuid4, primary_key=True)
+    user_id: uuid.UUID = Field(foreign_key='users.uid', ondelete='CASCADE')
+    token_id: str
+    method: int
+    seq: int
+    qty: float
+    price: float
+    date: datetime | None = None
+
+    user: User = Relationship(back_populates='asset_lots')
@@ -1,12 +1,15 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Response, status
 from sqlmodel.ext.asyncio.session import AsyncSession
 from src.db.main import get_session
 from src.db.models import User
-from src.schemes.asset import AssetPublic
+from src.schemes.asset import AssetPublic, AssetWalletPublic
 from src.services.asset import AssetService
 from src.services.auth import get_current_user
+from src.utils.queue import asset_queue
+
+ASSETS_VERSION_HEADER = 'X-Assets-Version'
 
 router = APIRouter(
     prefix='/assets',
@@ -22,8 +25,17 @@ router = APIRouter(
 async def get_user_assets(
     session: Annotated[AsyncSession, Depends(get_session)],
     current_user: Annotated[User, Depends(get_current_user)],
+    min_version: int | None = None,
 ):
-    return await AssetService(session).get_user_assets(current_user.uid)
+    # Lecture de ses propres écritures : attend que les assets reflètent la version du ledger demandée
+    if min_version is not None and current_user.assets_version < min_version:
+        await asset_queue.wait_for_version(current_user.uid, min_version)
+        await session.refresh(current_user)
+
+    headers = {ASSETS_VERSION_HEADER: str(current_user.assets_version)}
+    # Snapshot déjà sérialisé : pas de revalidation par response_model
+    content = await AssetService(session).get_user_assets_snapshot(current_user)
+    return Response(content=content, media_type='application/json', headers=headers)
 
 
 @router.post(
@@ -35,4 +47,18 @@ async def update_user_assets(
     session: Annotated[AsyncSession, Depends(get_session)],
     current_user: Annotated[User, Depends(get_current_user)],
 ):
-    return await AssetService(session).update_user_assets(current_user.uid)
+    calc_method_display = current_user.calc_method_display
+    assets = await AssetService(session).update_user_assets(current_user.uid)
+    return [AssetPublic.from_asset(asset, calc_method_display) for asset in assets]
+
+
+@router.get(
+    '/wallets',
+    status_code=status.HTTP_200_OK,
+    response_model=list[AssetWalletPublic],
+)
+async def get_user_wallets(
+    session: Annotated[AsyncSession, Depends(get_session)],
+    current_user: Annotated[User, Depends(get_current_user)],
+):
+    return await AssetService(session).get_user_wallets(current_user.uid)
@@ -41,5 +41,6 @@ async def calculate_histo_pf(
     session: Annotated[AsyncSession, Depends(get_session)],
     current_user: Annotated[User, Depends(get_current_user)],
     tv_list: list[Ticker],
+    full: bool = False,
 ):
-    return await HistoryService(session).calculate_histo_pf(current_user.uid, tv_list)
+    return await HistoryService(session).calculate_histo_pf(current_user.uid, tv_list, full=full)
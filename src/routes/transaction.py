@@ -1,12 +1,15 @@
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
 from sqlmodel.ext.asyncio.session import AsyncSession
 from src.db.main import get_session
 from src.db.models import User
-from src.schemes.transaction import TransactionCreate, TransactionPublic, TransactionUpdate
+from src.schemes.transaction import TransactionBatch, TransactionCreate, TransactionPublic, TransactionUpdate
 from src.services.auth import get_current_user
-from src.services.transaction import TransactionService
+from src.services.transaction import LEDGER_VERSION_HEADER, NEXT_CURSOR_HEADER, TransactionService
+from src.utils.bulk import BULK_FORMATS, iter_lines
+
+MAX_PAGE_SIZE = 1000
 
 router = APIRouter(
     prefix='/transactions',
@@ -20,10 +23,21 @@ router = APIRouter(
     response_model=list[TransactionPublic],
 )
 async def get_user_transactions(
+    response: Response,
     session: Annotated[AsyncSession, Depends(get_session)],
     current_user: Annotated[User, Depends(get_current_user)],
+    limit: Annotated[int | None, Query(ge=1, le=MAX_PAGE_SIZE)] = None,
+    cursor: str | None = None,
+    type: str | None = None,
+    token: str | None = None,
+    wallet: str | None = None,
 ):
-    return await TransactionService(session).get_user_transactions(current_user.uid)
+    transactions, next_cursor = await TransactionService(session).get_user_transactions(
+        current_user.uid, limit=limit, cursor=cursor, type=type, token=token, wallet=wallet
+    )
+    if next_cursor is not None:
+        response.headers[NEXT_CURSOR_HEADER] = next_cursor
+    return transactions
 
 
 @router.post(
@@ -33,10 +47,52 @@ async def get_user_transactions(
 )
 async def create_transactions(
     trx_data: TransactionCreate,
+    response: Response,
+    session: Annotated[AsyncSession, Depends(get_session)],
+    current_user: Annotated[User, Depends(get_current_user)],
+):
+    service = TransactionService(session)
+    transaction = await service.create_transactions(trx_data, current_user)
+    if service.duplicate:
+        response.status_code = status.HTTP_200_OK  # Transaction déjà existante, rien n'a été créé
+    response.headers[LEDGER_VERSION_HEADER] = str(service.ledger_version)
+    return transaction
+
+
+@router.post('/bulk', status_code=status.HTTP_201_CREATED)
+async def bulk_create_transactions(
+    request: Request,
+    session: Annotated[AsyncSession, Depends(get_session)],
+    current_user: Annotated[User, Depends(get_current_user)],
+):
+    content_type = request.headers.get('content-type', '').split(';')[0].strip()
+    fmt = BULK_FORMATS.get(content_type)
+    if fmt is None:
+        raise HTTPException(
+            status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+            detail=f'Formats acceptés : {", ".join(BULK_FORMATS)}',
+        )
+
+    return await TransactionService(session).bulk_create_transactions(
+        iter_lines(request.stream()), fmt, current_user
+    )
+
+
+@router.post(
+    '/batch',
+    status_code=status.HTTP_200_OK,
+    response_model=list[TransactionPublic],
+)
+async def batch_transactions(
+    batch: TransactionBatch,
+    response: Response,
     session: Annotated[AsyncSession, Depends(get_session)],
     current_user: Annotated[User, Depends(get_current_user)],
 ):
-    return await TransactionService(session).create_transactions(trx_data, current_user)
+    service = TransactionService(session)
+    transactions = await service.batch_transactions(batch, current_user)
+    response.headers[LEDGER_VERSION_HEADER] = str(service.ledger_version)
+    return transactions
 
 
 @router.patch(
@@ -46,10 +102,14 @@ async def create_transactions(
 )
 async def update_transactions(
     trx_data: TransactionUpdate,
+    response: Response,
     session: Annotated[AsyncSession, Depends(get_session)],
     current_user: Annotated[User, Depends(get_current_user)],
 ):
-    return await TransactionService(session).update_transactions(trx_data, current_user)
+    service = TransactionService(session)
+    transaction = await service.update_transactions(trx_data, current_user)
+    response.headers[LEDGER_VERSION_HEADER] = str(service.ledger_version)
+    return transaction
 
 
 @router.delete('/', status_code=status.HTTP_200_OK)
@@ -5,10 +5,10 @@ from datetime import datetime
 from pydantic import computed_field
 from sqlalchemy.exc import NoResultFound
 from sqlalchemy.orm import selectinload
-from sqlmodel import Field, SQLModel, select
+from sqlmodel import Field, SQLModel
 from src.db.main import get_session
 from src.schemes.token import TokenPublicAsset
-from src.utils.asset import get_asset_mean_buy, get_asset_qty, get_asset_qty_by_wallet
+from src.utils.asset import CALC_METHODS, LedgerContext, get_asset_mean_buy, get_calc_method
 
 
 class AssetBase(SQLModel):
@@ -16,40 +16,39 @@ class AssetBase(SQLModel):
     token_id: str = Field(foreign_key='tokens.cg_id')
 
     qty: float = 0
-    mean_buy: float = 0
-
-    qty_by_wallet: str | None = None
-
-    @property
-    def qty_by_wallet_dict(self) -> dict:
-        return json.loads(self.qty_by_wallet or '{}')
-
-    @qty_by_wallet_dict.setter
-    def qty_by_wallet_dict(self, value: dict):
-        self.qty_by_wallet = json.dumps(value)
-
-    async def update_asset(self, session):
-        from src.db.models import Transaction
-
+    mean_buy_wavg: float = 0
+    mean_buy_fifo: float = 0
+    mean_buy_lifo: float = 0
+
+    async def update_asset(self, session, ledger: LedgerContext | None = None, mean_buys: dict | None = None):
+        """
+        Met à jour quantité et prix moyens à partir du ledger partagé (chargé ici si absent). Retourne la
+        répartition par wallet {wallet: qty}, à écrire dans `asset_wallets` par le service (None si le calcul
+        des quantités a échoué).
+        """
+        w = None
         try:
-            statement = select(Transaction).where(Transaction.user_id == self.user_id).order_by(Transaction.date)
-            results = await session.exec(statement)
-            transactions = results.all()
+            if ledger is None:
+                ledger = await LedgerContext.load(session, self.user_id, {self.token_id})
 
             try:
-                q, w = get_asset_qty_by_wallet(token_id=self.token_id, transactions=transactions)
+                q, w = ledger.holdings.get(self.token_id, (0, {}))
                 self.qty = q
-                self.qty_by_wallet_dict = w
 
             except Exception as err:
                 print('erreur dans get_asset_qty')
                 print(err)
             try:
-                self.mean_buy = (
-                    await get_asset_mean_buy(token_id=self.token_id, transactions=transactions, session=session)
-                    if self.qty != 0
-                    else 0
-                )
+                if self.qty == 0:
+                    token_mean_buys = {method['field']: 0 for method in CALC_METHODS}
+                elif mean_buys is None:
+                    token_mean_buys = await get_asset_mean_buy(
+                        token_id=self.token_id, transactions=ledger.transactions, session=session
+                    )
+                else:
+                    token_mean_buys = mean_buys.get(self.token_id, {method['field']: 0 for method in CALC_METHODS})
+                for field, value in token_mean_buys.items():
+                    setattr(self, field, value)
             except Exception as err:
                 print('erreur dans get_asset_mean_buy')
                 print(err)
@@ -60,6 +59,8 @@ class AssetBase(SQLModel):
         except Exception as err:
             print('erreur inconnue:', err)
 
+        return w
+
 
 class AssetPublic(SQLModel):
     qty: float = 0
@@ -68,6 +69,12 @@ class AssetPublic(SQLModel):
     updated_at: datetime
     qty_by_wallet: str | None = None
 
+    @classmethod
+    def from_asset(cls, asset, calc_method_display: str):
+        # Les trois prix moyens sont stockés : on sert celui de la méthode choisie par l'utilisateur
+        field = get_calc_method(calc_method_display)['field']
+        return cls.model_validate(asset, update={'mean_buy': getattr(asset, field)})
+
     @property
     def qty_by_wallet_dict(self) -> dict:
         return json.loads(self.qty_by_wallet or '{}')
@@ -87,3 +94,14 @@ class AssetPublic(SQLModel):
     def pnl_percent(self) -> float | None:
         if self.mean_buy != 0 and self.qty != 0:
             return (self.value / (self.mean_buy * self.qty)) - 1
+
+
+class AssetWalletBase(SQLModel):
+    wallet: str
+    qty: float = 0
+
+
+class AssetWalletPublic(SQLModel):
+    wallet: str
+    value: float = 0
+    token_count: int = 0
@@ -1,7 +1,8 @@
 import uuid
 from datetime import datetime
+from typing import Annotated, Literal
 
-from pydantic import computed_field
+from pydantic import BaseModel, ConfigDict, Field, computed_field, field_validator
 from sqlmodel import SQLModel
 from src.schemes.token import TokenBase
 
@@ -52,3 +53,74 @@ class TransactionUpdate(SQLModel):
   actif_a_id: str | None = None
   actif_v_id: str | None = None
   actif_f_id: str | None = None
+
+
+BATCH_MAX_OPERATIONS = 500
+
+
+class TransactionCreateOperation(BaseModel):
+  op: Literal['create']
+  data: TransactionCreate
+
+
+class TransactionUpdateOperation(BaseModel):
+  op: Literal['update']
+  data: TransactionUpdate
+
+
+class TransactionDeleteOperation(BaseModel):
+  op: Literal['delete']
+  id: uuid.UUID
+
+
+TransactionOperation = Annotated[
+  TransactionCreateOperation | TransactionUpdateOperation | TransactionDeleteOperation, Field(discriminator='op')
+]
+
+
+class TransactionBatch(BaseModel):
+  """Opérations appliquées ensemble (toutes ou aucune) par POST /transactions/batch."""
+
+  operations: list[TransactionOperation] = Field(min_length=1, max_length=BATCH_MAX_OPERATIONS)
+
+
+class TransactionCSVModel(BaseModel):
+  """Ligne d'un export de transactions (CSV ou NDJSON), avec les conventions du tableur d'origine."""
+
+  date: datetime
+  type: str
+  actif_a_id: str
+  qty_a: float
+  actif_v_id: str | None = None
+  price: float | None = None
+  qty_v: float | None = None
+  destination: str
+  origin: str | None = None
+  actif_f_id: str | None = None
+  qty_f: float | None = None
+  value_f: float | None = None
+  value_a: float | None = None
+  id: int | None = None
+
+  @field_validator('date', mode='before')
+  @classmethod
+  def parse_date(cls, v):
+    # Format du tableur (26-10-23 17:40:00) ; les dates ISO (NDJSON) sont laissées à pydantic
+    if isinstance(v, str):
+      try:
+        return datetime.strptime(v.strip(), '%d-%m-%y %H:%M:%S')
+      except ValueError:
+        return v
+    return v
+
+  @field_validator('*', mode='before')
+  @classmethod
+  def empty_str_to_none(cls, v):
+    if isinstance(v, str) and v.strip() == '':
+      return None
+    return v
+
+  model_config = ConfigDict(extra='ignore')
+
+  def to_transaction_create(self) -> TransactionCreate:
+    return TransactionCreate.model_validate(self.model_dump(exclude={'id', 'qty_v'}))
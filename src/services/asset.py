@@ -1,10 +1,30 @@
 import uuid
+from collections import defaultdict
+from datetime import datetime
 
+from pydantic import TypeAdapter
+from sqlalchemy.dialects.sqlite import insert
 from sqlalchemy.exc import MissingGreenlet
 from sqlalchemy.orm import selectinload
-from sqlmodel import select
+from sqlmodel import delete, func, select
 from sqlmodel.ext.asyncio.session import AsyncSession
-from src.db.models import Asset, Token, User
+from src.config import settings
+from src.db.models import Asset, AssetLot, AssetWallet, Token, Transaction, User
+from src.schemes.asset import AssetPublic, AssetWalletPublic
+from src.utils.asset import (
+    LedgerContext,
+    accumulate_holdings,
+    apply_to_lot_books,
+    get_books_mean_buys,
+    new_lot_books,
+    revert_from_lot_books,
+    touches_tokens,
+)
+from src.utils.cache import TOKEN_PRICES, asset_cache, get_version, set_assets_version
+
+UPSERT_BATCH_SIZE = 500  # Reste sous la limite de variables par requête de SQLite
+UPSERT_KEEP_COLUMNS = ('id', 'token_id', 'user_id')
+ASSET_LIST_ADAPTER = TypeAdapter(list[AssetPublic])
 
 
 class AssetService:
@@ -13,39 +33,36 @@ class AssetService:
 
     async def update_user_assets(self, current_user_uid):
         try:
-            statement = (
-                select(User)
-                .where(User.uid == current_user_uid)
-                .options(
-                    selectinload(User.transactions),
-                    selectinload(User.assets),
-                )
-            )
-            result = await self.session.exec(statement)
-            user = result.one()
-
-            token_ids = set()
-            for trx in user.transactions:
-                token_ids.add(trx.actif_a_id)
-                token_ids.add(trx.actif_v_id)
-                token_ids.add(trx.actif_f_id)
-            token_ids.discard(None)
+            # Ledger chargé une seule fois et partagé par tous les assets
+            ledger = await LedgerContext.load(self.session, current_user_uid)
+            assets_dict = await self.load_asset_states(current_user_uid)
+
+            token_ids = ledger.token_ids
             # print(token_ids)
 
-            assets_dict = {asset.token_id: asset for asset in user.assets}
+            # Prix moyens (toutes méthodes) de tous les tokens en un seul parcours du ledger
+            books = {}
+            last_dates = await apply_to_lot_books(books, ledger.transactions, self.session)
+            mean_buys = {token_id: get_books_mean_buys(token_books) for token_id, token_books in books.items()}
+            await self.save_lot_books(current_user_uid, books, replace_all=True)
 
+            # Nouveaux états calculés en mémoire puis écrits en bloc
+            assets = []
+            wallets = []
             for tok_id in token_ids:
-                if tok_id not in assets_dict:
-                    new_asset = Asset(token_id=tok_id, user_id=current_user_uid)
-                    await new_asset.update_asset(self.session)
-                    await self.session.merge(new_asset)
-                else:
-                    asset = assets_dict[tok_id]
-                    await asset.update_asset(self.session)
-                    print(asset)
-                    await self.session.merge(asset)
+                asset = assets_dict.get(tok_id) or Asset(token_id=tok_id, user_id=current_user_uid)
+                asset.last_trx_date = last_dates.get(tok_id)
+                qty_by_wallet = await asset.update_asset(self.session, ledger=ledger, mean_buys=mean_buys)
+                assets.append(asset)
+                wallets.append((asset, qty_by_wallet))
 
+            # Assets dont le token n'apparaît plus dans les transactions : supprimés dans la même transaction
+            await self.delete_assets(current_user_uid, assets_dict.keys() - token_ids)
+            await self.upsert_assets(assets)
+            await self.save_wallets(wallets)
+            await set_assets_version(self.session, current_user_uid)  # Tout le ledger est reflété
             await self.session.commit()
+            asset_cache.invalidate(current_user_uid)  # Version parfois inchangée : snapshot retiré explicitement
 
         except MissingGreenlet as err:
             await self.session.rollback()
@@ -69,7 +86,9 @@ class AssetService:
             statement = (
                 select(Asset)
                 .where(Asset.user_id == current_user_uid)
+                .execution_options(populate_existing=True)  # Les assets sont écrits en bloc, hors ORM
                 .options(
+                    selectinload(Asset.wallets),  # type: ignore
                     selectinload(Asset.token).load_only(
                         Token.symbol,
                         Token.price,
@@ -111,62 +130,334 @@ class AssetService:
             print('Exception:', err)
             return []
 
-    async def update_specific_assets(self, user_id: uuid.UUID, token_ids: set[str]):
+    async def get_user_assets_snapshot(self, current_user: User) -> bytes:
+        """
+        Liste des assets déjà sérialisée (JSON), servie depuis `asset_cache` tant que la version du ledger reflétée
+        par les assets, celle des prix des tokens et la méthode d'affichage n'ont pas changé.
+        """
+        # Lus avant tout rollback éventuel de get_user_assets, qui expirerait l'utilisateur
+        user_id = current_user.uid
+        calc_method_display = current_user.calc_method_display
+        key = (current_user.assets_version, await get_version(self.session, TOKEN_PRICES), calc_method_display)
+
+        content = asset_cache.get(user_id, key)
+        if content is None:
+            assets = await self.get_user_assets(user_id)
+            assets_public = [AssetPublic.from_asset(asset, calc_method_display) for asset in assets]
+            content = ASSET_LIST_ADAPTER.dump_json(assets_public)
+            asset_cache.set(user_id, key, content)
+        return content
+
+    async def update_specific_assets(self, user_id: uuid.UUID, token_ids: set[str], since: datetime | None = None):
+        """
+        `since` : date de la plus ancienne transaction créée, modifiée ou supprimée. Si elle est postérieure à
+        la dernière transaction appliquée aux lots d'un asset, seules les nouvelles transactions sont appliquées
+        aux lots persistés ; sinon les lots du token sont reconstruits depuis le début de son historique.
+        """
+        try:
+            await self.write_specific_assets(user_id, token_ids, since)
+            await self.session.commit()
+
+        except Exception as e:
+            await self.session.rollback()
+            print(f'[Asset Update Error] {e}')
+            raise  # Re-raise pour un handling externe éventuel
+
+    async def write_specific_assets(self, user_id: uuid.UUID, token_ids: set[str], since: datetime | None = None):
+        """Comme `update_specific_assets`, sans commit : les écritures restent dans la transaction de l'appelant."""
         if not token_ids:
             return  # Rien à faire
 
-        try:
-            # 1. Récupérer les assets existants de l'utilisateur pour les token_ids
-            statement = select(Asset).where(Asset.user_id == user_id, Asset.token_id.in_(token_ids))
-            result = await self.session.exec(statement)
-            existing_assets = result.all()
-            existing_ids = {asset.token_id for asset in existing_assets}
+        # 1. Récupérer l'état des assets existants de l'utilisateur pour les token_ids
+        existing_assets = await self.load_asset_states(user_id, token_ids)
+
+        # 2. Préparer les nouveaux assets à créer
+        new_ids = token_ids - existing_assets.keys()
+        new_assets = [Asset(token_id=tok_id, user_id=user_id) for tok_id in new_ids]
+
+        # 3. Mettre à jour les lots : ajout en fin d'historique ou reconstruction du token
+        all_assets = list(existing_assets.values()) + new_assets
+        appended_ids = {
+            asset.token_id
+            for asset in all_assets
+            if since is not None and asset.last_trx_date is not None and since > asset.last_trx_date
+        }
+        replayed_ids = token_ids - appended_ids
+
+        # Un seul chargement des transactions touchant ces tokens, partagé par les lots et les quantités
+        ledger = await LedgerContext.load(self.session, user_id, token_ids)
+
+        books = await self.load_lot_books(user_id, appended_ids)
+        last_dates = {}
+        if appended_ids:
+            appended = [t for t in ledger.transactions if t.date >= since]
+            last_dates |= await apply_to_lot_books(books, appended, self.session, appended_ids)
+        if replayed_ids:
+            books |= {token_id: new_lot_books() for token_id in replayed_ids}
+            last_dates |= await apply_to_lot_books(books, ledger.transactions, self.session, replayed_ids)
+
+        await self.save_lot_books(user_id, books)
+        mean_buys = {token_id: get_books_mean_buys(token_books) for token_id, token_books in books.items()}
+
+        # 4. Mettre à jour tous les assets (existants + nouveaux) et les écrire en bloc
+        stale_ids = token_ids - ledger.token_ids
+        assets = [asset for asset in all_assets if asset.token_id not in stale_ids]
+        wallets = []
+        for asset in assets:
+            if asset.token_id in last_dates or asset.token_id in replayed_ids:
+                asset.last_trx_date = last_dates.get(asset.token_id)
+            wallets.append((asset, await asset.update_asset(self.session, ledger=ledger, mean_buys=mean_buys)))
 
-            # 2. Préparer les nouveaux assets à créer
-            new_ids = token_ids - existing_ids
-            new_assets = [Asset(token_id=tok_id, user_id=user_id) for tok_id in new_ids]
+        await self.delete_assets(user_id, stale_ids)
+        await self.upsert_assets(assets)
+        await self.save_wallets(wallets)
 
-            # 3. Mettre à jour tous les assets (existants + nouveaux)
-            all_assets = list(existing_assets) + new_assets
-            for asset in all_assets:
-                await asset.update_asset(self.session)
-                self.session.add(asset)
+    async def apply_transaction_changes(
+        self, user_id: uuid.UUID, changes: list[tuple[Transaction, int]], token_ids: set[str] | None = None
+    ):
+        """
+        Applique aux assets les deltas de transactions créées (+1) ou supprimées (-1) sans relire le ledger :
+        quantité, répartition par wallet et lots sont ajustés à partir de ces seules transactions.
 
+        Un token est rejoué par `update_specific_assets` si la modification n'est pas en fin d'historique, si une
+        suppression doit rendre des lots déjà consommés, ou si une valeur stockée à 0 a pu être bornée (la
+        quantité réelle, négative, est alors inconnue).
+        """
+        try:
+            await self.write_transaction_changes(user_id, changes, token_ids)
             await self.session.commit()
 
         except Exception as e:
             await self.session.rollback()
             print(f'[Asset Update Error] {e}')
-            raise  # Re-raise pour un handling externe éventuel
+            raise
 
-    async def delete_old_assets(self, current_user_uid):
-        try:
-            statement = (
-                select(User)
-                .where(User.uid == current_user_uid)
-                .options(
-                    selectinload(User.transactions),
-                    selectinload(User.assets),
+    async def write_transaction_changes(
+        self, user_id: uuid.UUID, changes: list[tuple[Transaction, int]], token_ids: set[str] | None = None
+    ):
+        """Comme `apply_transaction_changes`, sans commit : les écritures restent dans la transaction de l'appelant."""
+        transactions = sorted((t for t, _ in changes), key=lambda t: t.date)
+        touched = {token_id for t in transactions for token_id in (t.actif_a_id, t.actif_v_id, t.actif_f_id)}
+        token_ids = (touched - {None}) if token_ids is None else (token_ids & touched)
+        if not token_ids:
+            return
+
+        assets = await self.load_asset_states(user_id, token_ids)
+        wallets = await self.load_wallets(assets.values())
+        books = await self.load_lot_books(user_id, set(assets))
+        replayed_ids = token_ids - {token_id for token_id, asset in assets.items() if asset.last_trx_date}
+
+        created = [t for t, sign in changes if sign > 0]
+        deleted = [t for t, sign in changes if sign < 0]
+        for token_id in token_ids - replayed_ids:
+            asset = assets[token_id]
+            token_created = [t for t in created if token_id in (t.actif_a_id, t.actif_v_id, t.actif_f_id)]
+            token_deleted = [t for t in deleted if token_id in (t.actif_a_id, t.actif_v_id, t.actif_f_id)]
+
+            if token_created and token_deleted:
+                replayed_ids.add(token_id)
+            elif token_created:
+                if min(t.date for t in token_created) <= asset.last_trx_date:
+                    replayed_ids.add(token_id)
+                    continue
+                token_created.sort(key=lambda t: t.date)
+                last_dates = await apply_to_lot_books(books, token_created, self.session, {token_id})
+                asset.last_trx_date = last_dates[token_id]
+            else:
+                # Seules les dernières transactions du token peuvent être retirées des lots
+                statement = select(func.max(Transaction.date)).where(
+                    Transaction.user_id == user_id, touches_tokens({token_id})
                 )
+                remaining_last_date = (await self.session.exec(statement)).one()
+                if remaining_last_date is not None and remaining_last_date >= min(t.date for t in token_deleted):
+                    replayed_ids.add(token_id)
+                    continue
+                for t in sorted(token_deleted, key=lambda t: t.date, reverse=True):
+                    if await revert_from_lot_books(books, t, self.session, {token_id}):
+                        replayed_ids.add(token_id)
+                        break
+                asset.last_trx_date = remaining_last_date
+
+            if token_id in replayed_ids or not self._apply_holdings_delta(
+                asset, wallets[asset.id], token_created, token_deleted
+            ):
+                replayed_ids.add(token_id)
+                continue
+
+            mean_buys = get_books_mean_buys(books[token_id])
+            for field, value in mean_buys.items():
+                setattr(asset, field, value if asset.qty != 0 else 0)
+
+        delta_ids = token_ids - replayed_ids
+        await self.upsert_assets([assets[token_id] for token_id in delta_ids])
+        await self.save_wallets([(assets[token_id], wallets[assets[token_id].id]) for token_id in delta_ids])
+        await self.save_lot_books(user_id, {token_id: books[token_id] for token_id in delta_ids})
+
+        if replayed_ids:
+            await self.write_specific_assets(user_id, replayed_ids, since=transactions[0].date)
+
+    @staticmethod
+    def _apply_holdings_delta(asset: Asset, qty_by_wallet: dict, created: list, deleted: list) -> bool:
+        """Ajoute à l'asset les deltas de quantité et de wallets ; False si une valeur stockée est ambiguë."""
+        created_qty, created_wallets = accumulate_holdings(created)
+        deleted_qty, deleted_wallets = accumulate_holdings(deleted)
+
+        delta_qty = created_qty.get(asset.token_id, 0) - deleted_qty.get(asset.token_id, 0)
+        delta_wallets = defaultdict(float)
+        for wallet, qty in created_wallets.get(asset.token_id, {}).items():
+            delta_wallets[wallet] += qty
+        for wallet, qty in deleted_wallets.get(asset.token_id, {}).items():
+            delta_wallets[wallet] -= qty
+
+        # Une valeur à 0 a pu être bornée ; après une suppression, un wallet à 0 ne serait peut-être plus listé
+        if delta_qty != 0 and asset.qty == 0:
+            return False
+        for wallet, delta in delta_wallets.items():
+            if delta != 0 and qty_by_wallet.get(wallet) == 0:
+                return False
+            if deleted and qty_by_wallet.get(wallet, 0) + delta == 0:
+                return False
+
+        asset.qty = max(asset.qty + delta_qty, 0)
+        for wallet, delta in delta_wallets.items():
+            qty_by_wallet[wallet] = max(qty_by_wallet.get(wallet, 0) + delta, 0)
+        return True
+
+    async def load_wallets(self, assets) -> dict[uuid.UUID, dict[str, float]]:
+        asset_ids = [asset.id for asset in assets]
+        qty_by_wallet = {asset_id: {} for asset_id in asset_ids}
+        if not asset_ids:
+            return qty_by_wallet
+
+        statement = select(AssetWallet).where(AssetWallet.asset_id.in_(asset_ids))  # type: ignore
+        result = await self.session.exec(statement)
+        for wallet in result.all():
+            qty_by_wallet[wallet.asset_id][wallet.wallet] = wallet.qty
+        return qty_by_wallet
+
+    async def load_asset_states(self, user_id: uuid.UUID, token_ids: set[str] | None = None) -> dict[str, Asset]:
+        """État courant des assets, lu colonne par colonne (hors session) : ils sont réécrits en bloc par `upsert_assets`."""
+        statement = select(*Asset.__table__.columns).where(Asset.user_id == user_id)  # type: ignore
+        if token_ids is not None:
+            statement = statement.where(Asset.token_id.in_(token_ids))  # type: ignore
+        result = await self.session.exec(statement)
+        return {row.token_id: Asset(**row._mapping) for row in result.all()}
+
+    async def upsert_assets(self, assets: list[Asset]):
+        """Ecrit les assets avec INSERT ... ON CONFLICT(token_id, user_id) DO UPDATE et récupère leurs ids en base."""
+        if not assets:
+            return
+
+        columns = [column.name for column in Asset.__table__.columns]  # type: ignore
+        now = datetime.now()
+        rows = [{**{column: getattr(asset, column) for column in columns}, 'updated_at': now} for asset in assets]
+
+        ids = {}
+        for start in range(0, len(rows), UPSERT_BATCH_SIZE):
+            statement = insert(Asset).values(rows[start : start + UPSERT_BATCH_SIZE])
+            statement = statement.on_conflict_do_update(
+                index_elements=['token_id', 'user_id'],
+                set_={column: statement.excluded[column] for column in columns if column not in UPSERT_KEEP_COLUMNS},
+            ).returning(Asset.token_id, Asset.id)
+            result = await self.session.exec(statement)  # type: ignore
+            ids |= dict(result.all())
+
+        for asset in assets:
+            asset.id = ids[asset.token_id]
+
+    async def delete_assets(self, user_id: uuid.UUID, token_ids: set[str]):
+        if not token_ids:
+            return
+
+        for model in (AssetWallet, AssetLot, Asset):
+            await self.session.exec(
+                delete(model).where(model.user_id == user_id, model.token_id.in_(token_ids))  # type: ignore
             )
-            result = await self.session.exec(statement)
-            user = result.one()
 
-            token_ids = set()
-            for trx in user.transactions:
-                token_ids.add(trx.actif_a_id)
-                token_ids.add(trx.actif_v_id)
-                token_ids.add(trx.actif_f_id)
-            token_ids.discard(None)
+    async def load_lot_books(self, user_id: uuid.UUID, token_ids: set[str]) -> dict:
+        books = {token_id: new_lot_books() for token_id in token_ids}
+        if not token_ids:
+            return books
+
+        statement = (
+            select(AssetLot)
+            .where(AssetLot.user_id == user_id, AssetLot.token_id.in_(token_ids))  # type: ignore
+            .order_by(AssetLot.token_id, AssetLot.method, AssetLot.seq)
+        )
+        result = await self.session.exec(statement)
+        for lot in result.all():
+            for book in books[lot.token_id]:
+                if book.method == lot.method:
+                    book.add(lot.qty, lot.price, lot.date)
+
+        return books
+
+    async def save_lot_books(self, user_id: uuid.UUID, books: dict, replace_all: bool = False):
+        # Les lots des tokens concernés sont réécrits : ils ne dépendent que des lots encore ouverts
+        statement = delete(AssetLot).where(AssetLot.user_id == user_id)
+        if not replace_all:
+            statement = statement.where(AssetLot.token_id.in_(books))  # type: ignore
+        await self.session.exec(statement)  # type: ignore
 
-            assets_dict = {asset.token_id: asset for asset in user.assets}
+        self.session.add_all(
+            [
+                AssetLot(user_id=user_id, token_id=token_id, method=book.method, seq=seq, qty=qty, price=price, date=date)
+                for token_id, token_books in books.items()
+                for book in token_books
+                for seq, (qty, price, date) in enumerate(book.to_lots())
+            ]
+        )
+
+    async def save_wallets(self, wallets: list[tuple[Asset, dict | None]]):
+        """Réécrit la répartition par wallet des assets donnés : [(asset, {wallet: qty}), ...]."""
+        wallets = [(asset, qty_by_wallet) for asset, qty_by_wallet in wallets if qty_by_wallet is not None]
+        if not wallets:
+            return
+
+        asset_ids = [asset.id for asset, _ in wallets]
+        await self.session.exec(delete(AssetWallet).where(AssetWallet.asset_id.in_(asset_ids)))  # type: ignore
+        self.session.add_all(
+            [
+                AssetWallet(asset_id=asset.id, user_id=asset.user_id, token_id=asset.token_id, wallet=wallet, qty=qty)
+                for asset, qty_by_wallet in wallets
+                for wallet, qty in qty_by_wallet.items()
+            ]
+        )
+
+    async def get_user_wallets(self, current_user_uid):
+        # Valeur (USD) détenue sur chaque wallet, agrégée en SQL ; les fiats sont exclues comme pour la valeur du pf
+        statement = (
+            select(
+                AssetWallet.wallet,
+                func.sum(AssetWallet.qty * Token.price).label('value'),
+                func.count(func.distinct(AssetWallet.token_id)).label('token_count'),
+            )
+            .join(Token, Token.cg_id == AssetWallet.token_id)  # type: ignore
+            .where(
+                AssetWallet.user_id == current_user_uid,
+                AssetWallet.qty > 0,
+                AssetWallet.token_id.not_in(settings.FIATS),  # type: ignore
+            )
+            .group_by(AssetWallet.wallet)
+            .order_by(func.sum(AssetWallet.qty * Token.price).desc())
+        )
+        results = await self.session.exec(statement)
+        return [
+            AssetWalletPublic(wallet=wallet, value=value or 0, token_count=token_count)
+            for wallet, value, token_count in results.all()
+        ]
+
+    async def delete_old_assets(self, current_user_uid, ledger: LedgerContext | None = None):
+        try:
+            if ledger is None:
+                ledger = await LedgerContext.load(self.session, current_user_uid)
+            statement = select(Asset.token_id).where(Asset.user_id == current_user_uid)
+            result = await self.session.exec(statement)
 
-            assets_ids = set(assets_dict.keys())
-            missing_in_tx = assets_ids - token_ids
+            assets_ids = set(result.all())
+            missing_in_tx = assets_ids - ledger.token_ids
 
-            for asset_to_delete_from_assets in missing_in_tx:
-                print(assets_dict.get(asset_to_delete_from_assets))
-                await self.session.delete(assets_dict.get(asset_to_delete_from_assets))
+            await self.delete_assets(current_user_uid, missing_in_tx)
             await self.session.commit()
 
         except Exception as err:
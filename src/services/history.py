@@ -1,21 +1,33 @@
 import time
+import uuid
 from collections import defaultdict
-from datetime import timedelta
+from datetime import datetime
 
 import aiohttp
 import pandas as pd
 from fastapi import HTTPException, status
 from sqlalchemy.exc import NoResultFound
-from sqlmodel import select
+from sqlmodel import delete, desc, func, insert, select, update
 from sqlmodel.ext.asyncio.session import AsyncSession
 from src.celery.tasks import compute_pf_history_task, wait_for_celery_result
 from src.config import settings
 from src.db.models import DtaoCgList, FiatHistory, Token, Transaction, User, UserPfHistory
 from src.schemes.token import Ticker
-from src.utils.calculations import get_cash_in_fiat, get_cash_in_usd
+from src.utils.calculations import get_cash_in, invalidate_cash_in_state
+from src.utils.fx import FX_LOOKBACK, convert_usd_totals
 from src.utils.tvdatafeed import find_longest_history, get_history_ohlc_single_symbol, get_tv_search
 
 
+HISTORY_INSERT_BATCH_SIZE = 500  # Reste sous la limite de variables par requête de SQLite
+
+# Colonnes fiat de `user_portfolio_history` (préfixe) -> colonnes du DataFrame résultat (préfixe)
+HISTORY_COLUMN_SOURCES = {
+    'value_in_': 'total_fiat_',
+    'cash_in_': 'cash_in_fiat_',
+    'pnl_percent_fiat_': 'pnl_percent_fiat_',
+}
+
+
 class HistoryService:
     def __init__(self, session: AsyncSession):
         self.session = session
@@ -73,15 +85,43 @@ class HistoryService:
 
         return (df_pivot, transactions)
 
-    async def calculate_histo_pf(self, current_user_uid, tv_list):
+    async def calculate_histo_pf(self, current_user_uid, tv_list, full: bool = False):
+        """
+        Calcule l'historique du portefeuille et l'enregistre dans `user_portfolio_history`.
+
+        Par défaut seuls les jours à partir du plus ancien entre le dernier jour stocké et la plus ancienne
+        transaction modifiée (`users.history_dirty_date`) sont recalculés puis remplacés. `full=True` reconstruit
+        tout l'historique.
+        """
         df_qty, transactions = await self.build_portfolio_df(current_user_uid)
 
+        usr = await self.session.get(User, current_user_uid, populate_existing=True)
+        dirty_date = usr.history_dirty_date
+        if len(df_qty) < 2:
+            # Aucune journée terminée (transactions toutes datées d'aujourd'hui) : l'historique est vide
+            await self.replace_history(current_user_uid, [], None, dirty_date)
+            return {'data': []}
+
+        since = None if full else await self.get_history_start(current_user_uid, dirty_date)
+        cash_in_start = None
+
+        if since is not None:
+            since = min(since, df_qty.index[-2].to_pydatetime())  # Au moins la dernière journée terminée
+            df_period = df_qty.loc[since:]
+            df_period = df_period.loc[:, (df_period > 0).any()]  # Tokens encore détenus sur la période
+            if df_period.columns.empty:
+                since = None  # Plus rien à valoriser sur la période : reconstruction complète
+            else:
+                df_qty = df_period
+                transactions = [t for t in transactions if t.date >= since]
+                cash_in_start = await self.get_cash_in_before(current_user_uid, since)
+
         # Conversion pour Celery
         df_qty_json = df_qty.to_json(orient='split')
         tv_list_data = [t.dict() for t in tv_list]
         transactions_data = [t.model_dump() for t in transactions]
 
-        # get_cash_in_usd(transactions_data)
+        # get_cash_in(transactions_data)
 
         # Tache sans celery (work pc)
         # -------------------------------------------------------------------------------------
@@ -111,65 +151,27 @@ class HistoryService:
         ignored_tokens = task_result['ignored_tokens']
         # -------------------------------------------------------------------------------------
 
-        # Ajout colonne des totaux en fiat_usd
-
-        for fiat_id in [f for f in settings.FIATS if f != 'fiat_usd']:
-            min_date = result[0]['index'] - timedelta(days=20)
-            max_date = result[-1]['index']
-            statement = select(FiatHistory.date, FiatHistory.close).where(
-                FiatHistory.cg_id == fiat_id, FiatHistory.date >= min_date, FiatHistory.date <= max_date
-            )
-            results = await self.session.exec(statement)
-            fiat_history_dict = {date: rate for date, rate in results.all()}  # ✅ proper dict
-
-            sorted_dates = sorted(fiat_history_dict.keys())
-
-            for row in result:
-                date = row['index']
-
-                # Cherche la dernière date <= date
-                nearest_rate = None
-                for d in reversed(sorted_dates):  # on parcourt depuis la fin
-                    if d <= date:
-                        nearest_rate = fiat_history_dict[d]
-                        break
-
-                if row['total_fiat_usd'] != 0 and nearest_rate is not None:
-                    row[f'total_{fiat_id}'] = row['total_fiat_usd'] / nearest_rate
-                else:
-                    row[f'total_{fiat_id}'] = 0.0
-
-        # Fin ajout de la colonne en fiat_usd
-
+        # Ajout des colonnes de totaux dans les autres fiats
         df_result = pd.DataFrame(result)
+        await self.add_fiat_totals(df_result)
+
         df_result['index'] = pd.to_datetime(df_result['index']).dt.normalize()
         df_result = df_result.set_index('index')
 
         # Ajout des colonnes cash in
         # -------------------------------------------------------------------------------------------------------------------------
 
-        async def process_cash_in(transactions_data, df_result, fiat='fiat_usd'):
-            if fiat == 'fiat_usd':
-                # USD
-                cash_in = await get_cash_in_usd(transactions_data, df_result)
-                col_name = 'cash_in_fiat_usd'
-            else:
-                # autres FIATS
-                cash_in = await get_cash_in_fiat(transactions_data, df_result, fiat)
-                col_name = f'cash_in_{fiat}'
-
-            df_cash_in = pd.DataFrame(cash_in)
-            df_cash_in['date'] = df_cash_in['date'].dt.normalize()
-            df_cash_in = df_cash_in.set_index('date')
-            df_cash_in = df_cash_in[~df_cash_in.index.duplicated(keep='last')]
-
-            cash_in_series = df_cash_in.reindex(df_result.index, method='ffill')
-            cash_in_series[col_name] = cash_in_series[col_name].fillna(0)
-
-            df_result[col_name] = cash_in_series[col_name]
+        df_cash_in = await get_cash_in(transactions_data, df_result, fiats=settings.FIATS, start=cash_in_start)
+        df_cash_in['date'] = df_cash_in['date'].dt.normalize()
+        df_cash_in = df_cash_in.set_index('date')
+        df_cash_in = df_cash_in[~df_cash_in.index.duplicated(keep='last')]
 
+        # Avant le premier achat/vente de la période, le cash in est celui de la veille du recalcul
+        cash_in_series = df_cash_in.reindex(df_result.index, method='ffill').fillna(
+            {f'cash_in_{fiat}': (cash_in_start or {}).get(fiat, 0) for fiat in settings.FIATS}
+        )
         for fiat in settings.FIATS:
-            await process_cash_in(transactions_data, df_result, fiat=fiat)
+            df_result[f'cash_in_{fiat}'] = cash_in_series[f'cash_in_{fiat}']
 
         # -------------------------------------------------------------------------------------------------------------------------
         # Fin ajout des colonnes cash in
@@ -186,57 +188,139 @@ class HistoryService:
         # -------------------------------------------------------------------------------------------------------------------------
         # Fin ajout des colonnes performances en %
 
-        # Supprimer les anciens historiques pour cet utilisateur
-        statement = select(UserPfHistory).where(UserPfHistory.user_id == current_user_uid)
-        results = await self.session.exec(statement)
-        old_records = results.all()
+        await self.replace_history(current_user_uid, self.history_rows(current_user_uid, df_result), since, dirty_date)
 
-        for record in old_records:
-            await self.session.delete(record)
+        # Réponse inchangée : tout l'historique, y compris les jours non recalculés
+        result = await self.get_history_totals(current_user_uid)
 
-        # On passe le paramètre d'initialisation du pf à false
-        usr = await self.session.get(User, current_user_uid)
-        usr.history_init = False
-        self.session.add(usr)
+        if len(ignored_tokens) > 0:
+            response = {
+                'data': result,
+                'warning': f"L'historique n'a pas pu être récupéré pour les tokens suivants : {ignored_tokens}. Veuillez indiquer un autre exchange tradingview ou ces tokens seront ignorés dans l'historique.\nVous pouvez quitter cet outil si vous souhaitez ignorer ces tokens.",
+            }
+        else:
+            response = {'data': result}
 
-        await self.session.commit()
+        return response
 
-        # Ajouter les nouvelles données
-        for row in df_result.reset_index().to_dict(orient='records'):
-            new_item = UserPfHistory(
-                user_id=current_user_uid,
-                date=row['index'],
-                value_in_usd=row['total_fiat_usd'],
-                value_in_eur=row['total_fiat_eur'],
-                value_in_cad=row['total_fiat_cad'],
-                value_in_chf=row['total_fiat_chf'],
-                cash_in_usd=row['cash_in_fiat_usd'],
-                cash_in_eur=row['cash_in_fiat_eur'],
-                cash_in_cad=row['cash_in_fiat_cad'],
-                cash_in_chf=row['cash_in_fiat_chf'],
-                pnl_percent_fiat_usd=row['pnl_percent_fiat_usd'],
-                pnl_percent_fiat_eur=row['pnl_percent_fiat_eur'],
-                pnl_percent_fiat_cad=row['pnl_percent_fiat_cad'],
-                pnl_percent_fiat_chf=row['pnl_percent_fiat_chf'],
+    async def replace_history(self, current_user_uid, rows: list[dict], since: datetime | None, dirty_date):
+        """Remplace les jours à partir de `since` (tous si None) par `rows`, dans un seul commit."""
+        # Remplacement des jours recalculés en une seule transaction : une suppression, une insertion multi-lignes
+        statement = delete(UserPfHistory).where(UserPfHistory.user_id == current_user_uid)
+        if since is not None:
+            statement = statement.where(UserPfHistory.date >= since)
+        await self.session.exec(statement)
+
+        for start in range(0, len(rows), HISTORY_INSERT_BATCH_SIZE):
+            await self.session.exec(insert(UserPfHistory).values(rows[start : start + HISTORY_INSERT_BATCH_SIZE]))
+
+        # Le cash in des ventes dépend de l'historique : les états de cash in persistés ne sont plus valides
+        await invalidate_cash_in_state(self.session, current_user_uid, since=since)
+
+        # Les transactions modifiées pendant le calcul restent à prendre en compte au prochain
+        if dirty_date is not None:
+            statement = (
+                update(User)
+                .where(User.uid == current_user_uid, User.history_dirty_date == dirty_date)
+                .values(history_dirty_date=None)
             )
-            self.session.add(new_item)
+            await self.session.exec(statement)
 
-        # On passe le paramètre d'initialisation du pf à true
+        # Historique initialisé, dans le même commit que les nouvelles lignes
         usr = await self.session.get(User, current_user_uid)
         usr.history_init = True
         self.session.add(usr)
 
         await self.session.commit()
 
-        if len(ignored_tokens) > 0:
-            response = {
-                'data': result,
-                'warning': f"L'historique n'a pas pu être récupéré pour les tokens suivants : {ignored_tokens}. Veuillez indiquer un autre exchange tradingview ou ces tokens seront ignorés dans l'historique.\nVous pouvez quitter cet outil si vous souhaitez ignorer ces tokens.",
+    async def get_history_totals(self, current_user_uid) -> list[dict]:
+        """Historique stocké complet, au format de la tâche celery (`index` et `total_{fiat}`)."""
+        statement = (
+            select(UserPfHistory).where(UserPfHistory.user_id == current_user_uid).order_by(UserPfHistory.date)
+        )
+        results = await self.session.exec(statement)
+        return [
+            {
+                'index': entry.date,
+                **{
+                    f'total_fiat_{field.removeprefix("value_in_")}': getattr(entry, field)
+                    for field in UserPfHistory.model_fields
+                    if field.startswith('value_in_')
+                },
             }
-        else:
-            response = {'data': result}
+            for entry in results.all()
+        ]
+
+    async def add_fiat_totals(self, df_result: pd.DataFrame):
+        """Ajoute `total_{fiat}` pour chaque fiat hors USD : une requête pour tous les cours, puis une jointure as-of."""
+        fiats = [f for f in settings.FIATS if f != 'fiat_usd']
+        dates = pd.to_datetime(df_result['index'])
+
+        statement = (
+            select(FiatHistory.cg_id, FiatHistory.date, FiatHistory.close)
+            .where(
+                FiatHistory.cg_id.in_(fiats),  # type: ignore
+                FiatHistory.date >= dates.min().to_pydatetime() - FX_LOOKBACK,
+                FiatHistory.date <= dates.max().to_pydatetime(),
+            )
+            .order_by(FiatHistory.cg_id, FiatHistory.date)
+        )
+        results = await self.session.exec(statement)
+        df_fx = pd.DataFrame(results.all(), columns=['cg_id', 'date', 'close'])
 
-        return response
+        for fiat_id in fiats:
+            df_fiat = df_fx[df_fx['cg_id'] == fiat_id]
+            df_result[f'total_{fiat_id}'] = convert_usd_totals(
+                dates, df_result['total_fiat_usd'], df_fiat['date'], df_fiat['close']
+            )
+
+    @staticmethod
+    def history_rows(user_id: uuid.UUID, df_result: pd.DataFrame) -> list[dict]:
+        """
+        Lignes de `user_portfolio_history` construites colonne par colonne depuis le DataFrame résultat. Les colonnes
+        fiat sont celles du modèle : une fiat de `settings.FIATS` sans colonne n'est pas stockée, une colonne sans
+        valeur calculée lève une ValueError.
+        """
+        columns = {
+            'id': [uuid.uuid4() for _ in range(len(df_result))],
+            'user_id': [user_id] * len(df_result),
+            'date': [date.to_pydatetime() for date in df_result.index],
+        }
+        for field in UserPfHistory.model_fields:
+            prefix = next((prefix for prefix in HISTORY_COLUMN_SOURCES if field.startswith(prefix)), None)
+            if prefix is None:
+                continue
+            source = HISTORY_COLUMN_SOURCES[prefix] + field.removeprefix(prefix)
+            if source not in df_result.columns:
+                raise ValueError(f'Missing {source} in history result for column {field}')
+            columns[field] = df_result[source].astype(float).tolist()
+
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+    async def get_history_start(self, user_id: uuid.UUID, dirty_date: datetime | None) -> datetime | None:
+        """Premier jour à recalculer, ou None s'il n'y a pas encore d'historique (reconstruction complète)."""
+        statement = select(func.max(UserPfHistory.date)).where(UserPfHistory.user_id == user_id)
+        last_date = (await self.session.exec(statement)).one()
+        if last_date is None:
+            return None
+        return min(last_date, dirty_date) if dirty_date is not None else last_date
+
+    async def get_cash_in_before(self, user_id: uuid.UUID, since: datetime) -> dict[str, float] | None:
+        """Cash in par fiat de la dernière journée stockée avant `since`."""
+        statement = (
+            select(UserPfHistory)
+            .where(UserPfHistory.user_id == user_id, UserPfHistory.date < since)
+            .order_by(desc(UserPfHistory.date))
+            .limit(1)
+        )
+        previous = (await self.session.exec(statement)).first()
+        if previous is None:
+            return None
+        return {
+            f'fiat_{field.removeprefix("cash_in_")}': getattr(previous, field)
+            for field in UserPfHistory.model_fields
+            if field.startswith('cash_in_')
+        }
 
     async def get_best_ticker_exchange(self, cg_id: str):
         r = {}
@@ -273,7 +357,7 @@ class HistoryService:
                 if r['exchange'] == 'CRYPTO':
                     return r
 
-            r = find_longest_history(exchange_list)
+            r = await find_longest_history(exchange_list)
 
             if r is None:
                 raise HTTPException(
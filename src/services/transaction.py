@@ -1,75 +1,136 @@
+import base64
 import uuid
+from datetime import datetime
+from typing import AsyncIterator
 
 from fastapi import HTTPException, status
 from fastapi.responses import JSONResponse
 from pydantic import ValidationError
 from sqlalchemy.exc import NoResultFound, SQLAlchemyError
-from sqlalchemy.orm import joinedload, selectinload
-from sqlmodel import select
+from sqlalchemy.orm import joinedload
+from sqlmodel import and_, insert, or_, select
 from sqlmodel.ext.asyncio.session import AsyncSession
-from src.celery.tasks import get_total_pnl_task
 from src.db.models import Token, Transaction, User
-from src.services.asset import AssetService
+from src.schemes.transaction import TransactionBatch
+from src.utils.asset import touches_tokens
+from src.utils.bulk import get_content_hash, parse_transaction_lines
+from src.utils.cache import bump_ledger_version
+from src.utils.calculations import invalidate_cash_in_state, mark_history_dirty
+from src.utils.queue import asset_queue
+
+LEDGER_VERSION_HEADER = 'X-Ledger-Version'
+BULK_INSERT_BATCH_SIZE = 500  # Reste sous la limite de variables par requête de SQLite
+BULK_MAX_ERRORS = 50
+NEXT_CURSOR_HEADER = 'X-Next-Cursor'
+
+
+def encode_cursor(trx: Transaction) -> str:
+    """Curseur opaque pointant après `trx` dans l'ordre (date DESC, id DESC)."""
+    return base64.urlsafe_b64encode(f'{trx.date.isoformat()}|{trx.id}'.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, uuid.UUID]:
+    try:
+        cursor_date, cursor_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(cursor_date), uuid.UUID(cursor_id)
+    except ValueError as err:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail='Invalid cursor.') from err
 
 
 class TransactionService:
     def __init__(self, session: AsyncSession):
         self.session = session
-
-    async def get_user_transactions(self, current_user_uid):
+        self.ledger_version: int | None = None  # Version du ledger après la dernière écriture
+        self.duplicate = False  # La dernière création était un doublon d'une transaction existante
+
+    async def get_user_transactions(
+        self,
+        current_user_uid,
+        limit: int | None = None,
+        cursor: str | None = None,
+        type: str | None = None,
+        token: str | None = None,
+        wallet: str | None = None,
+    ):
+        """
+        Transactions de l'utilisateur, des plus récentes aux plus anciennes (date DESC, id DESC), avec filtres
+        optionnels. Pagination par curseur sur l'index (user_id, date) : retourne la page et le curseur de la
+        suivante (None s'il n'y en a pas). Sans `limit`, tout l'historique est renvoyé.
+        """
         statement = (
-            select(User)
-            .where(User.uid == current_user_uid)
+            select(Transaction)
+            .where(Transaction.user_id == current_user_uid)
             .options(
-                selectinload(User.transactions).selectinload(Transaction.actif_a).load_only(Token.symbol, Token.rank, Token.name), # type: ignore 
-                selectinload(User.transactions).selectinload(Transaction.actif_v).load_only(Token.symbol, Token.rank, Token.name), # type: ignore
-                selectinload(User.transactions).selectinload(Transaction.actif_f).load_only(Token.symbol, Token.rank, Token.name), # type: ignore
+                joinedload(Transaction.actif_a).load_only(Token.symbol, Token.rank, Token.name),  # type: ignore
+                joinedload(Transaction.actif_v).load_only(Token.symbol, Token.rank, Token.name),  # type: ignore
+                joinedload(Transaction.actif_f).load_only(Token.symbol, Token.rank, Token.name),  # type: ignore
             )
-        )  # fmt: skip
+            .order_by(Transaction.date.desc(), Transaction.id.desc())  # type: ignore
+        )
+        if type is not None:
+            statement = statement.where(Transaction.type == type)
+        if token is not None:
+            statement = statement.where(touches_tokens({token}))
+        if wallet is not None:
+            statement = statement.where(or_(Transaction.destination == wallet, Transaction.origin == wallet))
+        if cursor is not None:
+            cursor_date, cursor_id = decode_cursor(cursor)
+            statement = statement.where(
+                or_(
+                    Transaction.date < cursor_date,
+                    and_(Transaction.date == cursor_date, Transaction.id < cursor_id),  # type: ignore
+                )
+            )
+        if limit is not None:
+            statement = statement.limit(limit + 1)  # Une ligne de plus pour savoir s'il reste une page
+
         result = await self.session.exec(statement)
-        user_with_tx = result.one()
-        missing_tokens = [str(t.actif_a_id) for t in user_with_tx.transactions if t.actif_a is None]
+        transactions = list(result.all())
+
+        missing_tokens = [str(t.actif_a_id) for t in transactions if t.actif_a is None]
         if missing_tokens:
             raise HTTPException(
                 status_code=status.HTTP_404_NOT_FOUND,
                 detail=f'token(s) {", ".join(missing_tokens)} missing in DB. Contact administrator.',
             )
 
-        return sorted(user_with_tx.transactions, key=lambda trx: trx.date, reverse=True) if user_with_tx else []
+        next_cursor = None
+        if limit is not None and len(transactions) > limit:
+            transactions = transactions[:limit]
+            next_cursor = encode_cursor(transactions[-1])
+
+        return transactions, next_cursor
 
     async def create_transactions(self, trx_data, current_user: User):
         user_id = current_user.uid
-        fiat = current_user.fiat_id
 
         extra_data = {'user_id': user_id}
         try:
             db_trx = Transaction.model_validate(trx_data, update=extra_data)
+            db_trx.content_hash = get_content_hash(db_trx)
+
+            # Transaction déjà importée : renvoyée telle quelle, sans nouvelle écriture
+            existing_ids = await self.find_duplicates(user_id, [db_trx.content_hash])
+            if existing_ids:
+                self.duplicate = True
+                self.ledger_version = current_user.ledger_version
+                return await self.get_transaction_with_relations(existing_ids[db_trx.content_hash])
+
             self.session.add(db_trx)
+            await invalidate_cash_in_state(self.session, user_id, since=db_trx.date)
+            await mark_history_dirty(self.session, user_id, since=db_trx.date)
+            self.ledger_version = await bump_ledger_version(self.session, user_id)
             await self.session.commit()
             await self.session.refresh(db_trx)
 
-            statement = (
-                select(Transaction)
-                .options(
-                    joinedload(Transaction.actif_a).load_only(Token.symbol, Token.rank, Token.name),  # type: ignore
-                    joinedload(Transaction.actif_v).load_only(Token.symbol, Token.rank, Token.name),  # type: ignore
-                    joinedload(Transaction.actif_f).load_only(Token.symbol, Token.rank, Token.name),  # type: ignore
-                )
-                .where(Transaction.id == db_trx.id)
-            )
-
-            result = await self.session.exec(statement)
-            transaction_with_relations = result.first()
+            transaction_with_relations = await self.get_transaction_with_relations(db_trx.id)
             if not transaction_with_relations:
                 raise HTTPException(
                     status_code=status.HTTP_404_NOT_FOUND, detail='Transaction not found after creation'
                 )
 
-            await self.update_assets_from_transaction(transaction_with_relations, user_id)  # Update Assets
-
-            get_total_pnl_task.delay(user_id=user_id, fiat='fiat_usd')
-            if fiat != 'fiat_usd':
-                get_total_pnl_task.delay(user_id=user_id, fiat=fiat)
+            # Assets puis PnL recalculés en tâche de fond
+            self.update_assets_from_transaction([(Transaction(**db_trx.model_dump()), 1)], current_user)
 
             return transaction_with_relations
 
@@ -85,9 +146,85 @@ class TransactionService:
             await self.session.rollback()
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail='Unexpected error')
 
+    async def bulk_create_transactions(self, lines: AsyncIterator[str], fmt: str, current_user: User):
+        """
+        Import en une seule fois d'un export CSV ou NDJSON : lignes validées au fil du flux, tokens vérifiés en une
+        requête, insertions par lots dans une même transaction, puis un seul recalcul des assets et du PnL.
+        Rien n'est importé si une ligne est invalide.
+        """
+        user_id = current_user.uid
+
+        transactions = []
+        errors = []
+        async for line_number, trx, error in parse_transaction_lines(lines, fmt):
+            if error is not None:
+                errors.append(f'Ligne {line_number} : {error}')
+            else:
+                transactions.append(Transaction.model_validate(trx, update={'user_id': user_id}))
+
+        if not errors and not transactions:
+            errors.append('Aucune transaction à importer.')
+
+        token_ids = {
+            token_id for trx in transactions for token_id in (trx.actif_a_id, trx.actif_v_id, trx.actif_f_id)
+        } - {None}
+        if token_ids:
+            statement = select(Token.cg_id).where(Token.cg_id.in_(token_ids))  # type: ignore
+            result = await self.session.exec(statement)
+            missing_ids = token_ids - set(result.all())
+            if missing_ids:
+                errors.append(f'Tokens inconnus : {", ".join(sorted(missing_ids))}')
+
+        if errors:
+            raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=errors[:BULK_MAX_ERRORS])
+
+        self.ledger_version = current_user.ledger_version
+        imported = []
+        try:
+            for trx in transactions:
+                trx.content_hash = get_content_hash(trx)
+
+            # Empreintes présentes avant l'import, lues avant toute insertion : les lignes déjà présentes (export
+            # ré-importé) sont ignorées, les doublons internes au fichier sont gardés quelle que soit leur position
+            existing_hashes = set()
+            for start in range(0, len(transactions), BULK_INSERT_BATCH_SIZE):
+                batch = transactions[start : start + BULK_INSERT_BATCH_SIZE]
+                existing_hashes |= (await self.find_duplicates(user_id, [trx.content_hash for trx in batch])).keys()
+
+            for start in range(0, len(transactions), BULK_INSERT_BATCH_SIZE):
+                batch = transactions[start : start + BULK_INSERT_BATCH_SIZE]
+                batch = [trx for trx in batch if trx.content_hash not in existing_hashes]
+                if batch:
+                    await self.session.exec(insert(Transaction).values([trx.model_dump() for trx in batch]))
+                    imported.extend(batch)
+
+            if imported:
+                await invalidate_cash_in_state(self.session, user_id, since=min(trx.date for trx in imported))
+                await mark_history_dirty(self.session, user_id, since=min(trx.date for trx in imported))
+                self.ledger_version = await bump_ledger_version(self.session, user_id)
+                await self.session.commit()
+
+        except SQLAlchemyError as e:
+            await self.session.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f'Database error while importing: {str(e)}'
+            )
+
+        if imported:
+            self.update_assets_from_transaction([(trx, 1) for trx in imported], current_user)
+
+        return JSONResponse(
+            status_code=status.HTTP_201_CREATED if imported else status.HTTP_200_OK,
+            content={
+                'detail': 'Transactions imported successfully.',
+                'count': len(imported),
+                'skipped': len(transactions) - len(imported),
+            },
+            headers={LEDGER_VERSION_HEADER: str(self.ledger_version)},
+        )
+
     async def delete_transaction(self, trx_id, current_user: User):
         user_id = current_user.uid
-        fiat = current_user.fiat_id
         trx_uid = uuid.UUID(trx_id)
 
         try:
@@ -109,15 +246,19 @@ class TransactionService:
             )
 
         try:
+            deleted_trx = Transaction(**trx_to_delete.model_dump())
             await self.session.delete(trx_to_delete)
+            await invalidate_cash_in_state(self.session, user_id, since=trx_to_delete.date)
+            await mark_history_dirty(self.session, user_id, since=trx_to_delete.date)
+            self.ledger_version = await bump_ledger_version(self.session, user_id)
             await self.session.commit()
-            await self.update_assets_from_transaction(trx_to_delete, user_id)
-
-            get_total_pnl_task.delay(user_id=user_id, fiat='fiat_usd')
-            if fiat != 'fiat_usd':
-                get_total_pnl_task.delay(user_id=user_id, fiat=fiat)
+            self.update_assets_from_transaction([(deleted_trx, -1)], current_user)
 
-            return JSONResponse(status_code=status.HTTP_200_OK, content={'detail': 'Transaction deleted successfully.'})
+            return JSONResponse(
+                status_code=status.HTTP_200_OK,
+                content={'detail': 'Transaction deleted successfully.'},
+                headers={LEDGER_VERSION_HEADER: str(self.ledger_version)},
+            )
 
         except SQLAlchemyError as e:
             await self.session.rollback()
@@ -131,7 +272,6 @@ class TransactionService:
 
     async def update_transactions(self, trx_data, current_user: User):
         user_id = current_user.uid
-        fiat = current_user.fiat_id
 
         try:
             db_trx = Transaction.model_validate(trx_data)
@@ -142,40 +282,20 @@ class TransactionService:
                     status_code=status.HTTP_404_NOT_FOUND, detail=f'Transaction ID {db_trx.id} not found.'
                 )
 
-            existing_transaction.type = db_trx.type
-            existing_transaction.date = db_trx.date
-            existing_transaction.qty_a = db_trx.qty_a
-            existing_transaction.qty_f = db_trx.qty_f or None
-            existing_transaction.actif_a_id = db_trx.actif_a_id
-            existing_transaction.actif_v_id = db_trx.actif_v_id or None
-            existing_transaction.actif_f_id = db_trx.actif_f_id or None
-            existing_transaction.price = db_trx.price or None
-            existing_transaction.value_a = db_trx.value_a or None
-            existing_transaction.value_f = db_trx.value_f or None
-            existing_transaction.origin = db_trx.origin or None
-            existing_transaction.destination = db_trx.destination
+            old_trx = Transaction(**existing_transaction.model_dump())
 
+            self.set_transaction_fields(existing_transaction, db_trx)
             self.session.add(existing_transaction)
+            await invalidate_cash_in_state(self.session, user_id, since=min(old_trx.date, existing_transaction.date))
+            await mark_history_dirty(self.session, user_id, since=min(old_trx.date, existing_transaction.date))
+            self.ledger_version = await bump_ledger_version(self.session, user_id)
             await self.session.commit()
 
-            statement = (
-                select(Transaction)
-                .options(
-                    joinedload(Transaction.actif_a).load_only(Token.symbol, Token.rank, Token.name),
-                    joinedload(Transaction.actif_v).load_only(Token.symbol, Token.rank, Token.name),
-                    joinedload(Transaction.actif_f).load_only(Token.symbol, Token.rank, Token.name),
-                )
-                .where(Transaction.id == db_trx.id)
-            )
-
-            result = await self.session.exec(statement)
-            transaction_with_relations = result.first()
-
-            await self.update_assets_from_transaction(transaction_with_relations, transaction_with_relations.user_id)
+            transaction_with_relations = await self.get_transaction_with_relations(db_trx.id)
 
-            get_total_pnl_task.delay(user_id=user_id, fiat='fiat_usd')
-            if fiat != 'fiat_usd':
-                get_total_pnl_task.delay(user_id=user_id, fiat=fiat)
+            # Ancienne version retirée, nouvelle ajoutée : les tokens touchés sont rejoués depuis la plus ancienne date
+            new_trx = Transaction(**existing_transaction.model_dump())
+            self.update_assets_from_transaction([(old_trx, -1), (new_trx, 1)], current_user)
 
             return transaction_with_relations
 
@@ -194,17 +314,156 @@ class TransactionService:
             await self.session.rollback()
             raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f'Unexpected error: {str(e)}')
 
-    async def update_assets_from_transaction(self, transaction: Transaction, current_user_uid: uuid.UUID):
-        # token_ids = {
-        #   transaction.actif_a_id,
-        #   transaction.actif_v_id,
-        #   transaction.actif_f_id,
-        # } - {None}
+    async def batch_transactions(self, batch: TransactionBatch, current_user: User):
+        """
+        Applique des créations, modifications et suppressions en un seul commit : tout ou rien.
+        Les assets des tokens touchés et le PnL ne sont recalculés qu'une fois pour tout le lot.
+        Renvoie les transactions créées et modifiées, dans l'ordre des opérations.
+        """
+        user_id = current_user.uid
+        operations = batch.operations
+
+        # Une transaction ne peut être visée que par une seule opération du lot
+        target_ids = [op.data.id if op.op == 'update' else op.id for op in operations if op.op != 'create']
+        if len(set(target_ids)) != len(target_ids):
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail='A transaction can only appear in one operation of the batch.',
+            )
+
+        existing = {}
+        if target_ids:
+            statement = select(Transaction).where(Transaction.id.in_(target_ids))  # type: ignore
+            result = await self.session.exec(statement)
+            existing = {trx.id: trx for trx in result.all()}
+
+        missing_ids = [str(trx_id) for trx_id in target_ids if trx_id not in existing]
+        if missing_ids:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND, detail=f'Transactions not found: {", ".join(missing_ids)}'
+            )
+        if any(trx.user_id != user_id for trx in existing.values()):
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail='You are not authorized to modify these transactions.',
+            )
+
+        try:
+            new_transactions = [
+                Transaction.model_validate(op.data, update={'user_id': user_id})
+                for op in operations
+                if op.op != 'delete'
+            ]
+        except ValidationError as ve:
+            raise HTTPException(
+                status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail=f'Validation error: {ve.errors()}'
+            )
+
+        token_ids = {
+            token_id for trx in new_transactions for token_id in (trx.actif_a_id, trx.actif_v_id, trx.actif_f_id)
+        } - {None}
+        if token_ids:
+            statement = select(Token.cg_id).where(Token.cg_id.in_(token_ids))  # type: ignore
+            result = await self.session.exec(statement)
+            missing_tokens = token_ids - set(result.all())
+            if missing_tokens:
+                raise HTTPException(
+                    status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                    detail=f'Unknown tokens: {", ".join(sorted(missing_tokens))}',
+                )
+
+        changes = []
+        result_ids = []
+        new_trx_iter = iter(new_transactions)
+        try:
+            for op in operations:
+                if op.op == 'delete':
+                    trx = existing[op.id]
+                    changes.append((Transaction(**trx.model_dump()), -1))
+                    await self.session.delete(trx)
+                    continue
+
+                db_trx = next(new_trx_iter)
+                if op.op == 'update':
+                    trx = existing[op.data.id]
+                    changes.append((Transaction(**trx.model_dump()), -1))
+                    self.set_transaction_fields(trx, db_trx)
+                    self.session.add(trx)
+                else:
+                    trx = db_trx
+                    trx.content_hash = get_content_hash(trx)
+                    self.session.add(trx)
+                changes.append((Transaction(**trx.model_dump()), 1))
+                result_ids.append(trx.id)
+
+            await invalidate_cash_in_state(self.session, user_id, since=min(trx.date for trx, _ in changes))
+            await mark_history_dirty(self.session, user_id, since=min(trx.date for trx, _ in changes))
+            self.ledger_version = await bump_ledger_version(self.session, user_id)
+            await self.session.commit()
+
+        except SQLAlchemyError as db_err:
+            await self.session.rollback()
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=f'Database error: {str(db_err)}'
+            )
+
+        # Un seul passage dans la file : assets des tokens touchés puis un calcul du PnL
+        self.update_assets_from_transaction(changes, current_user)
+
+        transactions = {trx.id: trx for trx in await self.get_transactions_with_relations(result_ids)}
+        return [transactions[trx_id] for trx_id in result_ids]
+
+    @staticmethod
+    def set_transaction_fields(existing_transaction: Transaction, db_trx: Transaction):
+        existing_transaction.type = db_trx.type
+        existing_transaction.date = db_trx.date
+        existing_transaction.qty_a = db_trx.qty_a
+        existing_transaction.qty_f = db_trx.qty_f or None
+        existing_transaction.actif_a_id = db_trx.actif_a_id
+        existing_transaction.actif_v_id = db_trx.actif_v_id or None
+        existing_transaction.actif_f_id = db_trx.actif_f_id or None
+        existing_transaction.price = db_trx.price or None
+        existing_transaction.value_a = db_trx.value_a or None
+        existing_transaction.value_f = db_trx.value_f or None
+        existing_transaction.origin = db_trx.origin or None
+        existing_transaction.destination = db_trx.destination
+        existing_transaction.content_hash = get_content_hash(existing_transaction)
+
+    async def get_transaction_with_relations(self, trx_id: uuid.UUID):
+        transactions = await self.get_transactions_with_relations([trx_id])
+        return transactions[0] if transactions else None
+
+    async def get_transactions_with_relations(self, trx_ids: list[uuid.UUID]):
+        if not trx_ids:
+            return []
+        statement = (
+            select(Transaction)
+            .options(
+                joinedload(Transaction.actif_a).load_only(Token.symbol, Token.rank, Token.name),  # type: ignore
+                joinedload(Transaction.actif_v).load_only(Token.symbol, Token.rank, Token.name),  # type: ignore
+                joinedload(Transaction.actif_f).load_only(Token.symbol, Token.rank, Token.name),  # type: ignore
+            )
+            .where(Transaction.id.in_(trx_ids))  # type: ignore
+            .execution_options(populate_existing=True)  # Relations rechargées après changement des actifs
+        )
+        result = await self.session.exec(statement)
+        return result.all()
+
+    async def find_duplicates(self, user_id: uuid.UUID, content_hashes: list[str]) -> dict[str, uuid.UUID]:
+        """Transactions déjà enregistrées avec ces empreintes (une requête sur l'index (user_id, content_hash))."""
+        statement = select(Transaction.content_hash, Transaction.id).where(
+            Transaction.user_id == user_id,
+            Transaction.content_hash.in_(content_hashes),  # type: ignore
+        )
+        result = await self.session.exec(statement)
+        return {content_hash: trx_id for content_hash, trx_id in result.all()}
+
+    def update_assets_from_transaction(self, changes: list[tuple[Transaction, int]], current_user: User):
+        """Confie les modifications (+1 création, -1 suppression) à la file de recalcul des assets de l'utilisateur."""
         token_ids = {
             actif_id
+            for transaction, _ in changes
             for actif_id in {transaction.actif_a_id, transaction.actif_v_id, transaction.actif_f_id}
             if actif_id is not None and not str(actif_id).startswith('fiat_')
         }
-
-        if token_ids:
-            await AssetService(self.session).update_specific_assets(current_user_uid, token_ids)
+        asset_queue.enqueue(current_user.uid, changes, token_ids, self.ledger_version, current_user.fiat_id)
@@ -3,12 +3,13 @@ import uuid
 from fastapi import HTTPException, status
 from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
-from src.celery.tasks import get_total_pnl_task
 from src.db.models import User
 from src.schemes.user import UserParamsUpdate, UserUpdate, UserUpdateAdmin
+from src.utils.asset import get_calc_method
 from src.utils.dbcheck import (
     check_username_or_email_exists,
 )
+from src.utils.queue import pnl_scheduler
 from src.utils.security import hash_password, verify_password
 
 
@@ -186,6 +187,16 @@ class UserService:
     async def update_params(self, user_uid: uuid.UUID, params: UserParamsUpdate):
         params_to_update = params.model_dump(exclude_unset=True)
 
+        # Les prix moyens de toutes les méthodes sont déjà stockés : changer de méthode ne recalcule rien
+        if params_to_update.get('calc_method_display') is not None:
+            try:
+                get_calc_method(params_to_update['calc_method_display'], strict=True)
+            except ValueError as err:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail=str(err),
+                )
+
         user_db = await self.session.get(User, user_uid)
 
         if user_db is not None:
@@ -204,7 +215,7 @@ class UserService:
                 field and setattr(user_db, field, 0)
 
                 if new_fiat in fiat_field_map:
-                    get_total_pnl_task.delay(user_id=user_id, fiat=new_fiat)
+                    pnl_scheduler.schedule(user_id, {new_fiat})
 
             user_db.sqlmodel_update(params_to_update)
             self.session.add(user_db)
@@ -0,0 +1,301 @@
+import json
+from datetime import datetime
+
+import pytest
+from sqlalchemy import event
+from sqlalchemy.orm import selectinload
+from sqlmodel import select
+from src.db.models import Asset, AssetLot, AssetWallet, Token, Transaction, User
+from src.schemes.asset import AssetPublic
+from src.schemes.transaction import TransactionCreate
+from src.services.asset import AssetService
+from src.utils.asset import LotBook, get_asset_qty_by_wallet, get_holdings, get_mean_buys
+from src.utils.cache import TOKEN_PRICES, bump_version
+
+
+def make_trx(type, actif_a_id, qty_a, destination='binance', **kwargs):
+    return TransactionCreate(
+        date=kwargs.pop('date', datetime(2024, 1, 1)),
+        type=type,
+        actif_a_id=actif_a_id,
+        qty_a=qty_a,
+        destination=destination,
+        **kwargs,
+    )
+
+
+LEDGER = [
+    make_trx('Achat', 'bitcoin', 2, actif_v_id='fiat_eur', price=30000),
+    make_trx('Swap', 'ethereum', 10, actif_v_id='bitcoin', price=0.05, actif_f_id='ethereum', qty_f=0.1),
+    make_trx('Transfert', 'bitcoin', 1, origin='binance', destination='ledger', actif_f_id='bitcoin', qty_f=0.001),
+    make_trx('Retrait', 'fiat_eur', 1000),
+]
+
+
+def test_get_holdings_computes_every_token_in_one_pass():
+    holdings = get_holdings(LEDGER)
+
+    assert set(holdings) == {'bitcoin', 'ethereum', 'fiat_eur'}
+    assert holdings['bitcoin'] == (2 - 0.5 - 0.001, {'binance': 2 - 0.5 - 1, 'ledger': 1 - 0.001})
+    assert holdings['ethereum'] == (10 - 0.1, {'binance': 10 - 0.1})
+
+
+def test_get_holdings_clamps_negative_quantities_to_zero():
+    holdings = get_holdings(LEDGER)
+
+    assert holdings['fiat_eur'] == (0, {'binance': 0})
+
+
+def test_get_asset_qty_by_wallet_is_a_view_over_holdings():
+    assert get_asset_qty_by_wallet('bitcoin', LEDGER) == get_holdings(LEDGER)['bitcoin']
+    assert get_asset_qty_by_wallet('solana', LEDGER) == (0, {})
+
+
+def test_lot_book_weighted_average_scales_totals_on_removal():
+    book = LotBook(1)
+    book.add(2, 100)
+    book.add(2, 200)
+    book.remove(2)
+
+    assert book.total_qty == 2
+    assert book.mean_buy() == 150
+
+
+
+def test_lot_book_weighted_average_undo_add_only_when_it_empties_the_book():
+    book = LotBook(1)
+    book.add(0.1, 100, datetime(2024, 1, 1))
+    book.add(0.2, 200, datetime(2024, 1, 2))
+
+    # Lot agrégé encore ouvert : date précédente inconnue, le token sera rejoué
+    assert not book.undo_add(0.2, 200, datetime(2024, 1, 2))
+
+    # Dernier lot retiré : totaux remis à zéro malgré le résidu flottant (0.1 + 0.2 - 0.3 != 0)
+    book = LotBook(1)
+    book.add(0.1 + 0.2, 100, datetime(2024, 1, 1))
+    assert book.undo_add(0.3, 100, datetime(2024, 1, 1))
+    assert (book.total_qty, book.total_value, book.date, book.to_lots()) == (0, 0, None, [])
+
+def test_lot_book_fifo_consumes_oldest_lots():
+    book = LotBook(2)
+    book.add(1, 100)
+    book.add(1, 200)
+    book.remove(1.5)
+
+    assert book.mean_buy() == 200
+
+
+def test_lot_book_lifo_consumes_newest_lots():
+    book = LotBook(3)
+    book.add(1, 100)
+    book.add(1, 200)
+    book.remove(1.5)
+
+    assert book.mean_buy() == 100
+
+
+def test_lot_book_empty_is_zero():
+    for method in (1, 2, 3):
+        book = LotBook(method)
+        book.remove(1)
+        assert book.mean_buy() == 0
+
+
+@pytest.mark.asyncio
+async def test_get_mean_buys_computes_every_method_in_one_pass():
+    ledger = [
+        make_trx('Achat', 'bitcoin', 1, actif_v_id='tether', price=100, value_a=100),
+        make_trx('Achat', 'bitcoin', 1, actif_v_id='tether', price=300, value_a=300),
+        make_trx('Swap', 'ethereum', 5, actif_v_id='bitcoin', price=0.2, value_a=40),
+    ]
+
+    mean_buys = await get_mean_buys(ledger, session=None)
+
+    assert mean_buys['bitcoin'] == {'mean_buy_wavg': 200, 'mean_buy_fifo': 300, 'mean_buy_lifo': 100}
+    assert mean_buys['ethereum'] == {'mean_buy_wavg': 40, 'mean_buy_fifo': 40, 'mean_buy_lifo': 40}
+
+
+def test_asset_public_serves_mean_buy_of_user_calc_method():
+    token = Token(cg_id='bitcoin', name='Bitcoin', symbol='btc', price=400, rank=1)
+    asset = Asset(token_id='bitcoin', qty=1, mean_buy_wavg=200, mean_buy_fifo=300, mean_buy_lifo=100, token=token)
+
+    assert AssetPublic.from_asset(asset, 'weighted average').mean_buy == 200
+    assert AssetPublic.from_asset(asset, 'lifo').pnl_usd == 300
+    # Libellé enregistré avant la validation des paramètres : méthode par défaut
+    assert AssetPublic.from_asset(asset, 'median').mean_buy == 200
+
+
+@pytest.mark.asyncio
+async def test_update_specific_assets_appends_to_persisted_lots(session):
+    user = User(username='lots', email='lots@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    await session.commit()
+
+    def make_db_trx(*args, **kwargs):
+        return Transaction(user_id=user_id, **make_trx(*args, **kwargs).model_dump())
+
+    session.add_all(
+        [
+            make_db_trx('Achat', 'bitcoin', 1, actif_v_id='tether', price=100, value_a=100, date=datetime(2024, 1, 1)),
+            make_db_trx('Achat', 'bitcoin', 1, actif_v_id='tether', price=300, value_a=300, date=datetime(2024, 1, 2)),
+        ]
+    )
+    await session.commit()
+    await AssetService(session).update_specific_assets(user_id, {'bitcoin', 'tether'})
+
+    # Vente de 1.5 BTC postérieure à la dernière transaction : appliquée aux lots persistés
+    sale_date = datetime(2024, 1, 3)
+    session.add(make_db_trx('Swap', 'ethereum', 5, actif_v_id='bitcoin', price=0.3, value_a=60, date=sale_date))
+    await session.commit()
+    await AssetService(session).update_specific_assets(user_id, {'bitcoin', 'ethereum'}, since=sale_date)
+
+    asset = (await session.exec(select(Asset).where(Asset.user_id == user_id, Asset.token_id == 'bitcoin'))).one()
+    fifo_lots = (await session.exec(select(AssetLot).where(AssetLot.token_id == 'bitcoin', AssetLot.method == 2))).all()
+
+    assert asset.last_trx_date == sale_date
+    assert [(lot.qty, lot.price) for lot in fifo_lots] == [(0.5, 300)]
+    assert (asset.mean_buy_wavg, asset.mean_buy_fifo, asset.mean_buy_lifo) == (200, 300, 100)
+
+
+@pytest.mark.asyncio
+async def test_update_user_assets_writes_wallet_holdings(session):
+    user = User(username='wallets', email='wallets@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    session.add_all(
+        [
+            Token(cg_id='bitcoin', name='Bitcoin', symbol='btc', price=100, rank=1),
+            Token(cg_id='ethereum', name='Ethereum', symbol='eth', price=10, rank=2),
+            Token(cg_id='tether', name='Tether', symbol='usdt', price=1, rank=3),
+        ]
+    )
+    session.add_all([Transaction(user_id=user_id, **trx.model_dump()) for trx in LEDGER[:3]])
+    await session.commit()
+
+    assets = await AssetService(session).update_user_assets(user_id)
+    wallets = await AssetService(session).get_user_wallets(user_id)
+
+    bitcoin = next(asset for asset in assets if asset.token_id == 'bitcoin')
+    assert json.loads(bitcoin.qty_by_wallet) == {'binance': 2 - 0.5 - 1, 'ledger': 1 - 0.001}
+    assert {(w.wallet, w.token_count) for w in wallets} == {('binance', 2), ('ledger', 1)}
+    assert next(w for w in wallets if w.wallet == 'ledger').value == pytest.approx((1 - 0.001) * 100)
+
+
+@pytest.mark.asyncio
+async def test_update_user_assets_query_count_does_not_grow_with_tokens(session):
+    statements = []
+    event.listen(session.bind.sync_engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+    async def count_refresh_queries(username: str, tokens: list[str]) -> int:
+        user = User(username=username, email=f'{username}@mail.com', hashed_password='x')
+        user_id = user.uid
+        session.add(user)
+        session.add_all(
+            [
+                Transaction(user_id=user_id, **make_trx('Achat', token, 1, actif_v_id='tether', price=10, value_a=10).model_dump())
+                for token in tokens
+            ]
+        )  # fmt: skip
+        await session.commit()
+
+        statements.clear()
+        await AssetService(session).update_user_assets(user_id)
+        return len(statements)
+
+    assert await count_refresh_queries('few', ['bitcoin']) == await count_refresh_queries(
+        'many', ['bitcoin', 'ethereum', 'solana', 'cardano', 'polkadot', 'tron']
+    )
+
+
+@pytest.mark.asyncio
+async def test_update_user_assets_upserts_and_removes_stale_assets(session):
+    user = User(username='upsert', email='upsert@mail.com', hashed_password='x')
+    user_id = user.uid
+    swap = Transaction(user_id=user_id, **LEDGER[1].model_dump())
+    session.add(user)
+    session.add_all([Transaction(user_id=user_id, **LEDGER[0].model_dump()), swap])
+    await session.commit()
+
+    first = {asset.token_id: asset.id for asset in await AssetService(session).update_user_assets(user_id)}
+    await session.delete(swap)
+    await session.commit()
+    second = {asset.token_id: asset.id for asset in await AssetService(session).update_user_assets(user_id)}
+
+    assert set(first) == {'bitcoin', 'ethereum', 'fiat_eur'}
+    assert second == {'bitcoin': first['bitcoin'], 'fiat_eur': first['fiat_eur']}
+    stale_wallets = await session.exec(select(AssetWallet).where(AssetWallet.token_id == 'ethereum'))
+    assert stale_wallets.all() == []
+
+
+@pytest.mark.asyncio
+async def test_apply_transaction_changes_matches_full_refresh(session):
+    user = User(username='delta', email='delta@mail.com', hashed_password='x')
+    user_id = user.uid
+    buy = Transaction(user_id=user_id, **make_trx('Achat', 'bitcoin', 2, actif_v_id='tether', price=100, value_a=100).model_dump())
+    session.add(user)
+    session.add(buy)
+    await session.commit()
+    await AssetService(session).update_user_assets(user_id)
+
+    def make_db_trx(*args, date, **kwargs):
+        return Transaction(user_id=user_id, **make_trx(*args, date=date, **kwargs).model_dump())
+
+    # Achat puis vente postérieurs à l'historique : appliqués en delta
+    second_buy = make_db_trx('Achat', 'bitcoin', 1, actif_v_id='tether', price=400, value_a=400, date=datetime(2024, 1, 2))
+    sale = make_db_trx('Vente', 'tether', 50, actif_v_id='bitcoin', price=100, destination='ledger', date=datetime(2024, 1, 3))
+    changes = [(Transaction(**second_buy.model_dump()), 1), (Transaction(**sale.model_dump()), 1)]
+    session.add_all([second_buy, sale])
+    await session.commit()
+    await AssetService(session).apply_transaction_changes(user_id, changes, {'bitcoin'})
+
+    # Suppression de la dernière transaction : retirée des lots
+    await session.delete(await session.get(Transaction, changes[1][0].id))
+    await session.commit()
+    await AssetService(session).apply_transaction_changes(user_id, [(changes[1][0], -1)], {'bitcoin'})
+
+    statement = (
+        select(Asset)
+        .where(Asset.user_id == user_id, Asset.token_id == 'bitcoin')
+        .options(selectinload(Asset.wallets))  # type: ignore
+    )
+    delta = (await session.exec(statement.execution_options(populate_existing=True))).one()
+    delta_state = (delta.qty, delta.qty_by_wallet, delta.mean_buy_wavg, delta.mean_buy_fifo, delta.mean_buy_lifo)
+    await AssetService(session).update_user_assets(user_id)
+    full = (await session.exec(statement.execution_options(populate_existing=True))).one()
+
+    assert delta_state == (full.qty, full.qty_by_wallet, full.mean_buy_wavg, full.mean_buy_fifo, full.mean_buy_lifo)
+    assert delta_state[:3] == (3, json.dumps({'binance': 3.0}), 200)
+
+
+@pytest.mark.asyncio
+async def test_user_assets_snapshot_is_cached_until_a_version_changes(session):
+    user = User(username='snapshot', email='snapshot@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    session.add(Token(cg_id='bitcoin', name='Bitcoin', symbol='btc', price=100, rank=1))
+    session.add(Transaction(user_id=user_id, **make_trx('Airdrop', 'bitcoin', 2, value_a=50).model_dump()))
+    await session.commit()
+    await AssetService(session).update_user_assets(user_id)
+
+    async def snapshot():
+        current_user = await session.get(User, user_id, populate_existing=True)
+        return json.loads(await AssetService(session).get_user_assets_snapshot(current_user))
+
+    assert [asset['value'] for asset in await snapshot()] == [200]
+
+    # Prix modifié sans nouvelle version : le snapshot en cache est servi
+    bitcoin = await session.get(Token, 'bitcoin')
+    bitcoin.price = 300
+    await session.commit()
+    assert [asset['value'] for asset in await snapshot()] == [200]
+
+    await bump_version(session, TOKEN_PRICES)
+    await session.commit()
+    assert [asset['value'] for asset in await snapshot()] == [600]
+
+    # Reconstruction complète sans changement de version : le snapshot est recalculé
+    session.add(Transaction(user_id=user_id, **make_trx('Airdrop', 'bitcoin', 1, value_a=50).model_dump()))
+    await session.commit()
+    await AssetService(session).update_user_assets(user_id)
+    assert [asset['value'] for asset in await snapshot()] == [900]
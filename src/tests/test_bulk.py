@@ -0,0 +1,171 @@
+import json
+from datetime import datetime
+
+import pytest
+from fastapi import HTTPException
+from sqlmodel import select
+from src.db.models import Token, Transaction, User
+from src.services import transaction as transaction_service
+from src.services.transaction import TransactionService
+from src.schemes.transaction import TransactionCreate
+from src.utils.bulk import get_content_hash, iter_lines, parse_transaction_lines
+from src.utils.queue import asset_queue
+
+CSV_EXPORT = (
+    'date,type,qty_a,actif_a_id,price,qty_v,actif_v_id,destination,qty_f,actif_f_id,origin,value_f,value_a,id\r\n'
+    '26-10-23 17:40:00,Depot,2500.69,fiat_eur,,,,Trade Republic,,,,,1.052,1\r\n'
+    '26-10-23 17:41:00,Achat,0.076583,bitcoin,32640.27,2499.69,fiat_eur,Trade Republic,1.0,fiat_eur,,,34337.57,2\r\n'
+)
+
+
+async def stream(content: str, chunk_size: int = 7):
+    data = content.encode()
+    for start in range(0, len(data), chunk_size):
+        yield data[start : start + chunk_size]
+
+
+async def parse(content: str, fmt: str):
+    return [row async for row in parse_transaction_lines(iter_lines(stream(content)), fmt)]
+
+
+@pytest.mark.asyncio
+async def test_parse_transaction_lines_reads_spreadsheet_csv():
+    rows = await parse(CSV_EXPORT, 'csv')
+
+    assert [(line, error) for line, _, error in rows] == [(2, None), (3, None)]
+    assert rows[1][1].date == datetime(2023, 10, 26, 17, 41)
+    assert (rows[1][1].actif_v_id, rows[1][1].origin) == ('fiat_eur', None)
+
+
+@pytest.mark.asyncio
+async def test_parse_transaction_lines_keeps_quoted_newlines_in_one_record():
+    content = (
+        'date,type,qty_a,actif_a_id,destination\r\n'
+        '2024-01-01 10:00:00,Airdrop,1,bitcoin,"Ledger\r\nNano"\r\n'
+        '\r\n'
+        '2024-01-02 10:00:00,Airdrop,"2",bitcoin,"Cold ""wallet"""\r\n'
+    )
+
+    rows = await parse(content, 'csv')
+
+    assert [(line, error) for line, _, error in rows] == [(2, None), (5, None)]
+    assert rows[0][1].destination == 'Ledger\nNano'
+    assert (rows[1][1].qty_a, rows[1][1].destination) == (2, 'Cold "wallet"')
+
+
+@pytest.mark.asyncio
+async def test_parse_transaction_lines_reads_ndjson_and_reports_invalid_lines():
+    content = (
+        '{"date": "2024-01-01T10:00:00", "type": "Airdrop", "qty_a": 1, "actif_a_id": "bitcoin", "destination": "w"}\n'
+        '\n'
+        '{"date": "2024-01-02T10:00:00", "type": "Airdrop", "actif_a_id": "bitcoin", "destination": "w"}\n'
+    )
+
+    rows = await parse(content, 'ndjson')
+
+    assert rows[0][1].date == datetime(2024, 1, 1, 10)
+    assert rows[1][0] == 3 and rows[1][1] is None and 'qty_a' in rows[1][2]
+
+
+@pytest.mark.asyncio
+async def test_bulk_create_transactions_inserts_all_and_recomputes_once(session, monkeypatch):
+    user = User(username='bulk', email='bulk@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    session.add_all(
+        [
+            Token(cg_id='bitcoin', name='Bitcoin', symbol='btc', price=1),
+            Token(cg_id='fiat_eur', name='Euro', symbol='eur', price=1),
+        ]
+    )
+    await session.commit()
+
+    enqueued = []
+    monkeypatch.setattr(asset_queue, 'enqueue', lambda *args: enqueued.append(args))
+    monkeypatch.setattr(session.sync_session, 'expire_on_commit', False)  # Comme les sessions de l'API
+
+    user = await session.get(User, user_id)
+    response = await TransactionService(session).bulk_create_transactions(iter_lines(stream(CSV_EXPORT)), 'csv', user)
+
+    transactions = (await session.exec(select(Transaction).where(Transaction.user_id == user_id))).all()
+    assert response.status_code == 201
+    assert response.headers['X-Ledger-Version'] == '1'
+    assert len(transactions) == 2
+    assert len(enqueued) == 1 and len(enqueued[0][1]) == 2
+
+    # Export ré-importé : tout est ignoré, sans nouvelle version ni recalcul
+    response = await TransactionService(session).bulk_create_transactions(iter_lines(stream(CSV_EXPORT)), 'csv', user)
+
+    assert response.status_code == 200
+    assert json.loads(response.body) == {'detail': 'Transactions imported successfully.', 'count': 0, 'skipped': 2}
+    assert response.headers['X-Ledger-Version'] == '1'
+    assert len(enqueued) == 1
+
+
+
+@pytest.mark.asyncio
+async def test_bulk_create_transactions_keeps_in_file_duplicates_across_batches(session, monkeypatch):
+    user = User(username='bulk_dup', email='bulk_dup@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    session.add(Token(cg_id='bitcoin', name='Bitcoin', symbol='btc', price=1))
+    await session.commit()
+    monkeypatch.setattr(asset_queue, 'enqueue', lambda *args: None)
+    monkeypatch.setattr(session.sync_session, 'expire_on_commit', False)
+    monkeypatch.setattr(transaction_service, 'BULK_INSERT_BATCH_SIZE', 1)  # Chaque copie dans son propre lot
+
+    line = '{"date": "2024-01-01T10:00:00", "type": "Airdrop", "qty_a": 1, "actif_a_id": "bitcoin", "destination": "w"}\n'
+    user = await session.get(User, user_id)
+    response = await TransactionService(session).bulk_create_transactions(iter_lines(stream(line * 2)), 'ndjson', user)
+
+    transactions = (await session.exec(select(Transaction).where(Transaction.user_id == user_id))).all()
+    assert json.loads(response.body)['count'] == 2
+    assert len(transactions) == 2
+
+@pytest.mark.asyncio
+async def test_bulk_create_transactions_rejects_unknown_tokens(session, monkeypatch):
+    user = User(username='bulk_unknown', email='bulk_unknown@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    await session.commit()
+    monkeypatch.setattr(asset_queue, 'enqueue', lambda *args: None)
+
+    user = await session.get(User, user_id)
+    with pytest.raises(HTTPException) as err:
+        await TransactionService(session).bulk_create_transactions(iter_lines(stream(CSV_EXPORT)), 'csv', user)
+
+    assert err.value.status_code == 422
+    assert err.value.detail == ['Tokens inconnus : bitcoin, fiat_eur']
+    assert (await session.exec(select(Transaction).where(Transaction.user_id == user_id))).all() == []
+
+
+def test_content_hash_ignores_valuations_and_normalizes_values():
+    date = datetime(2024, 1, 1)
+    trx = TransactionCreate(date=date, type='Achat', qty_a=1, price=0.3, destination='Binance', value_a=10)
+    same = TransactionCreate(date=date, type='Achat', qty_a=1.0, price=0.1 + 0.2, destination=' binance')
+    other = TransactionCreate(date=date, type='Achat', qty_a=2, price=0.3, destination='Binance')
+
+    assert get_content_hash(trx) == get_content_hash(same)
+    assert get_content_hash(trx) != get_content_hash(other)
+
+
+@pytest.mark.asyncio
+async def test_create_transactions_returns_existing_duplicate(session, monkeypatch):
+    user = User(username='duplicate', email='duplicate@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    await session.commit()
+    monkeypatch.setattr(asset_queue, 'enqueue', lambda *args: None)
+    monkeypatch.setattr(session.sync_session, 'expire_on_commit', False)
+
+    user = await session.get(User, user_id)
+    trx_data = TransactionCreate(
+        date=datetime(2024, 1, 1), type='Airdrop', qty_a=1, actif_a_id='bitcoin', destination='w'
+    )
+    first = await TransactionService(session).create_transactions(trx_data, user)
+    service = TransactionService(session)
+    second = await service.create_transactions(trx_data, user)
+
+    assert service.duplicate
+    assert second.id == first.id
+    assert len((await session.exec(select(Transaction).where(Transaction.user_id == user_id))).all()) == 1
@@ -0,0 +1,36 @@
+import uuid
+
+import pytest
+from src.utils.cache import SnapshotCache, bump_version, get_version
+
+
+def test_snapshot_cache_ignores_entries_with_another_key():
+    cache = SnapshotCache()
+    user_id = uuid.uuid4()
+    cache.set(user_id, (1, 1), b'[]')
+
+    assert cache.get(user_id, (1, 1)) == b'[]'
+    assert cache.get(user_id, (2, 1)) is None
+
+
+def test_snapshot_cache_evicts_least_recently_used_user():
+    cache = SnapshotCache(maxsize=2)
+    first, second, third = uuid.uuid4(), uuid.uuid4(), uuid.uuid4()
+    cache.set(first, (0,), b'1')
+    cache.set(second, (0,), b'2')
+    cache.get(first, (0,))
+    cache.set(third, (0,), b'3')
+
+    assert cache.get(second, (0,)) is None
+    assert cache.get(first, (0,)) == b'1'
+    assert cache.get(third, (0,)) == b'3'
+
+
+@pytest.mark.asyncio
+async def test_bump_version_creates_then_increments(session):
+    assert await get_version(session, 'prices') == 0
+    await bump_version(session, 'prices')
+    await bump_version(session, 'prices')
+    await session.commit()
+
+    assert await get_version(session, 'prices') == 2
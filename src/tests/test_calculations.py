@@ -0,0 +1,161 @@
+from datetime import date, datetime
+
+import pandas as pd
+import pytest
+from sqlmodel import select
+from src.db.models import Asset, CashInCheckpoint, FiatHistory, Token, Transaction, User, UserPfHistory
+from src.schemes.transaction import TransactionCreate
+from src.utils import calculations
+from src.utils.calculations import get_cash_in, value_transactions
+from src.utils.fx import fx_table
+
+
+def make_trx(date, type, qty_a, price, actif_v_id='fiat_usd'):
+    return {
+        'date': date,
+        'type': type,
+        'qty_a': qty_a,
+        'price': price,
+        'destination': 'wallet',
+        'origin': None,
+        'qty_f': None,
+        'value_f': None,
+        'value_a': None,
+        'actif_a_id': 'bitcoin',
+        'actif_v_id': actif_v_id,
+        'actif_f_id': None,
+    }
+
+
+@pytest.fixture(autouse=True)
+def fx_rates(monkeypatch):
+    monkeypatch.setattr(fx_table, 'dates', {'fiat_eur': [date(2023, 12, 1)]})
+    monkeypatch.setattr(fx_table, 'closes', {'fiat_eur': [2.0]})
+    monkeypatch.setattr(fx_table, 'loaded_at', datetime.now())
+
+
+@pytest.mark.asyncio
+async def test_get_cash_in_all_fiats_in_one_pass():
+    transactions = [
+        make_trx(datetime(2024, 1, 1, 10), 'Achat', 1, 100),
+        make_trx(datetime(2024, 1, 2, 10), 'Swap', 1, 50),
+        make_trx(datetime(2024, 1, 3, 10), 'Vente', 1, 50),
+    ]
+    df_pf = pd.DataFrame(
+        {'total_fiat_usd': [100.0, 150.0, 100.0], 'total_fiat_eur': [50.0, 75.0, 50.0]},
+        index=pd.date_range('2024-01-01', periods=3),
+    )
+
+    df_cash_in = await get_cash_in(transactions, df_pf, fiats=['fiat_usd', 'fiat_eur'])
+
+    assert list(df_cash_in.columns) == ['date', 'cash_in_fiat_usd', 'cash_in_fiat_eur']
+    assert list(df_cash_in['cash_in_fiat_usd']) == [100, 100 * (1 - 50 / 150)]
+    assert list(df_cash_in['cash_in_fiat_eur']) == [50, 50 * (1 - 25 / 75)]
+
+
+@pytest.mark.asyncio
+async def test_get_cash_in_same_day_uses_portfolio_before_transaction():
+    transactions = [
+        make_trx(datetime(2024, 1, 1, 9), 'Achat', 1, 100),
+        make_trx(datetime(2024, 1, 1, 12), 'Vente', 1, 40),
+        make_trx(datetime(2024, 1, 1, 18), 'Achat', 1, 20),
+    ]
+    df_pf = pd.DataFrame({'total_fiat_usd': [80.0]}, index=pd.date_range('2024-01-01', periods=1))
+
+    df_cash_in = await get_cash_in(transactions, df_pf, fiats=['fiat_usd'])
+
+    # Valeur avant la vente : 80 - (20 - 40) = 100
+    assert list(df_cash_in['cash_in_fiat_usd']) == [100, 100 * (1 - 40 / 100), 100 * (1 - 40 / 100) + 20]
+
+
+@pytest.mark.asyncio
+async def test_get_cash_in_without_cash_flows_is_empty():
+    transactions = [make_trx(datetime(2024, 1, 1), 'Achat', 1, 100, actif_v_id='tether')]
+    df_pf = pd.DataFrame({'total_fiat_usd': [100.0]}, index=pd.date_range('2024-01-01', periods=1))
+
+    df_cash_in = await get_cash_in(transactions, df_pf, fiats=['fiat_usd'])
+
+    assert df_cash_in.empty
+    assert list(df_cash_in.columns) == ['date', 'cash_in_fiat_usd']
+
+
+@pytest.mark.asyncio
+async def test_value_transactions_values_every_fiat_from_fx_table():
+    transactions = [
+        TransactionCreate.model_validate(make_trx(datetime(2024, 1, 1), 'Achat', 2, 100)),
+        TransactionCreate.model_validate(make_trx(datetime(2024, 1, 2), 'Vente', 1, 30)),
+    ]
+
+    values = await value_transactions(transactions, ['fiat_usd', 'fiat_eur'])
+
+    assert values == {'fiat_usd': [200, 30], 'fiat_eur': [100, 15]}
+
+
+@pytest.mark.asyncio
+async def test_value_transactions_reloads_the_shared_fx_table_once(session, monkeypatch):
+    # Dernière clôture connue bien avant la transaction
+    session.add(FiatHistory(id='eur-1', cg_id='fiat_eur', date=datetime(2023, 9, 1), open=4, high=4, low=4, close=4.0))
+    await session.commit()
+    monkeypatch.setattr(fx_table, 'loaded_at', None)
+
+    sessions = []
+
+    async def get_session():
+        sessions.append(session)
+        yield session
+
+    monkeypatch.setattr(calculations, 'get_session', get_session)
+    trx = TransactionCreate.model_validate(make_trx(datetime(2024, 1, 1), 'Achat', 2, 100))
+
+    first = await value_transactions([trx], ['fiat_eur'])
+    second = await value_transactions([trx], ['fiat_eur'])
+
+    assert first == second == {'fiat_eur': [50]}
+    assert len(sessions) == 1
+    assert fx_table.fresh
+
+
+@pytest.mark.asyncio
+async def test_get_current_total_pnls_updates_every_fiat_from_one_ledger_load(session, monkeypatch):
+    user = User(username='pnls', email='pnls@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    session.add_all(
+        [
+            Token(cg_id='bitcoin', name='Bitcoin', symbol='btc', price=100, rank=1),
+            Token(cg_id='fiat_usd', name='Dollar', symbol='usd', price=1, rank=2),
+            Token(cg_id='fiat_eur', name='Euro', symbol='eur', price=2, rank=3),
+            Asset(token_id='bitcoin', user_id=user_id, qty=2),
+        ]
+    )
+    for day, price in ((1, 100), (2, 50)):
+        session.add(Transaction(user_id=user_id, **make_trx(datetime(2024, 1, day, 10), 'Achat', 1, price)))
+        values = {f'{prefix}{fiat}': 100.0 * day for prefix in ('value_in_', 'cash_in_') for fiat in ('usd', 'cad')}
+        values |= {'value_in_chf': 100.0 * day, 'cash_in_chf': 100.0 * day}
+        values |= {'value_in_eur': 50.0 * day, 'cash_in_eur': 50.0 * day}
+        values |= {f'pnl_percent_fiat_{fiat}': 0.0 for fiat in ('usd', 'eur', 'cad', 'chf')}
+        session.add(UserPfHistory(user_id=user_id, date=datetime(2024, 1, day), **values))
+    # Le dollar a déjà un état au 1er janvier, l'euro repart du début
+    session.add(CashInCheckpoint(user_id=user_id, fiat='fiat_usd', date=datetime(2024, 1, 1), cash_in=100))
+    await session.commit()
+
+    sessions = []
+
+    async def get_session():
+        sessions.append(session)
+        yield session
+
+    monkeypatch.setattr(calculations, 'get_session', get_session)
+
+    await calculations.get_current_total_pnls(user_id, ['fiat_usd', 'fiat_eur'])
+
+    user = await session.get(User, user_id, populate_existing=True)
+    checkpoints = (await session.exec(select(CashInCheckpoint.fiat, CashInCheckpoint.date))).all()
+    assert (user.cash_in_usd, user.cash_in_eur) == (150, 75)
+    assert sorted(checkpoints) == [
+        ('fiat_eur', datetime(2024, 1, 1)),
+        ('fiat_eur', datetime(2024, 1, 2)),
+        ('fiat_usd', datetime(2024, 1, 1)),
+        ('fiat_usd', datetime(2024, 1, 2)),
+    ]
+    assert len(sessions) == 2  # Un chargement, une écriture
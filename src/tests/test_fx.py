@@ -0,0 +1,51 @@
+from datetime import date, datetime
+
+import pytest
+from src.utils.fx import FxRateTable, convert_usd_totals
+
+
+@pytest.fixture(name='table')
+def table_fixture():
+    table = FxRateTable()
+    table.dates = {'fiat_eur': [date(2024, 1, 1), date(2024, 1, 2), date(2024, 1, 5)]}
+    table.closes = {'fiat_eur': [1.10, 1.20, 1.30]}
+    table.loaded_at = datetime.now()
+    return table
+
+
+def test_get_price_uses_last_close_strictly_before_date(table: FxRateTable):
+    assert table.get_price('fiat_eur', datetime(2024, 1, 2, 15, 30)) == 1.10
+    assert table.get_price('fiat_eur', date(2024, 1, 3)) == 1.20
+    assert table.get_price('fiat_eur', datetime(2024, 1, 5)) == 1.20
+    assert table.get_price('fiat_eur', datetime(2024, 2, 1)) == 1.30
+
+
+def test_get_price_usd_is_always_one(table: FxRateTable):
+    assert table.get_price('fiat_usd', datetime(1990, 1, 1)) == 1
+
+
+def test_get_price_without_previous_close_raises(table: FxRateTable):
+    with pytest.raises(LookupError):
+        table.get_price('fiat_eur', datetime(2024, 1, 1))
+
+    with pytest.raises(LookupError):
+        table.get_price('fiat_chf', datetime(2024, 1, 10))
+
+
+def test_invalidate_marks_table_as_stale(table: FxRateTable):
+    assert table.fresh
+    table.invalidate()
+    assert not table.fresh
+
+
+def test_convert_usd_totals_uses_last_close_on_or_before_date():
+    dates = [datetime(2024, 1, 1), datetime(2024, 1, 2), datetime(2024, 1, 3), datetime(2024, 1, 4), datetime(2024, 1, 6)]
+    totals = [100.0, 100.0, 0.0, 100.0, 100.0]
+    fx_dates = [datetime(2024, 1, 2), datetime(2024, 1, 4), datetime(2024, 1, 5)]
+    fx_closes = [2.0, 4.0, 0.0]
+
+    converted = convert_usd_totals(dates, totals, fx_dates, fx_closes)
+
+    # Pas de cours avant le 2, total nul le 3, cours nul le 5
+    assert list(converted) == [0.0, 50.0, 0.0, 25.0, 0.0]
+    assert list(convert_usd_totals(dates[:2], totals[:2], [], [])) == [0.0, 0.0]
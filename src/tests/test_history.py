@@ -0,0 +1,133 @@
+import uuid
+from datetime import datetime, timedelta
+from io import StringIO
+
+import pandas as pd
+import pytest
+from sqlmodel import select
+from src.db.models import Token, Transaction, User, UserPfHistory
+from src.schemes.history import UserHistoryBase
+from src.services import history
+from src.services.history import HistoryService
+from src.utils.calculations import mark_history_dirty
+
+BTC_PRICE = 10.0
+
+
+@pytest.fixture
+def history_task(monkeypatch):
+    """Remplace la tâche celery : chaque jour terminé vaut quantité de btc x BTC_PRICE."""
+    calls = []
+
+    class FakeTask:
+        def delay(self, df_qty_json, tv_list_data, transactions):
+            df_qty = pd.read_json(StringIO(df_qty_json), orient='split')
+            calls.append(df_qty)
+            self.result = {
+                'result': [
+                    {'index': date.to_pydatetime(), 'total_fiat_usd': float(df_qty.loc[date].sum()) * BTC_PRICE}
+                    for date in df_qty.index[:-1]
+                ],
+                'ignored_tokens': [],
+            }
+            return type('AsyncResult', (), {'id': 'task'})()
+
+    task = FakeTask()
+
+    async def wait_for_celery_result(task_id, timeout, poll_interval):
+        return task.result
+
+    monkeypatch.setattr(history, 'compute_pf_history_task', task)
+    monkeypatch.setattr(history, 'wait_for_celery_result', wait_for_celery_result)
+    return calls
+
+
+@pytest.mark.asyncio
+async def test_calculate_histo_pf_only_recomputes_from_the_dirty_date(session, history_task, monkeypatch):
+    monkeypatch.setattr(session.sync_session, 'expire_on_commit', False)
+    today = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+    user = User(username='histo', email='histo@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    session.add(Token(cg_id='bitcoin', name='Bitcoin', symbol='btc', price=1))
+    session.add(
+        Transaction(user_id=user_id, date=today - timedelta(days=5), type='Airdrop', qty_a=1, actif_a_id='bitcoin', destination='w')
+    )
+    await session.commit()
+
+    service = HistoryService(session)
+    await service.calculate_histo_pf(user_id, [])
+
+    # Transaction ajoutée il y a 3 jours : seuls ces jours sont recalculés
+    trx_date = today - timedelta(days=3)
+    session.add(Transaction(user_id=user_id, date=trx_date, type='Airdrop', qty_a=1, actif_a_id='bitcoin', destination='w'))
+    await mark_history_dirty(session, user_id, trx_date)
+    await session.commit()
+    response = await service.calculate_histo_pf(user_id, [])
+
+    rows = (
+        await session.exec(select(UserPfHistory).where(UserPfHistory.user_id == user_id).order_by(UserPfHistory.date))
+    ).all()
+    user = await session.get(User, user_id, populate_existing=True)
+    assert [df.index[0] for df in history_task] == [today - timedelta(days=5), trx_date]
+    assert [row.value_in_usd for row in rows] == [10.0, 10.0, 20.0, 20.0, 20.0]
+    assert user.history_dirty_date is None and user.history_init
+    # La réponse contient tout l'historique, pas seulement les jours recalculés
+    assert [row['total_fiat_usd'] for row in response['data']] == [10.0, 10.0, 20.0, 20.0, 20.0]
+    assert response['data'][0]['index'] == today - timedelta(days=5)
+
+    # Reconstruction complète sur demande
+    await service.calculate_histo_pf(user_id, [], full=True)
+    rows = (await session.exec(select(UserPfHistory).where(UserPfHistory.user_id == user_id))).all()
+    assert history_task[-1].index[0] == today - timedelta(days=5)
+    assert sorted(row.value_in_usd for row in rows) == [10.0, 10.0, 20.0, 20.0, 20.0]
+
+
+
+@pytest.mark.asyncio
+async def test_calculate_histo_pf_without_a_finished_day_empties_the_history(session, history_task, monkeypatch):
+    monkeypatch.setattr(session.sync_session, 'expire_on_commit', False)
+    today = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
+    user = User(username='histo_today', email='histo_today@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    session.add(Token(cg_id='bitcoin', name='Bitcoin', symbol='btc', price=1))
+    old_trx = Transaction(user_id=user_id, date=today - timedelta(days=2), type='Airdrop', qty_a=1, actif_a_id='bitcoin', destination='w')
+    session.add(old_trx)
+    await session.commit()
+
+    service = HistoryService(session)
+    await service.calculate_histo_pf(user_id, [])
+
+    # Il ne reste que des transactions du jour : plus aucune journée terminée à valoriser
+    await session.delete(old_trx)
+    session.add(Transaction(user_id=user_id, date=today, type='Airdrop', qty_a=1, actif_a_id='bitcoin', destination='w'))
+    await mark_history_dirty(session, user_id, today - timedelta(days=2))
+    await session.commit()
+
+    assert await service.calculate_histo_pf(user_id, []) == {'data': []}
+    rows = (await session.exec(select(UserPfHistory).where(UserPfHistory.user_id == user_id))).all()
+    user = await session.get(User, user_id, populate_existing=True)
+    assert rows == []
+    assert user.history_dirty_date is None
+
+
+def test_history_rows_follow_the_model_columns():
+    dates = pd.date_range('2024-01-01', periods=2, freq='D')
+    df_result = pd.DataFrame(
+        {
+            f'{prefix}{fiat}': [1.0, 2.0]
+            for fiat in ('fiat_usd', 'fiat_eur', 'fiat_cad', 'fiat_chf', 'fiat_gbp')
+            for prefix in ('total_', 'cash_in_', 'pnl_percent_')
+        },
+        index=dates,
+    )
+
+    # Fiat sans colonne dans le modèle : ignorée
+    rows = HistoryService.history_rows(uuid.uuid4(), df_result)
+    assert set(rows[0]) == {'id', 'user_id', 'date'} | set(UserHistoryBase.model_fields) - {'date'}
+    assert rows[1]['cash_in_chf'] == 2.0
+
+    # Colonne du modèle sans valeur calculée : erreur explicite
+    with pytest.raises(ValueError, match='cash_in_fiat_cad'):
+        HistoryService.history_rows(uuid.uuid4(), df_result.drop(columns='cash_in_fiat_cad'))
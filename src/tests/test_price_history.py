@@ -0,0 +1,107 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+
+import pandas as pd
+import pytest
+from src.celery import histo
+from src.utils import price_history
+from src.utils.price_history import PRICE_HISTORY_BARS, bars_since, get_price_history
+from src.utils.ratelimit import TokenBucket
+
+
+def make_bars(start: str, closes: list[float]):
+    index = pd.date_range(start, periods=len(closes), freq='D', name='datetime')
+    return pd.DataFrame(
+        {'symbol': 'MEXC:BTCUSDT', 'open': closes, 'high': closes, 'low': closes, 'close': closes, 'volume': 1.0},
+        index=index,
+    )
+
+
+@pytest.fixture(autouse=True)
+def store_session(session, monkeypatch):
+    @asynccontextmanager
+    async def session_factory():
+        yield session
+
+    monkeypatch.setattr(price_history, 'get_session_with_context_manager', session_factory)
+
+
+@pytest.mark.asyncio
+async def test_get_price_history_only_fetches_the_missing_tail():
+    calls = []
+
+    def fetch(last_date):
+        calls.append(last_date)
+        if last_date is None:
+            return make_bars('2024-01-01', [1.0, 2.0, 3.0])
+        # La dernière barre stockée est renvoyée avec sa valeur définitive
+        return make_bars('2024-01-02', [2.0, 3.5, 4.0])
+
+    first = await get_price_history('BTCUSDT', 'MEXC', '1D', fetch)
+    second = await get_price_history('BTCUSDT', 'MEXC', '1D', fetch)
+
+    assert calls == [None, datetime(2024, 1, 3)]
+    assert list(first['close']) == [1.0, 2.0, 3.0]
+    assert list(second['close']) == [1.0, 2.0, 3.5, 4.0]
+    assert second.index.name == 'datetime'
+
+
+@pytest.mark.asyncio
+async def test_get_price_history_keeps_stored_bars_when_the_download_fails():
+    await get_price_history('ETHUSDT', 'MEXC', '1D', lambda last_date: make_bars('2024-01-01', [10.0, 11.0]))
+
+    def failing_fetch(last_date):
+        raise ConnectionError('offline')
+
+    history = await get_price_history('ETHUSDT', 'MEXC', '1D', failing_fetch)
+
+    assert list(history['close']) == [10.0, 11.0]
+    assert await get_price_history('ETHUSDT', 'MEXC', '1H', lambda last_date: None) is None
+
+
+def test_bars_since():
+    assert bars_since(None, '1D') == PRICE_HISTORY_BARS
+    assert bars_since(datetime.now() - timedelta(days=3, hours=1), '1D') == 5
+    assert bars_since(datetime(1990, 1, 1), '1D') == PRICE_HISTORY_BARS
+
+
+def test_token_bucket_limits_the_request_rate():
+    bucket = TokenBucket(rate=50)
+
+    start = time.monotonic()
+    for _ in range(5):
+        bucket.acquire()
+
+    assert time.monotonic() - start >= 4 / 50 * 0.9
+
+
+@pytest.mark.asyncio
+async def test_compute_pf_history_fetches_in_parallel_and_keeps_ignored_order(monkeypatch):
+    tokens = ['solana', 'bitcoin', 'cardano', 'ethereum', 'polkadot']
+    dates = pd.date_range('2024-01-01', periods=4, freq='D')
+    df_qty = pd.DataFrame({token: [1.0] * 4 for token in tokens}, index=dates)
+    tv_list = [{'cg_id': token, 'ticker': token.upper(), 'exchange': 'MEXC'} for token in tokens]
+    running, peak = 0, 0
+
+    async def fake_history(ticker, exchange):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01 if ticker == 'SOLANA' else 0.02)  # Le premier token arrive en premier
+        running -= 1
+        if ticker == 'POLKADOT':
+            raise ConnectionError('TradingView unavailable')
+        if ticker in ('SOLANA', 'CARDANO'):
+            return None
+        return make_bars('2024-01-01', [1.0, 2.0, 3.0, 4.0])
+
+    monkeypatch.setattr(histo, 'get_stored_history_ohlc', fake_history)
+    monkeypatch.setattr(histo.settings, 'HISTORY_FETCH_CONCURRENCY', 2)
+
+    result = await histo.compute_pf_history(df_qty.to_json(orient='split'), tv_list, [])
+
+    assert result['ignored_tokens'] == ['solana', 'cardano', 'polkadot']
+    assert peak == 2
+    assert [row['total_fiat_usd'] for row in result['result']] == [2.0, 4.0, 6.0]
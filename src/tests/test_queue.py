@@ -0,0 +1,127 @@
+import asyncio
+import uuid
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+import pytest
+from sqlmodel import select
+from src.db.models import Asset, Transaction, User
+from src.utils.cache import bump_ledger_version
+from src.utils.queue import AssetRecomputeQueue, PnlScheduler
+
+
+@pytest.mark.asyncio
+async def test_asset_queue_coalesces_a_burst_into_one_recompute(session):
+    user = User(username='queue', email='queue@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    await session.commit()
+
+    @asynccontextmanager
+    async def session_factory():
+        yield session
+
+    queue = AssetRecomputeQueue(session_factory=session_factory)
+    recomputes, pnl_runs = [], []
+    recompute = queue.recompute
+
+    async def counted_recompute(user_id, job):
+        recomputes.append(len(job.changes))
+        await recompute(user_id, job)
+
+    queue.recompute = counted_recompute
+    queue.schedule_pnl = lambda user_id, fiat: pnl_runs.append(fiat)
+
+    writes = []
+    for day in (1, 2, 3):
+        trx = Transaction(user_id=user_id, date=datetime(2024, 1, day), type='Airdrop', qty_a=1, actif_a_id='bitcoin', destination='w')
+        session.add(Transaction(**trx.model_dump()))
+        writes.append((trx, await bump_ledger_version(session, user_id)))
+    await session.commit()
+
+    # Rafale reçue avant que la tâche de fond ne reprenne la main
+    for trx, version in writes:
+        queue.enqueue(user_id, [(trx, 1)], {'bitcoin'}, version, 'fiat_eur')
+
+    assert await queue.wait_for_version(user_id, 3, timeout=5)
+    await queue.stop()
+
+    asset = (await session.exec(select(Asset).where(Asset.user_id == user_id))).one()
+    user = await session.get(User, user_id, populate_existing=True)
+    assert recomputes == [3]
+    assert pnl_runs == ['fiat_eur']
+    assert asset.qty == 3
+    assert (user.ledger_version, user.assets_version) == (3, 3)
+
+
+@pytest.mark.asyncio
+async def test_asset_queue_waits_for_earlier_versions(session):
+    user = User(username='queue_order', email='queue_order@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    await session.commit()
+
+    @asynccontextmanager
+    async def session_factory():
+        yield session
+
+    queue = AssetRecomputeQueue(session_factory=session_factory)
+    queue.schedule_pnl = lambda user_id, fiat: None
+
+    writes = []
+    for day in (1, 2):
+        trx = Transaction(user_id=user_id, date=datetime(2024, 1, day), type='Airdrop', qty_a=1, actif_a_id='bitcoin', destination='w')
+        session.add(Transaction(**trx.model_dump()))
+        writes.append((trx, await bump_ledger_version(session, user_id)))
+    await session.commit()
+
+    # La version 2 arrive avant la version 1 : elle est appliquée mais pas encore déclarée reflétée
+    (first, v1), (second, v2) = writes
+    queue.enqueue(user_id, [(second, 1)], {'bitcoin'}, v2, 'fiat_eur')
+    assert not await queue.wait_for_version(user_id, v2, timeout=0.2)
+    user = await session.get(User, user_id, populate_existing=True)
+    assert user.assets_version == 0
+
+    queue.enqueue(user_id, [(first, 1)], {'bitcoin'}, v1, 'fiat_eur')
+    assert await queue.wait_for_version(user_id, v2, timeout=5)
+
+    # Modification d'une version déjà reflétée : ignorée
+    queue.enqueue(user_id, [(first, 1)], {'bitcoin'}, v1, 'fiat_eur')
+    await queue.stop()
+
+    asset = (await session.exec(select(Asset).where(Asset.user_id == user_id))).one()
+    user = await session.get(User, user_id, populate_existing=True)
+    assert asset.qty == 2
+    assert user.assets_version == 2
+
+
+@pytest.mark.asyncio
+async def test_pnl_scheduler_debounces_and_merges_fiats():
+    scheduler = PnlScheduler(quiet_window=0.05)
+    user_id = uuid.uuid4()
+    runs = []
+    release = asyncio.Event()
+
+    async def dispatch(user_id, fiats):
+        runs.append(sorted(fiats))
+        await release.wait()
+
+    scheduler.dispatch = dispatch
+
+    # Rafale : un seul calcul, pour tous les fiats demandés
+    for fiat in ('fiat_usd', 'fiat_eur', 'fiat_usd'):
+        scheduler.schedule(user_id, {fiat})
+        await asyncio.sleep(0.01)
+    await asyncio.sleep(0.1)
+    assert runs == [['fiat_eur', 'fiat_usd']]
+
+    # Pendant le calcul, les nouvelles demandes forment un seul calcul en attente
+    for fiat in ('fiat_usd', 'fiat_chf'):
+        scheduler.schedule(user_id, {fiat})
+    await asyncio.sleep(0.1)
+    assert len(runs) == 1
+
+    release.set()
+    await asyncio.sleep(0.1)
+    assert runs == [['fiat_eur', 'fiat_usd'], ['fiat_chf', 'fiat_usd']]
+    assert scheduler.workers == {}
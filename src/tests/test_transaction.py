@@ -0,0 +1,148 @@
+from datetime import datetime
+
+import pytest
+import pytest_asyncio
+from fastapi import HTTPException
+from sqlmodel import select
+from src.db.models import Token, Transaction, User
+from src.schemes.transaction import TransactionBatch
+from src.services.transaction import TransactionService
+from src.utils.queue import asset_queue
+
+
+@pytest_asyncio.fixture(name='ledger')
+async def ledger_fixture(session):
+    user = User(username='pages', email='pages@mail.com', hashed_password='x')
+    user_id = user.uid
+    session.add(user)
+    session.add_all(
+        [
+            Token(cg_id='bitcoin', name='Bitcoin', symbol='btc', price=1),
+            Token(cg_id='ethereum', name='Ethereum', symbol='eth', price=1),
+        ]
+    )
+    days = [1, 2, 2, 3, 4]  # Deux transactions le même jour : départagées par id
+    session.add_all(
+        [
+            Transaction(
+                user_id=user_id,
+                date=datetime(2024, 1, day),
+                type='Airdrop' if index % 2 else 'Depot',
+                qty_a=1,
+                actif_a_id='ethereum' if index == 4 else 'bitcoin',
+                destination='ledger' if index == 0 else 'binance',
+            )
+            for index, day in enumerate(days)
+        ]
+    )
+    await session.commit()
+    return user_id
+
+
+@pytest.mark.asyncio
+async def test_get_user_transactions_pages_by_date_then_id(session, ledger):
+    service = TransactionService(session)
+    everything, cursor = await service.get_user_transactions(ledger)
+    assert cursor is None
+
+    pages = []
+    while True:
+        page, cursor = await service.get_user_transactions(ledger, limit=2, cursor=cursor)
+        pages.append(page)
+        if cursor is None:
+            break
+
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert [trx.id for page in pages for trx in page] == [trx.id for trx in everything]
+    assert [trx.date.day for trx in everything] == [4, 3, 2, 2, 1]
+
+
+@pytest.mark.asyncio
+async def test_get_user_transactions_filters(session, ledger):
+    service = TransactionService(session)
+
+    by_token, _ = await service.get_user_transactions(ledger, token='ethereum')
+    by_wallet, _ = await service.get_user_transactions(ledger, wallet='ledger')
+    by_type, _ = await service.get_user_transactions(ledger, type='Airdrop')
+
+    assert [trx.date.day for trx in by_token] == [4]
+    assert [trx.date.day for trx in by_wallet] == [1]
+    assert [trx.type for trx in by_type] == ['Airdrop', 'Airdrop']
+
+
+@pytest.mark.asyncio
+async def test_get_user_transactions_rejects_invalid_cursor(session, ledger):
+    with pytest.raises(HTTPException) as err:
+        await TransactionService(session).get_user_transactions(ledger, limit=2, cursor='not-a-cursor')
+
+    assert err.value.status_code == 400
+
+
+@pytest.mark.asyncio
+async def test_batch_transactions_applies_all_operations_in_one_commit(session, ledger, monkeypatch):
+    enqueued = []
+    monkeypatch.setattr(asset_queue, 'enqueue', lambda *args: enqueued.append(args))
+    monkeypatch.setattr(session.sync_session, 'expire_on_commit', False)  # Comme les sessions de l'API
+
+    user = await session.get(User, ledger)
+    transactions, _ = await TransactionService(session).get_user_transactions(ledger)
+    first, second = transactions[-1], transactions[-2]
+    batch = TransactionBatch.model_validate(
+        {
+            'operations': [
+                {'op': 'delete', 'id': str(first.id)},
+                {
+                    'op': 'update',
+                    'data': {
+                        'id': str(second.id),
+                        'date': '2024-01-05T00:00:00',
+                        'type': 'Airdrop',
+                        'qty_a': 2,
+                        'actif_a_id': 'ethereum',
+                        'destination': 'binance',
+                    },
+                },
+                {
+                    'op': 'create',
+                    'data': {'date': '2024-01-06T00:00:00', 'type': 'Airdrop', 'qty_a': 3, 'actif_a_id': 'bitcoin', 'destination': 'w'},
+                },
+            ]
+        }
+    )
+
+    service = TransactionService(session)
+    result = await service.batch_transactions(batch, user)
+
+    remaining = (await session.exec(select(Transaction).where(Transaction.user_id == ledger))).all()
+    assert [(trx.qty_a, trx.actif_a.symbol) for trx in result] == [(2, 'eth'), (3, 'btc')]
+    assert len(remaining) == 5 and first.id not in {trx.id for trx in remaining}
+    assert service.ledger_version == 1
+    assert len(enqueued) == 1
+    assert [sign for _, sign in enqueued[0][1]] == [-1, -1, 1, 1]
+    assert enqueued[0][2] == {'bitcoin', 'ethereum'}
+
+
+@pytest.mark.asyncio
+async def test_batch_transactions_is_all_or_nothing(session, ledger, monkeypatch):
+    monkeypatch.setattr(asset_queue, 'enqueue', lambda *args: pytest.fail('nothing should be enqueued'))
+
+    user = await session.get(User, ledger)
+    transactions, _ = await TransactionService(session).get_user_transactions(ledger)
+    batch = TransactionBatch.model_validate(
+        {
+            'operations': [
+                {'op': 'delete', 'id': str(transactions[0].id)},
+                {
+                    'op': 'create',
+                    'data': {'date': '2024-01-06T00:00:00', 'type': 'Airdrop', 'qty_a': 1, 'actif_a_id': 'solana', 'destination': 'w'},
+                },
+            ]
+        }
+    )
+
+    with pytest.raises(HTTPException) as err:
+        await TransactionService(session).batch_transactions(batch, user)
+
+    remaining = (await session.exec(select(Transaction).where(Transaction.user_id == ledger))).all()
+    assert err.value.status_code == 422
+    assert len(remaining) == 5
@@ -253,3 +253,16 @@ async def test_update_user_existing_email(client: AsyncClient, initial_user):
 
     assert response.status_code == 403
     assert data['detail'] == 'Email already exists.'
+
+
+@pytest.mark.asyncio
+async def test_update_params_calc_method_display(client: AsyncClient, initial_user):
+    login = await client.post('/auth/login', data={'username': TEST_USERNAME, 'password': TEST_PASSWORD})
+    headers = {'Authorization': f'Bearer {login.json()["access_token"]}'}
+
+    response = await client.patch('/users/params', json={'calc_method_display': 'median'}, headers=headers)
+    assert response.status_code == 400
+
+    response = await client.patch('/users/params', json={'calc_method_display': 'fifo'}, headers=headers)
+    assert response.status_code == 200
+    assert response.json()['calc_method_display'] == 'fifo'
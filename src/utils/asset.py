@@ -1,15 +1,32 @@
-from collections import defaultdict
+from collections import defaultdict, deque
+from datetime import datetime
 from typing import DefaultDict, List, Tuple
 
+from sqlmodel import or_, select
 from src.config import settings
 from src.utils.calculations import get_fiat_price
 
 CALC_METHODS = [
-    {'label': 'weighted average', 'value': 1},
-    {'label': 'fifo', 'value': 2},
-    {'label': 'lifo', 'value': 3},
+    {'label': 'weighted average', 'value': 1, 'field': 'mean_buy_wavg'},
+    {'label': 'fifo', 'value': 2, 'field': 'mean_buy_fifo'},
+    {'label': 'lifo', 'value': 3, 'field': 'mean_buy_lifo'},
 ]
-calc_method = {'value': 3}
+
+
+DEFAULT_CALC_METHOD = 'weighted average'  # Méthode par défaut de User.calc_method_display
+
+
+def get_calc_method(label: str, strict: bool = False) -> dict:
+    """
+    Méthode de CALC_METHODS correspondant au libellé. Un libellé inconnu (enregistré avant la validation des
+    paramètres) donne la méthode par défaut, sauf si `strict` (validation d'une modification).
+    """
+    for method in CALC_METHODS:
+        if method['label'] == label:
+            return method
+    if strict:
+        raise ValueError(f'Méthode de calcul inconnue : {label}')
+    return get_calc_method(DEFAULT_CALC_METHOD, strict=True)
 
 
 def get_asset_qty(token_id, transactions):
@@ -32,97 +49,302 @@ def get_asset_qty(token_id, transactions):
     return qty
 
 
-def get_asset_qty_by_wallet(token_id: str, transactions: List) -> Tuple[float, dict[str, float]]:
-    qty = 0
-    qty_by_wallet = defaultdict(float)
+def accumulate_holdings(transactions: List) -> Tuple[DefaultDict[str, float], DefaultDict[str, DefaultDict]]:
+    """Quantités et répartitions par wallet brutes (non bornées à 0) des transactions, pour chaque token."""
+    qty: DefaultDict[str, float] = defaultdict(float)
+    qty_by_wallet: DefaultDict[str, DefaultDict] = defaultdict(lambda: defaultdict(float))
 
     for trx in transactions:
+        actif_a, actif_v, actif_f = trx.actif_a_id, trx.actif_v_id, trx.actif_f_id
+
         if trx.type in ['Swap', 'Achat', 'Vente']:
-            if trx.actif_a_id == token_id:
-                qty += trx.qty_a
-                qty_by_wallet[f'{trx.destination}'] += trx.qty_a
-            if trx.actif_v_id == token_id:
-                qty -= trx.qty_a * trx.price
-                qty_by_wallet[f'{trx.destination}'] -= trx.qty_a * trx.price
+            if actif_a is not None:
+                qty[actif_a] += trx.qty_a
+                qty_by_wallet[actif_a][f'{trx.destination}'] += trx.qty_a
+            if actif_v is not None:
+                qty[actif_v] -= trx.qty_a * trx.price
+                qty_by_wallet[actif_v][f'{trx.destination}'] -= trx.qty_a * trx.price
         elif trx.type in ['Depot', 'Interets', 'Airdrop', 'Emprunt']:
-            if trx.actif_a_id == token_id:
-                qty += trx.qty_a
-                qty_by_wallet[f'{trx.destination}'] += trx.qty_a
+            if actif_a is not None:
+                qty[actif_a] += trx.qty_a
+                qty_by_wallet[actif_a][f'{trx.destination}'] += trx.qty_a
         elif trx.type in ['Retrait', 'Perte', 'Remboursement']:
-            if trx.actif_a_id == token_id:
-                qty -= trx.qty_a
-                qty_by_wallet[f'{trx.destination}'] -= trx.qty_a
-        elif trx.type == 'Transfert' and trx.actif_a_id == token_id:
-            qty_by_wallet[f'{trx.origin}'] -= trx.qty_a
-            qty_by_wallet[f'{trx.destination}'] += trx.qty_a
-        if trx.actif_f_id == token_id:
-            qty -= trx.qty_f
-            wallet = trx.destination if trx.type != 'Transfert' or trx.actif_f_id == trx.actif_a_id else trx.origin
-            qty_by_wallet[wallet] -= trx.qty_f
-
-    qty = max(qty, 0)
-    qty_by_wallet = {f'{key}': max(value, 0) for key, value in qty_by_wallet.items()}
+            if actif_a is not None:
+                qty[actif_a] -= trx.qty_a
+                qty_by_wallet[actif_a][f'{trx.destination}'] -= trx.qty_a
+        elif trx.type == 'Transfert' and actif_a is not None:
+            qty_by_wallet[actif_a][f'{trx.origin}'] -= trx.qty_a
+            qty_by_wallet[actif_a][f'{trx.destination}'] += trx.qty_a
+        if actif_f is not None:
+            qty[actif_f] -= trx.qty_f
+            wallet = trx.destination if trx.type != 'Transfert' or actif_f == actif_a else trx.origin
+            qty_by_wallet[actif_f][wallet] -= trx.qty_f
 
     return qty, qty_by_wallet
 
 
-async def get_asset_mean_buy(token_id, transactions, session):
-    summary_table = []
-    for t in transactions:
-        qty_a = t.qty_a - t.qty_f if t.actif_f_id == t.actif_a_id else t.qty_a
-        if t.actif_a_id == token_id and t.type in ['Swap', 'Achat', 'Vente', 'Emprunt', 'Depot', 'Airdrop']:
-            price = t.value_a
-            if t.actif_a_id in settings.FIATS:
-                price = await get_fiat_price(t.actif_a_id, t.date, session)
-            summary_table.append({'qty_a': qty_a, 'price': price})
-
-        elif t.actif_a_id == token_id and t.type in ['Interets']:
-            summary_table.append({'qty_a': qty_a, 'price': 0})
-
-        elif calc_method['value'] == 1:  # Weighted average
-            total = sum(row['qty_a'] for row in summary_table)
-            if total == 0:
-                print('Quantité = 0 pour le token: ', token_id)
-                return 0
+def get_holdings(transactions: List) -> dict[str, Tuple[float, dict[str, float]]]:
+    """
+    Parcourt une seule fois le ledger ordonné et retourne, pour chaque token rencontré,
+    sa quantité et sa répartition par wallet (mêmes règles que pour un token isolé).
+    """
+    qty, qty_by_wallet = accumulate_holdings(transactions)
+
+    return {
+        token_id: (
+            max(qty.get(token_id, 0), 0),
+            {f'{key}': max(value, 0) for key, value in qty_by_wallet.get(token_id, {}).items()},
+        )
+        for token_id in qty.keys() | qty_by_wallet.keys()
+    }
+
+
+def get_asset_qty_by_wallet(token_id: str, transactions: List) -> Tuple[float, dict[str, float]]:
+    return get_holdings(transactions).get(token_id, (0, {}))
+
+
+def touches_tokens(token_ids: set[str]):
+    from src.db.models import Transaction
+
+    return or_(
+        Transaction.actif_a_id.in_(token_ids),  # type: ignore
+        Transaction.actif_v_id.in_(token_ids),  # type: ignore
+        Transaction.actif_f_id.in_(token_ids),  # type: ignore
+    )
+
+
+class LedgerContext:
+    """
+    Transactions d'un utilisateur chargées une seule fois, triées par date, et partagées par tous les assets
+    d'une même mise à jour. Les quantités par token sont calculées au premier accès.
+    """
+
+    def __init__(self, transactions: list):
+        self.transactions = transactions
+        self._holdings = None
+
+    @classmethod
+    async def load(cls, session, user_id, token_ids: set[str] | None = None, since: datetime | None = None):
+        """`token_ids` limite aux transactions touchant ces tokens, `since` à celles datées à partir de `since`."""
+        from src.db.models import Transaction
+
+        statement = select(Transaction).where(Transaction.user_id == user_id).order_by(Transaction.date)
+        if token_ids is not None:
+            statement = statement.where(touches_tokens(token_ids))
+        if since is not None:
+            statement = statement.where(Transaction.date >= since)
+        results = await session.exec(statement)
+        return cls(list(results.all()))
+
+    @property
+    def token_ids(self) -> set[str]:
+        return {
+            token_id for t in self.transactions for token_id in (t.actif_a_id, t.actif_v_id, t.actif_f_id)
+        } - {None}
 
-            if t.actif_a_id == token_id and t.type in ['Retrait', 'Remboursement', 'Perte']:
-                for row in summary_table:
-                    row['qty_a'] -= row['qty_a'] * t.qty_a / total
+    @property
+    def holdings(self) -> dict[str, Tuple[float, dict[str, float]]]:
+        if self._holdings is None:
+            self._holdings = get_holdings(self.transactions)
+        return self._holdings
 
-            elif t.actif_v_id == token_id and t.type in ['Swap', 'Achat', 'Vente']:
-                for row in summary_table:
-                    row['qty_a'] -= row['qty_a'] * t.qty_a * t.price / total
+LOT_QTY_TOLERANCE = 1e-9  # Écart relatif sous lequel une quantité de lots est considérée nulle
 
-            if t.actif_f_id == token_id:
-                for row in summary_table:
-                    row['qty_a'] -= row['qty_a'] * t.qty_f / total
 
-        elif calc_method['value'] in [2, 3]:  # fifo / lifo
-            index_fifo_lifo = 0 if calc_method['value'] == 2 else -1
-            qty_to_remove = 0
+class LotBook:
+    """
+    Lots ouverts d'un token pour une méthode de CALC_METHODS.
 
-            if t.actif_a_id == token_id and t.type in ['Retrait', 'Remboursement', 'Perte']:
-                qty_to_remove = t.qty_a
+    Prix moyen pondéré : une quantité et une valeur totales, mises à l'échelle à chaque sortie (O(1)).
+    FIFO / LIFO : deque de lots [quantité, prix, date] consommée par la gauche (fifo) ou par la droite (lifo).
+    """
 
-            elif t.actif_v_id == token_id and t.type in ['Swap', 'Achat', 'Vente']:
-                qty_to_remove = t.qty_a * t.price
+    def __init__(self, method: int):
+        self.method = method
+        self.lots: deque[list] = deque()
+        self.total_qty = 0
+        self.total_value = 0
+        self.date = None
 
-            if t.actif_f_id == token_id:
-                qty_to_remove += t.qty_f
+    def add(self, qty, price, date=None):
+        if self.method == 1:
+            self.total_qty += qty
+            self.total_value += qty * price
+            self.date = date
+        else:
+            self.lots.append([qty, price, date])
 
-            while qty_to_remove > 0 and summary_table:
-                if summary_table[index_fifo_lifo]['qty_a'] >= qty_to_remove:
-                    summary_table[index_fifo_lifo]['qty_a'] -= qty_to_remove
+    def remove(self, *quantities):
+        if self.method == 1:  # Weighted average
+            total = self.total_qty  # Toutes les sorties d'une transaction sont proportionnelles au total initial
+            if total == 0:
+                return
+            for qty in quantities:
+                ratio = 1 - qty / total
+                self.total_qty *= ratio
+                self.total_value *= ratio
+
+        else:  # fifo / lifo
+            qty_to_remove = sum(quantities)
+            while qty_to_remove > 0 and self.lots:
+                lot = self.lots[0] if self.method == 2 else self.lots[-1]
+                if lot[0] >= qty_to_remove:
+                    lot[0] -= qty_to_remove
                     qty_to_remove = 0
                 else:
-                    qty_to_remove -= summary_table[index_fifo_lifo]['qty_a']
-                    summary_table.pop(index_fifo_lifo)
+                    qty_to_remove -= lot[0]
+                    if self.method == 2:
+                        self.lots.popleft()
+                    else:
+                        self.lots.pop()
+
+    def undo_add(self, qty, price, date=None) -> bool:
+        """Annule le dernier ajout, s'il n'a été suivi d'aucune autre opération. False si le lot a été entamé."""
+        if self.method == 1:
+            # Seul le retour à un lot vide est exact : sinon la date du lot agrégé précédent est perdue et la
+            # soustraction en flottants laisse un résidu, le token doit être rejoué
+            if abs(self.total_qty - qty) > LOT_QTY_TOLERANCE * max(abs(qty), 1):
+                return False
+            self.total_qty = 0
+            self.total_value = 0
+            self.date = None
+            return True
+        if self.lots and self.lots[-1] == [qty, price, date]:
+            self.lots.pop()
+            return True
+        return False
+
+    def mean_buy(self):
+        if self.method == 1:
+            total_buy_value = self.total_value
+            total_buy_qty = self.total_qty
+        else:
+            total_buy_value = sum(price * qty for qty, price, _ in self.lots)
+            total_buy_qty = sum(qty for qty, _, _ in self.lots)
+
+        if total_buy_qty == 0:
+            return 0
+
+        return total_buy_value / total_buy_qty
+
+    def to_lots(self) -> list[tuple]:
+        """Lots à persister : (quantité, prix, date). Le prix moyen pondéré est stocké comme un seul lot agrégé."""
+        if self.method == 1:
+            if self.total_qty == 0:
+                return []
+            return [(self.total_qty, self.total_value / self.total_qty, self.date)]
+        return [tuple(lot) for lot in self.lots]
+
+
+def new_lot_books() -> list[LotBook]:
+    return [LotBook(method['value']) for method in CALC_METHODS]
+
+
+def get_books_mean_buys(token_books: list[LotBook]) -> dict[str, float]:
+    return {method['field']: book.mean_buy() for method, book in zip(CALC_METHODS, token_books)}
+
+
+def get_lot_effect(t, token_id: str) -> tuple:
+    """
+    Effet d'une transaction sur les lots d'un token : ('buy', qty) au prix de la transaction,
+    ('interest', qty) à prix nul, ou ('remove', [quantités]) (liste vide si aucun effet).
+    """
+    if t.actif_a_id == token_id and t.type in ['Swap', 'Achat', 'Vente', 'Emprunt', 'Depot', 'Airdrop']:
+        return 'buy', t.qty_a - t.qty_f if t.actif_f_id == t.actif_a_id else t.qty_a
+
+    if t.actif_a_id == token_id and t.type in ['Interets']:
+        return 'interest', t.qty_a - t.qty_f if t.actif_f_id == t.actif_a_id else t.qty_a
+
+    quantities = []
+    if t.actif_a_id == token_id and t.type in ['Retrait', 'Remboursement', 'Perte']:
+        quantities.append(t.qty_a)
+    elif t.actif_v_id == token_id and t.type in ['Swap', 'Achat', 'Vente']:
+        quantities.append(t.qty_a * t.price)
+    if t.actif_f_id == token_id:
+        quantities.append(t.qty_f)
+    return 'remove', quantities
+
+
+async def get_lot_price(t, session):
+    if t.actif_a_id in settings.FIATS and t.type in ['Swap', 'Achat', 'Vente', 'Emprunt', 'Depot', 'Airdrop']:
+        return await get_fiat_price(t.actif_a_id, t.date, session)
+    return t.value_a
+
+
+async def apply_to_lot_books(books: dict, transactions, session, token_ids: set | None = None) -> dict:
+    """
+    Applique les transactions (triées par date) aux lots de chaque token touché, toutes méthodes confondues.
+    `books` ({token_id: [LotBook, ...]}) est complété sur place ; `token_ids` limite les tokens mis à jour.
+    Retourne la date de la dernière transaction appliquée pour chaque token.
+    """
+    last_dates = {}
+
+    for t in transactions:
+        touched = {t.actif_a_id, t.actif_v_id, t.actif_f_id} - {None}
+        if token_ids is not None:
+            touched &= token_ids
+        if not touched:
+            continue
+
+        price = await get_lot_price(t, session)
+
+        for token_id in touched:
+            token_books = books.setdefault(token_id, new_lot_books())
+            last_dates[token_id] = t.date
+            effect, qty = get_lot_effect(t, token_id)
+
+            if effect == 'buy':
+                if price is None:
+                    continue  # Valeur manquante : achat ignoré pour le prix moyen
+                for book in token_books:
+                    book.add(qty, price, t.date)
+
+            elif effect == 'interest':
+                for book in token_books:
+                    book.add(qty, 0, t.date)
+
+            else:
+                for book in token_books:
+                    book.remove(*qty)
+
+    return last_dates
+
+
+async def revert_from_lot_books(books: dict, t, session, token_ids: set[str]) -> set[str]:
+    """
+    Annule dans les lots une transaction qui était la dernière appliquée aux tokens donnés.
+    Retourne les tokens pour lesquels c'est impossible (lots consommés) : ils doivent être rejoués.
+    """
+    failed = set()
+    price = await get_lot_price(t, session)
+
+    for token_id in {t.actif_a_id, t.actif_v_id, t.actif_f_id} & token_ids:
+        token_books = books[token_id]
+        effect, qty = get_lot_effect(t, token_id)
+
+        if effect == 'buy' and price is not None:
+            if not all(book.undo_add(qty, price, t.date) for book in token_books):
+                failed.add(token_id)
+        elif effect == 'interest':
+            if not all(book.undo_add(qty, 0, t.date) for book in token_books):
+                failed.add(token_id)
+        elif effect == 'remove' and qty:
+            failed.add(token_id)
+
+    return failed
+
 
-    total_buy_value = sum(row['price'] * row['qty_a'] for row in summary_table)
-    total_buy_qty = sum(row['qty_a'] for row in summary_table)
+async def get_mean_buys(transactions, session) -> dict[str, dict[str, float]]:
+    """
+    Prix moyen d'achat de chaque token pour toutes les méthodes de CALC_METHODS, en un seul parcours
+    du ledger (trié par date). Retourne {token_id: {field: mean_buy}}.
+    """
+    books = {}
+    await apply_to_lot_books(books, transactions, session)
+    return {token_id: get_books_mean_buys(token_books) for token_id, token_books in books.items()}
 
-    if total_buy_qty == 0:
-        return 0
-    average_price = total_buy_value / total_buy_qty
 
-    return average_price
+async def get_asset_mean_buy(token_id, transactions, session) -> dict[str, float]:
+    transactions = [t for t in transactions if token_id in (t.actif_a_id, t.actif_v_id, t.actif_f_id)]
+    mean_buys = await get_mean_buys(transactions, session)
+    return mean_buys.get(token_id, {method['field']: 0 for method in CALC_METHODS})
@@ -0,0 +1,136 @@
+import codecs
+import csv
+import hashlib
+import json
+from collections import deque
+from typing import AsyncIterator
+
+from pydantic import ValidationError
+from src.schemes.transaction import TransactionCSVModel
+
+BULK_FORMATS = {
+    'text/csv': 'csv',
+    'application/x-ndjson': 'ndjson',
+    'application/jsonl': 'ndjson',
+}
+
+CONTENT_HASH_FIELDS = (
+    'date',
+    'type',
+    'actif_a_id',
+    'actif_v_id',
+    'actif_f_id',
+    'qty_a',
+    'qty_f',
+    'price',
+    'destination',
+    'origin',
+)
+
+
+def normalize_hash_value(value) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, float | int):
+        return format(float(value), '.12g')  # 1 et 1.0, ou 0.30000000000000004 et 0.3, ont la même empreinte
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    return str(value).strip().lower()
+
+
+def get_content_hash(trx) -> str:
+    """
+    Empreinte du contenu d'une transaction (date, type, actifs, quantités, prix et wallets), indépendante de son id
+    et des valorisations : une même ligne ré-importée donne la même empreinte.
+    """
+    content = '|'.join(normalize_hash_value(getattr(trx, field)) for field in CONTENT_HASH_FIELDS)
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+async def iter_lines(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Découpe un flux d'octets UTF-8 en lignes, sans le charger entièrement en mémoire."""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    buffer = ''
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        *lines, buffer = buffer.split('\n')
+        for line in lines:
+            yield line.rstrip('\r')
+
+    buffer += decoder.decode(b'', final=True)
+    if buffer.strip():
+        yield buffer.rstrip('\r')
+
+
+class LineFeeder:
+    """
+    Itérateur synchrone alimenté au fil du flux asynchrone : un seul `csv.reader` lit tout le fichier et voit les
+    champs entre guillemets qui s'étendent sur plusieurs lignes.
+    """
+
+    def __init__(self):
+        self.lines = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if not self.lines:
+            raise StopIteration
+        return self.lines.popleft()
+
+
+async def parse_transaction_lines(lines: AsyncIterator[str], fmt: str):
+    """
+    Valide chaque enregistrement avec les règles de `TransactionCSVModel` et produit `(numéro de ligne, transaction,
+    erreur)`, le numéro étant celui de la première ligne de l'enregistrement et la transaction un `TransactionCreate`
+    (None si l'enregistrement est invalide). Les lignes vides sont ignorées.
+    """
+    headers = None
+    feeder = LineFeeder()
+    reader = csv.reader(feeder)
+
+    def parse_record(record_start: int, line: str):
+        nonlocal headers
+        try:
+            if fmt == 'csv':
+                row = next(reader)
+                if headers is None:
+                    headers = [header.strip() for header in row]
+                    return None
+                data = dict(zip(headers, row))
+            else:
+                data = json.loads(line)
+
+            return record_start, TransactionCSVModel.model_validate(data).to_transaction_create(), None
+
+        except (ValidationError, ValueError, csv.Error) as err:
+            return record_start, None, str(err)
+
+    record_start = None
+    quotes = 0  # Guillemets de l'enregistrement en cours : impair tant qu'un champ entre guillemets est ouvert
+    line_number = 0
+    async for line in lines:
+        line_number += 1
+        if record_start is None:
+            if not line.strip():
+                continue
+            record_start = line_number
+
+        if fmt == 'csv':
+            # Le lecteur ne consomme les lignes qu'une fois l'enregistrement complet
+            feeder.lines.append(line + '\n')
+            quotes += line.count(reader.dialect.quotechar)
+            if quotes % 2:
+                continue
+
+        parsed = parse_record(record_start, line)
+        record_start, quotes = None, 0
+        if parsed is not None:
+            yield parsed
+
+    if record_start is not None:
+        # Guillemet jamais refermé : le lecteur rend l'enregistrement tronqué, rejeté ou non par la validation
+        parsed = parse_record(record_start, None)
+        if parsed is not None:
+            yield parsed
@@ -0,0 +1,96 @@
+import uuid
+from collections import OrderedDict
+
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import func, select, update
+
+ASSET_CACHE_SIZE = 1000  # Nombre maximum d'utilisateurs gardés en mémoire
+TOKEN_PRICES = 'token_prices'
+
+
+class SnapshotCache:
+    """
+    Cache LRU par utilisateur d'une réponse déjà sérialisée.
+
+    Chaque entrée est gardée avec la clé de version qui l'a produite (version du ledger, version des prix,
+    méthode de calcul...) : une entrée dont la clé ne correspond plus est simplement ignorée puis remplacée.
+    """
+
+    def __init__(self, maxsize: int = ASSET_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.entries: OrderedDict[uuid.UUID, tuple[tuple, bytes]] = OrderedDict()
+
+    def get(self, user_id: uuid.UUID, key: tuple) -> bytes | None:
+        entry = self.entries.get(user_id)
+        if entry is None or entry[0] != key:
+            return None
+        self.entries.move_to_end(user_id)
+        return entry[1]
+
+    def set(self, user_id: uuid.UUID, key: tuple, content: bytes):
+        self.entries[user_id] = (key, content)
+        self.entries.move_to_end(user_id)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, user_id: uuid.UUID | None = None):
+        if user_id is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(user_id, None)
+
+
+async def get_version(session, name: str) -> int:
+    from src.db.models import CacheVersion
+
+    result = await session.exec(select(CacheVersion.version).where(CacheVersion.name == name))
+    return result.first() or 0
+
+
+async def bump_version(session, name: str):
+    """Incrémente la version (sans commit) : à appeler dans la transaction qui modifie la donnée."""
+    from src.db.models import CacheVersion
+
+    statement = insert(CacheVersion).values(name=name, version=1)
+    statement = statement.on_conflict_do_update(
+        index_elements=['name'], set_={'version': CacheVersion.version + 1}
+    )
+    await session.exec(statement)
+
+
+async def bump_ledger_version(session, user_id: uuid.UUID) -> int:
+    """Nouvelle version du ledger de l'utilisateur (sans commit), à appeler dans la transaction qui le modifie."""
+    from src.db.models import User
+
+    statement = (
+        update(User)
+        .where(User.uid == user_id)  # type: ignore
+        .values(ledger_version=User.ledger_version + 1)
+        .returning(User.ledger_version)
+    )
+    result = await session.exec(statement)
+    return result.scalar_one()
+
+
+async def get_assets_version(session, user_id: uuid.UUID) -> int:
+    """Version du ledger reflétée par les assets stockés de l'utilisateur."""
+    from src.db.models import User
+
+    result = await session.exec(select(User.assets_version).where(User.uid == user_id))
+    return result.first() or 0
+
+
+async def set_assets_version(session, user_id: uuid.UUID, version: int | None = None):
+    """
+    Version du ledger reflétée par les assets (sans commit) : `version` après un recalcul partiel,
+    sinon la version courante du ledger (reconstruction complète). Elle ne recule jamais.
+    """
+    from src.db.models import User
+
+    version = User.ledger_version if version is None else version
+    statement = update(User).where(User.uid == user_id).values(assets_version=func.max(User.assets_version, version))
+    await session.exec(statement)
+
+
+# Snapshots de GET /assets, partagés par tout le process API
+asset_cache = SnapshotCache()
@@ -1,150 +1,123 @@
 import uuid
-from collections import defaultdict
-from datetime import datetime
+from datetime import datetime, timedelta
 
+import numpy as np
 import pandas as pd
-from sqlalchemy.orm import selectinload
-from sqlmodel import desc, select
+from sqlalchemy.orm import aliased
+from sqlmodel import delete, func, select, update
 from src.config import settings
 from src.db.main import get_session
 from src.schemes.transaction import TransactionCreate
+from src.utils.fx import FxRateTable, fx_table
 
 
 async def get_fiat_price(fiat, date, session):
-    from src.db.models import FiatHistory
-
     if fiat == 'fiat_usd':
         return 1
 
-    price = None
-    # count = 0
-
-    date = date.date()
-
-    statement = (
-        select(FiatHistory.close)
-        .where(FiatHistory.cg_id == fiat, FiatHistory.date < date)
-        .order_by(desc(FiatHistory.date))
-        .limit(1)
-    )
-    result = await session.exec(statement)
-    price = result.first()
-
-    if price is None or price == 0:
-        raise LookupError(f'Prix fiat non trouvé pour {fiat} à la date : {date}')
-
-    return price
-
-
-async def get_cash_in_usd(transactions: list[dict], df_pf_history):
-    cash_in = 0
-    cash_in_array = []
-    temp_cash_in_array = []
-
-    for tr in transactions:
-        trx = TransactionCreate.model_validate(tr)
-
-        if trx.type == 'Achat' and trx.actif_v_id in settings.FIATS:
-            trx_value = await calculate_transaction_value_in_usd(trx)
-            pf_value_end_of_day = get_pf_value_at_date(trx.date, df_pf_history)
-            temp_cash_in_array.append(
-                {'date': trx.date, 'type': 'achat', 'trx_value': trx_value, 'pf': pf_value_end_of_day}
-            )
-
-        if trx.type == 'Vente':
-            trx_value = await calculate_transaction_value_in_usd(trx)
-            pf_value_end_of_day = get_pf_value_at_date(trx.date, df_pf_history)
-            temp_cash_in_array.append(
-                {'date': trx.date, 'type': 'vente', 'trx_value': trx_value, 'pf': pf_value_end_of_day}
-            )
-
-    # Gestion des cash in si meme date
-    grouped_by_date = defaultdict(list)
-    for row in temp_cash_in_array:
-        grouped_by_date[row['date'].date()].append(row)
-
-    for _, rows in grouped_by_date.items():
-        cumulative = 0
-        for row in reversed(rows):
-            if row['type'] == 'achat':
-                cumulative += row['trx_value']
-            elif row['type'] == 'vente':
-                cumulative -= row['trx_value']
-
-            row['pf_before_trx'] = max(row['pf'] - cumulative, 0)
-
-    for row in temp_cash_in_array:
-        if row['type'] == 'achat':
-            cash_in += row['trx_value']
-            cash_in_array.append({'date': row['date'], 'cash_in_fiat_usd': cash_in})
-
-        elif row['type'] == 'vente':
-            cash_in = cash_in * (1 - (row['trx_value'] / row['pf_before_trx']))
-            cash_in_array.append({'date': row['date'], 'cash_in_fiat_usd': cash_in})
+    # Les cours sont lus dans la table en mémoire, rechargée depuis la DB seulement si elle est périmée
+    if not fx_table.fresh:
+        await fx_table.load(session)
+
+    return fx_table.get_price(fiat, date)
+
+
+async def get_cash_in(
+    transactions: list[dict],
+    df_pf_history: pd.DataFrame,
+    fiats: list[str] | None = None,
+    start: dict[str, float] | None = None,
+):
+    """
+    Calcule en une seule passe les séries de cash in de toutes les fiats demandées.
+
+    Retourne un DataFrame avec une ligne par achat en fiat ou vente (dans l'ordre des transactions) :
+    la colonne `date` et une colonne `cash_in_{fiat}` par fiat. `start` donne le cash in de départ par fiat
+    lorsque les transactions reprennent après un état déjà calculé.
+    """
+    fiats = fiats or settings.FIATS
+    columns = [f'cash_in_{fiat}' for fiat in fiats]
+
+    # Seuls les achats payés en fiat et les ventes font varier le cash in
+    flows = [
+        TransactionCreate.model_construct(**tr)
+        for tr in transactions
+        if (tr['type'] == 'Achat' and tr['actif_v_id'] in settings.FIATS) or tr['type'] == 'Vente'
+    ]
+    if not flows:
+        return pd.DataFrame({'date': pd.Series(dtype='datetime64[ns]'), **{col: pd.Series(dtype=float) for col in columns}})
+
+    values_by_fiat = await value_transactions(flows, fiats)
+    values = np.column_stack([values_by_fiat[fiat] for fiat in fiats]).astype(float)
+
+    dates = pd.Series([trx.date for trx in flows])
+    days = dates.dt.normalize()
+    is_buy = np.array([trx.type == 'Achat' for trx in flows])
+
+    # Valeur du portefeuille en fin de journée pour chaque transaction
+    pf_end_of_day = df_pf_history.loc[days, [f'total_{fiat}' for fiat in fiats]].to_numpy(dtype=float)
+
+    # Gestion des cash in si meme date : on retire de la valeur de fin de journée les achats/ventes
+    # qui suivent la transaction dans la même journée (elle comprise)
+    signed_values = pd.DataFrame(np.where(is_buy[:, None], values, -values))
+    cumulative = signed_values.iloc[::-1].groupby(days.iloc[::-1].to_numpy()).cumsum().iloc[::-1].to_numpy()
+    pf_before_trx = np.maximum(pf_end_of_day - cumulative, 0)
+
+    cash_in = np.array([(start or {}).get(fiat, 0) for fiat in fiats], dtype=float)
+    cash_in_rows = np.empty_like(values)
+    for i in range(len(flows)):
+        if is_buy[i]:
+            cash_in = cash_in + values[i]
+        else:
+            cash_in = cash_in * (1 - (values[i] / pf_before_trx[i]))
+        cash_in_rows[i] = cash_in
 
-    return cash_in_array
+    df_cash_in = pd.DataFrame(cash_in_rows, columns=columns)
+    df_cash_in.insert(0, 'date', dates)
 
+    return df_cash_in
 
-async def get_cash_in_fiat(transactions: list[dict], df_pf_history, fiat):
-    cash_in = 0
-    cash_in_array = []
-    temp_cash_in_array = []
 
-    for tr in transactions:
-        trx = TransactionCreate.model_validate(tr)
+async def value_transactions(transactions: list, fiats: list[str]) -> dict[str, list[float]]:
+    """
+    Valorise un lot de transactions dans chacune des fiats demandées.
 
-        if trx.type == 'Achat' and trx.actif_v_id in settings.FIATS:
-            trx_value = await calculate_transaction_value_in_fiat(trx, fiat)
-            pf_value_end_of_day = get_pf_value_at_date(trx.date, df_pf_history, fiat=fiat)
-            temp_cash_in_array.append(
-                {'date': trx.date, 'type': 'achat', 'trx_value': trx_value, 'pf': pf_value_end_of_day}
-            )
+    Aucune session n'est ouverte si la table des cours en mémoire est à jour. Sinon elle est rechargée en entier
+    (une requête), pour que les valorisations suivantes restent en mémoire et que la dernière clôture avant une
+    date soit toujours trouvée, aussi ancienne soit-elle.
+    """
+    fx = fx_table
+    if transactions and not fx.fresh:
+        async for session in get_session():
+            await fx.load(session)
 
-        if trx.type == 'Vente':
-            trx_value = await calculate_transaction_value_in_fiat(trx, fiat)
-            pf_value_end_of_day = get_pf_value_at_date(trx.date, df_pf_history, fiat=fiat)
-            temp_cash_in_array.append(
-                {'date': trx.date, 'type': 'vente', 'trx_value': trx_value, 'pf': pf_value_end_of_day}
-            )
+    values = {fiat: [] for fiat in fiats}
+    for t in transactions:
+        for fiat in fiats:
+            if fiat == 'fiat_usd':
+                values[fiat].append(value_transaction_in_usd(t, fx))
+            else:
+                values[fiat].append(value_transaction_in_fiat(t, fiat, fx))
 
-    # Gestion des cash in si meme date
-    grouped_by_date = defaultdict(list)
-    for row in temp_cash_in_array:
-        grouped_by_date[row['date'].date()].append(row)
+    return values
 
-    for _, rows in grouped_by_date.items():
-        cumulative = 0
-        for row in reversed(rows):
-            if row['type'] == 'achat':
-                cumulative += row['trx_value']
-            elif row['type'] == 'vente':
-                cumulative -= row['trx_value']
 
-            row['pf_before_trx'] = max(row['pf'] - cumulative, 0)
+async def calculate_transaction_value_in_usd(t: TransactionCreate):
+    values = await value_transactions([t], ['fiat_usd'])
+    return values['fiat_usd'][0]
 
-    for row in temp_cash_in_array:
-        if row['type'] == 'achat':
-            cash_in += row['trx_value']
-            cash_in_array.append({'date': row['date'], f'cash_in_{fiat}': cash_in})
 
-        elif row['type'] == 'vente':
-            cash_in = cash_in * (1 - (row['trx_value'] / row['pf_before_trx']))
-            cash_in_array.append({'date': row['date'], f'cash_in_{fiat}': cash_in})
-
-    return cash_in_array
+async def calculate_transaction_value_in_fiat(t: TransactionCreate, fiat: str):
+    values = await value_transactions([t], [fiat])
+    return values[fiat][0]
 
 
-async def calculate_transaction_value_in_usd(t: TransactionCreate):
+def value_transaction_in_usd(t: TransactionCreate, fx: FxRateTable):
     val = 0
 
     if t.type in ['Depot', 'Retrait'] and t.actif_a_id in settings.FIATS:
-        fiat_price = 0
-        if t.actif_a_id == 'fiat_usd':
-            fiat_price = 1
-        else:
-            date_normalized = t.date.replace(hour=0, minute=0, second=0, microsecond=0)
-            async for session in get_session():
-                fiat_price = await get_fiat_price(t.actif_a_id, date_normalized, session)
+        date_normalized = t.date.replace(hour=0, minute=0, second=0, microsecond=0)
+        fiat_price = fx.get_price(t.actif_a_id, date_normalized)
 
         val = t.qty_a * fiat_price
 
@@ -178,207 +151,286 @@ async def calculate_transaction_value_in_usd(t: TransactionCreate):
     return val
 
 
-async def calculate_transaction_value_in_fiat(t: TransactionCreate, fiat: str):
+def value_transaction_in_fiat(t: TransactionCreate, fiat: str, fx: FxRateTable):
     val = 0
     date_normalized = t.date.replace(hour=0, minute=0, second=0, microsecond=0)
 
-    async for session in get_session():
-        if t.type in ['Depot', 'Retrait'] and t.actif_a_id in settings.FIATS:
-            if t.actif_a_id == fiat:
-                fiat_price = 1
+    if t.type in ['Depot', 'Retrait'] and t.actif_a_id in settings.FIATS:
+        if t.actif_a_id == fiat:
+            fiat_price = 1
 
-            elif t.actif_a_id == 'fiat_usd':
-                fiat_price = await get_fiat_price(fiat, date_normalized, session)
+        elif t.actif_a_id == 'fiat_usd':
+            fiat_price = fx.get_price(fiat, date_normalized)
 
-            else:
-                transaction_fiat_price = await get_fiat_price(t.actif_a_id, date_normalized, session)
-                function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                fiat_price = transaction_fiat_price / function_fiat_price
+        else:
+            transaction_fiat_price = fx.get_price(t.actif_a_id, date_normalized)
+            function_fiat_price = fx.get_price(fiat, date_normalized)
+            fiat_price = transaction_fiat_price / function_fiat_price
 
-        elif t.type in ['Swap', 'Achat', 'Vente']:
-            if t.actif_a_id == fiat:
-                fiat_price = 1
+    elif t.type in ['Swap', 'Achat', 'Vente']:
+        if t.actif_a_id == fiat:
+            fiat_price = 1
 
-            elif t.actif_a_id in settings.FIATS and t.actif_a_id != 'fiat_usd':  # actif A est en fiat
-                if t.actif_v_id in settings.STABLECOINS or t.actif_v_id == 'fiat_usd':
-                    function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                    fiat_price = t.price / function_fiat_price
+        elif t.actif_a_id in settings.FIATS and t.actif_a_id != 'fiat_usd':  # actif A est en fiat
+            if t.actif_v_id in settings.STABLECOINS or t.actif_v_id == 'fiat_usd':
+                function_fiat_price = fx.get_price(fiat, date_normalized)
+                fiat_price = t.price / function_fiat_price
 
-                elif t.actif_v_id == fiat:
-                    fiat_price = t.price
+            elif t.actif_v_id == fiat:
+                fiat_price = t.price
 
-                else:
-                    transaction_fiat_price = await get_fiat_price(t.actif_a_id, date_normalized, session)
-                    function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                    fiat_price = transaction_fiat_price / function_fiat_price
+            else:
+                transaction_fiat_price = fx.get_price(t.actif_a_id, date_normalized)
+                function_fiat_price = fx.get_price(fiat, date_normalized)
+                fiat_price = transaction_fiat_price / function_fiat_price
 
-            elif t.actif_a_id in settings.STABLECOINS or t.actif_a_id == 'fiat_usd':  # actif A est en USD
-                if t.actif_v_id == fiat:
-                    fiat_price = t.price
+        elif t.actif_a_id in settings.STABLECOINS or t.actif_a_id == 'fiat_usd':  # actif A est en USD
+            if t.actif_v_id == fiat:
+                fiat_price = t.price
 
-                else:
-                    function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                    fiat_price = 1 / function_fiat_price
+            else:
+                function_fiat_price = fx.get_price(fiat, date_normalized)
+                fiat_price = 1 / function_fiat_price
 
-            else:  # actif A est une crypto classique
-                if t.actif_v_id == fiat:
-                    fiat_price = t.price
+        else:  # actif A est une crypto classique
+            if t.actif_v_id == fiat:
+                fiat_price = t.price
 
-                elif t.actif_v_id in settings.STABLECOINS or t.actif_v_id == 'fiat_usd':
-                    function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                    fiat_price = t.price / function_fiat_price
+            elif t.actif_v_id in settings.STABLECOINS or t.actif_v_id == 'fiat_usd':
+                function_fiat_price = fx.get_price(fiat, date_normalized)
+                fiat_price = t.price / function_fiat_price
 
-                elif t.actif_v_id in settings.FIATS:
-                    transaction_fiat_price = await get_fiat_price(t.actif_v_id, date_normalized, session)
-                    function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                    fiat_price = t.price * transaction_fiat_price / function_fiat_price
+            elif t.actif_v_id in settings.FIATS:
+                transaction_fiat_price = fx.get_price(t.actif_v_id, date_normalized)
+                function_fiat_price = fx.get_price(fiat, date_normalized)
+                fiat_price = t.price * transaction_fiat_price / function_fiat_price
 
-                else:
-                    function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                    fiat_price = t.value_a / function_fiat_price
+            else:
+                function_fiat_price = fx.get_price(fiat, date_normalized)
+                fiat_price = t.value_a / function_fiat_price
 
-        else:  # [Transfert, Mise en staking, Retrait de staking, Interets, Airdrop, Perte, Emprunt, Remboursement]
-            if t.actif_a_id == fiat:
-                fiat_price = 1
+    else:  # [Transfert, Mise en staking, Retrait de staking, Interets, Airdrop, Perte, Emprunt, Remboursement]
+        if t.actif_a_id == fiat:
+            fiat_price = 1
 
-            elif t.actif_a_id in settings.STABLECOINS or t.actif_a_id == 'fiat_usd':
-                function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                fiat_price = 1 / function_fiat_price
+        elif t.actif_a_id in settings.STABLECOINS or t.actif_a_id == 'fiat_usd':
+            function_fiat_price = fx.get_price(fiat, date_normalized)
+            fiat_price = 1 / function_fiat_price
 
-            elif t.actif_a_id in settings.FIATS:
-                transaction_fiat_price = await get_fiat_price(t.actif_a_id, date_normalized, session)
-                function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                fiat_price = transaction_fiat_price / function_fiat_price
-            else:
-                function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                fiat_price = t.value_a / function_fiat_price
+        elif t.actif_a_id in settings.FIATS:
+            transaction_fiat_price = fx.get_price(t.actif_a_id, date_normalized)
+            function_fiat_price = fx.get_price(fiat, date_normalized)
+            fiat_price = transaction_fiat_price / function_fiat_price
+        else:
+            function_fiat_price = fx.get_price(fiat, date_normalized)
+            fiat_price = t.value_a / function_fiat_price
 
-        val = t.qty_a * (fiat_price or 0)
+    val = t.qty_a * (fiat_price or 0)
 
-        # On ajoute les frais si ils ne sont pas compris dans la meme actif que l'actif acheté car c'est en plus
-        if t.actif_f_id != t.actif_a_id and t.actif_f_id is not None:
-            try:
-                if t.actif_f_id == fiat:
-                    val += t.qty_f or 0
+    # On ajoute les frais si ils ne sont pas compris dans la meme actif que l'actif acheté car c'est en plus
+    if t.actif_f_id != t.actif_a_id and t.actif_f_id is not None:
+        try:
+            if t.actif_f_id == fiat:
+                val += t.qty_f or 0
 
-                elif t.actif_f_id == t.actif_v_id:
-                    function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                    val += (t.qty_f or 0) / (t.price or 1) * (t.value_a or 0) / function_fiat_price
+            elif t.actif_f_id == t.actif_v_id:
+                function_fiat_price = fx.get_price(fiat, date_normalized)
+                val += (t.qty_f or 0) / (t.price or 1) * (t.value_a or 0) / function_fiat_price
 
-                elif t.actif_f_id in settings.STABLECOINS or t.actif_f_id == 'fiat_usd':
-                    function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                    val += t.qty_f / function_fiat_price
+            elif t.actif_f_id in settings.STABLECOINS or t.actif_f_id == 'fiat_usd':
+                function_fiat_price = fx.get_price(fiat, date_normalized)
+                val += t.qty_f / function_fiat_price
 
-                elif t.actif_f_id in settings.FIATS:
-                    transaction_fiat_price = await get_fiat_price(t.actif_f_id, date_normalized, session)
-                    function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                    val += t.qty_f * transaction_fiat_price / function_fiat_price
+            elif t.actif_f_id in settings.FIATS:
+                transaction_fiat_price = fx.get_price(t.actif_f_id, date_normalized)
+                function_fiat_price = fx.get_price(fiat, date_normalized)
+                val += t.qty_f * transaction_fiat_price / function_fiat_price
 
-                else:
-                    function_fiat_price = await get_fiat_price(fiat, date_normalized, session)
-                    val += (t.qty_f or 0) * (t.value_f or 0) / function_fiat_price
+            else:
+                function_fiat_price = fx.get_price(fiat, date_normalized)
+                val += (t.qty_f or 0) * (t.value_f or 0) / function_fiat_price
 
-            except TypeError as err:
-                print('TypeError:', err)
-                pass
+        except TypeError as err:
+            print('TypeError:', err)
+            pass
 
-            # except ValueError as err:
-            #     print('ValueError:', err)
+        # except ValueError as err:
+        #     print('ValueError:', err)
 
     return val
 
 
-def get_pf_value_at_date(date: datetime, df_history: pd.DataFrame, fiat: str = 'fiat_usd'):
-    date = date.replace(hour=0, minute=0, second=0, microsecond=0)
-    return df_history.at[date, f'total_{fiat}']
-
+async def get_current_pf_value(user_id: uuid.UUID, fiat: str = 'fiat_usd', rebuild: bool = False):
+    """
+    Valeur actuelle du portefeuille (hors fiats) calculée en une seule requête sur les assets déjà à jour.
 
-async def get_current_pf_value(user_id: uuid.UUID, fiat: str = 'fiat_usd'):
+    `rebuild=True` force la reconstruction des assets depuis les transactions avant le calcul.
+    """
     from src.db.models import Asset, Token
-    from src.schemes.asset import AssetPublic
     from src.services.asset import AssetService
 
-    rate = 1
+    fiat_token = aliased(Token)
+    fiat_price = select(fiat_token.price).where(fiat_token.cg_id == fiat).scalar_subquery()
 
     async for session in get_session():
-        await AssetService(session).update_user_assets(user_id)
+        if rebuild:
+            await AssetService(session).update_user_assets(user_id)
+
+        stmt = (
+            select(func.sum(Asset.qty * Token.price), fiat_price)
+            .join(Token, Token.cg_id == Asset.token_id)  # type: ignore
+            .where(Asset.user_id == user_id, Asset.token_id.not_in(settings.FIATS))  # type: ignore
+        )
+        result = await session.exec(stmt)
+        sum_value, price = result.one()
 
-        if fiat != 'fiat_usd':
-            result = await session.get(Token, fiat)
-            rate = 1 / result.price
+    rate = 1 if fiat == 'fiat_usd' else 1 / price
 
-        stmt = select(Asset).where(Asset.user_id == user_id).options(selectinload(Asset.token))
-        result = await session.exec(stmt)
-        assets = result.all()
+    return (sum_value or 0) * rate
 
-    sum_value = 0
 
-    for asset in assets:
-        current_asset = AssetPublic.model_validate(asset)
-        if current_asset.token.cg_id not in settings.FIATS:
-            sum_value += current_asset.value
+async def get_current_pf_values(session, user_id: uuid.UUID, fiats: list[str]) -> dict[str, float]:
+    """Valeur actuelle du portefeuille (hors fiats) dans chaque fiat : deux requêtes, quel que soit le nombre de fiats."""
+    from src.db.models import Asset, Token
 
-    sum_value *= rate
+    stmt = (
+        select(func.sum(Asset.qty * Token.price))
+        .join(Token, Token.cg_id == Asset.token_id)  # type: ignore
+        .where(Asset.user_id == user_id, Asset.token_id.not_in(settings.FIATS))  # type: ignore
+    )
+    value_usd = (await session.exec(stmt)).one() or 0
+
+    result = await session.exec(select(Token.cg_id, Token.price).where(Token.cg_id.in_(fiats)))  # type: ignore
+    prices = dict(result.all())
 
-    return sum_value
+    return {fiat: value_usd * (1 if fiat == 'fiat_usd' else 1 / prices[fiat]) for fiat in fiats}
 
 
 async def get_current_total_pnl(user_id: uuid.UUID, fiat: str = 'fiat_usd'):
-    from src.db.models import Transaction, User, UserPfHistory
+    await get_current_total_pnls(user_id, [fiat])
+
+
+async def get_current_total_pnls(user_id: uuid.UUID, fiats: list[str]):
+    """
+    Met à jour le cash in courant de l'utilisateur dans chaque fiat demandée.
+
+    Les transactions et l'historique sont chargés une seule fois, depuis le plus ancien des derniers états
+    persistés ; les fiats reprenant au même état partagent un seul calcul de cash in.
+    """
+    from src.db.models import CashInCheckpoint, Transaction, User, UserPfHistory
+
+    today = datetime.today().replace(hour=0, minute=0, second=0, microsecond=0)
 
     async for session in get_session():
-        # Récupération des transactions
-        stmt = select(Transaction).where(Transaction.user_id == user_id)
+        # Dernier état de cash in persisté (fin de la dernière journée traitée) de chaque fiat
+        latest = (
+            select(CashInCheckpoint.fiat, func.max(CashInCheckpoint.date).label('date'))
+            .where(CashInCheckpoint.user_id == user_id, CashInCheckpoint.fiat.in_(fiats))  # type: ignore
+            .group_by(CashInCheckpoint.fiat)
+            .subquery()
+        )
+        stmt = select(CashInCheckpoint).join(
+            latest, (CashInCheckpoint.fiat == latest.c.fiat) & (CashInCheckpoint.date == latest.c.date)
+        ).where(CashInCheckpoint.user_id == user_id)
+        result = await session.exec(stmt)
+        checkpoints = {checkpoint.fiat: checkpoint for checkpoint in result.all()}
+        starts = {fiat: checkpoints[fiat].date + timedelta(days=1) if fiat in checkpoints else None for fiat in fiats}
+        since = None if None in starts.values() else min(starts.values())
+
+        # Récupération des transactions postérieures au plus ancien de ces états
+        stmt = select(Transaction).where(Transaction.user_id == user_id).order_by(Transaction.date)
+        if since is not None:
+            stmt = stmt.where(Transaction.date >= since)
         result = await session.exec(stmt)
-        transactions = result.all()
-        transactions_dicts = [tr.model_dump() for tr in transactions]
+        transactions_dicts = [tr.model_dump() for tr in result.all()]
 
-        # Récupération de l’historique du portefeuille
+        # Récupération de l’historique du portefeuille sur la même période
         stmt = select(UserPfHistory).where(UserPfHistory.user_id == user_id)
+        if since is not None:
+            stmt = stmt.where(UserPfHistory.date >= since)
         result = await session.exec(stmt)
         pf_hist = result.all()
 
-    # Nom dynamique de l'attribut de valeur
-    value_attr = f'value_in_{fiat.split("_")[1]}'  # ex: value_in_usd / value_in_eur
+        # Ajout de la valeur actuelle du portefeuille
+        current_pf_values = await get_current_pf_values(session, user_id, fiats)
 
-    # Construction des données (dates + valeurs dynamiques)
-    data = [(entry.date, getattr(entry, value_attr)) for entry in pf_hist]
+    # Une colonne de valeur par fiat (value_in_usd / value_in_eur ...)
+    columns = [f'total_{fiat}' for fiat in fiats]
+    data = [(entry.date, *(getattr(entry, f'value_in_{fiat.split("_")[1]}') for fiat in fiats)) for entry in pf_hist]
+    data.append((today, *(current_pf_values[fiat] for fiat in fiats)))
 
-    # Ajout de la valeur actuelle du portefeuille
-    current_pf_value = await get_current_pf_value(user_id, fiat=fiat)
-    data.append((datetime.today().replace(hour=0, minute=0, second=0, microsecond=0), current_pf_value))
-
-    # Création du DataFrame
-    column_name = f'total_{fiat}'
-    df = pd.DataFrame(data, columns=['date', column_name])
+    df = pd.DataFrame(data, columns=['date', *columns])
     df.set_index('date', inplace=True)
     df.sort_index(inplace=True)
 
-    # Appel dynamique à la fonction
-    if fiat == 'fiat_usd':
-        cash_in_array = await get_cash_in_usd(transactions_dicts, df)
-    else:
-        cash_in_array = await get_cash_in_fiat(transactions_dicts, df, fiat=fiat)
-
-    # Accès à la bonne clé finale
-    cash_key = f'cash_in_{fiat}'
-    current_cash_in = cash_in_array[-1][cash_key]
+    # Fiats regroupées par état de départ : un seul passage de get_cash_in par groupe
+    groups = {}
+    for fiat in fiats:
+        groups.setdefault(starts[fiat], []).append(fiat)
+
+    current_cash_ins = {}
+    new_checkpoints = []
+    for start_date, group in groups.items():
+        group_transactions = [tr for tr in transactions_dicts if start_date is None or tr['date'] >= start_date]
+        start = {fiat: checkpoints[fiat].cash_in for fiat in group if fiat in checkpoints} or None
+        df_cash_in = await get_cash_in(group_transactions, df, fiats=group, start=start)
+
+        # Les journées terminées ne bougeront plus : on persiste le cash in de fin de journée.
+        # Les transactions du jour restent rejouées car elles dépendent de la valeur actuelle du portefeuille.
+        df_cash_in['day'] = df_cash_in['date'].dt.normalize()
+        df_closed_days = df_cash_in[df_cash_in['day'] < today].drop_duplicates('day', keep='last')
+
+        for fiat in group:
+            cash_key = f'cash_in_{fiat}'
+            if not df_cash_in.empty:
+                current_cash_ins[fiat] = df_cash_in[cash_key].iloc[-1]
+            else:
+                current_cash_ins[fiat] = checkpoints[fiat].cash_in if fiat in checkpoints else 0
 
-    # current_pnl_percent = current_pf_value / current_cash_in
-    # current_pnl_value = current_pf_value - current_cash_in
+            new_checkpoints += [
+                CashInCheckpoint(
+                    user_id=user_id, fiat=fiat, date=row['day'].to_pydatetime(), cash_in=float(row[cash_key])
+                )
+                for _, row in df_closed_days.iterrows()
+            ]
 
+    # Cash in de toutes les fiats et nouveaux états écrits dans un seul commit
     async for session in get_session():
         user_db = await session.get(User, user_id)
-
-        attr_name = f'cash_in_{fiat.split("_")[1]}'
-        setattr(user_db, attr_name, current_cash_in)
+        for fiat, current_cash_in in current_cash_ins.items():
+            setattr(user_db, f'cash_in_{fiat.split("_")[1]}', float(current_cash_in))
 
         session.add(user_db)
+        session.add_all(new_checkpoints)
         await session.commit()
 
-    # return {
-    #     'current_cash_in': current_cash_in,
-    #     'current_pf_value': current_pf_value,
-    #     'current_pnl_percent': current_pnl_percent,
-    #     'current_pnl_value': current_pnl_value,
-    # }
+
+async def invalidate_cash_in_state(session, user_id: uuid.UUID, since: datetime | None = None):
+    """
+    Supprime les états de cash in persistés à partir du jour de `since` (tous si None).
+
+    A appeler dans la session qui modifie les transactions ou l'historique : le prochain calcul rejouera
+    les transactions à partir du dernier état encore valide.
+    """
+    from src.db.models import CashInCheckpoint
+
+    statement = delete(CashInCheckpoint).where(CashInCheckpoint.user_id == user_id)
+    if since is not None:
+        statement = statement.where(
+            CashInCheckpoint.date >= since.replace(hour=0, minute=0, second=0, microsecond=0)
+        )
+    await session.exec(statement)
+
+
+async def mark_history_dirty(session, user_id: uuid.UUID, since: datetime):
+    """Retient le jour de `since` comme point de départ du prochain calcul incrémental de l'historique."""
+    from src.db.models import User
+
+    day = since.replace(hour=0, minute=0, second=0, microsecond=0)
+    statement = (
+        update(User)
+        .where(User.uid == user_id)
+        .values(history_dirty_date=func.min(func.coalesce(User.history_dirty_date, day), day))
+        .execution_options(synchronize_session=False)  # Valeur calculée en SQL : l'objet User en session est laissé tel quel
+    )
+    await session.exec(statement)
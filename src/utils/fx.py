@@ -0,0 +1,90 @@
+from bisect import bisect_left
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlmodel import select
+
+FX_TABLE_TTL = timedelta(hours=1)
+FX_LOOKBACK = timedelta(days=30)  # Marge pour trouver la dernière clôture avant le début d'une plage
+
+
+def to_day(value: date | datetime) -> date:
+    return value.date() if isinstance(value, datetime) else value
+
+
+class FxRateTable:
+    """
+    Table des cours de clôture fiat/USD chargée une seule fois depuis `fiat_history`.
+
+    Pour chaque fiat, les dates et les clôtures sont gardées triées afin de répondre par recherche
+    dichotomique à la question "dernière clôture strictement avant cette date".
+    """
+
+    def __init__(self):
+        self.dates: dict[str, list[date]] = {}
+        self.closes: dict[str, list[float]] = {}
+        self.loaded_at: datetime | None = None
+
+    @property
+    def fresh(self) -> bool:
+        return self.loaded_at is not None and datetime.now() - self.loaded_at < FX_TABLE_TTL
+
+    async def load(self, session):
+        from src.db.models import FiatHistory
+
+        statement = select(FiatHistory.cg_id, FiatHistory.date, FiatHistory.close).order_by(
+            FiatHistory.cg_id, FiatHistory.date
+        )
+        results = await session.exec(statement)
+
+        dates = defaultdict(list)
+        closes = defaultdict(list)
+        for cg_id, dt, close in results.all():
+            dates[cg_id].append(to_day(dt))
+            closes[cg_id].append(close)
+
+        self.dates = dict(dates)
+        self.closes = dict(closes)
+        self.loaded_at = datetime.now()
+
+    def invalidate(self):
+        self.loaded_at = None
+
+    def get_price(self, fiat: str, dt: date | datetime) -> float:
+        if fiat == 'fiat_usd':
+            return 1
+
+        day = to_day(dt)
+        dates = self.dates.get(fiat, [])
+        index = bisect_left(dates, day) - 1  # dernière date strictement avant `day`
+        price = self.closes[fiat][index] if index >= 0 else None
+
+        if price is None or price == 0:
+            raise LookupError(f'Prix fiat non trouvé pour {fiat} à la date : {day}')
+
+        return price
+
+
+def convert_usd_totals(dates, totals_usd, fx_dates, fx_closes) -> np.ndarray:
+    """
+    Conversion vectorisée de totaux USD avec, pour chaque date, la dernière clôture datée de ce jour ou avant
+    (jointure "as-of" par recherche dichotomique). Sans cours connu, avec un cours nul ou un total nul : 0.0.
+    """
+    dates = pd.to_datetime(pd.Series(dates)).to_numpy(dtype='datetime64[ns]')
+    totals_usd = np.asarray(totals_usd, dtype=float)
+    fx_dates = pd.to_datetime(pd.Series(fx_dates, dtype=object)).to_numpy(dtype='datetime64[ns]')
+    fx_closes = np.asarray(fx_closes, dtype=float)
+
+    index = np.searchsorted(fx_dates, dates, side='right') - 1  # dernière date <= date
+    rates = np.full(len(dates), np.nan)
+    found = index >= 0
+    rates[found] = fx_closes[index[found]]
+
+    valid = (totals_usd != 0) & (rates > 0)
+    return np.divide(totals_usd, rates, out=np.zeros_like(totals_usd), where=valid)
+
+
+# Table partagée par tout le process (API ou worker celery)
+fx_table = FxRateTable()
@@ -0,0 +1,119 @@
+import asyncio
+from datetime import datetime, timedelta
+from typing import Callable
+
+import pandas as pd
+from sqlalchemy.dialects.sqlite import insert
+from sqlmodel import select
+from src.db.main import get_session_with_context_manager
+from src.db.models import PriceHistory
+
+PRICE_HISTORY_BARS = 10000  # Historique complet téléchargé au premier appel
+PRICE_HISTORY_OVERLAP = 2  # Barres déjà stockées re-téléchargées (la dernière était peut-être incomplète)
+PRICE_HISTORY_BATCH_SIZE = 500
+OHLC_COLUMNS = ['open', 'high', 'low', 'close', 'volume']
+
+INTERVAL_DURATIONS = {
+    '1': timedelta(minutes=1),
+    '1H': timedelta(hours=1),
+    '4H': timedelta(hours=4),
+    '1D': timedelta(days=1),
+    '1W': timedelta(weeks=1),
+}
+
+
+def bars_since(last_date: datetime | None, interval: str) -> int:
+    """Nombre de barres à télécharger pour compléter un historique dont la dernière barre date de `last_date`."""
+    duration = INTERVAL_DURATIONS.get(interval)
+    if last_date is None or duration is None:
+        return PRICE_HISTORY_BARS
+    return min(PRICE_HISTORY_BARS, int((datetime.now() - last_date) / duration) + PRICE_HISTORY_OVERLAP)
+
+
+async def load_price_history(session, ticker: str, exchange: str, interval: str) -> pd.DataFrame:
+    statement = (
+        select(PriceHistory)
+        .where(PriceHistory.ticker == ticker, PriceHistory.exchange == exchange, PriceHistory.interval == interval)
+        .order_by(PriceHistory.date)
+    )
+    results = await session.exec(statement)
+    rows = [(bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume) for bar in results.all()]
+
+    df = pd.DataFrame(rows, columns=['datetime', *OHLC_COLUMNS])
+    return df.set_index('datetime')
+
+
+async def save_price_history(session, ticker: str, exchange: str, interval: str, df: pd.DataFrame):
+    rows = [
+        {
+            'ticker': ticker,
+            'exchange': exchange,
+            'interval': interval,
+            'date': pd.Timestamp(date).to_pydatetime(),
+            **{column: None if pd.isna(bar.get(column)) else float(bar[column]) for column in OHLC_COLUMNS},
+        }
+        for date, bar in df.iterrows()
+    ]
+
+    for start in range(0, len(rows), PRICE_HISTORY_BATCH_SIZE):
+        statement = insert(PriceHistory).values(rows[start : start + PRICE_HISTORY_BATCH_SIZE])
+        statement = statement.on_conflict_do_update(
+            index_elements=['ticker', 'exchange', 'interval', 'date'],
+            set_={column: statement.excluded[column] for column in OHLC_COLUMNS},
+        )
+        await session.exec(statement)
+
+
+def clean_bars(df: pd.DataFrame) -> pd.DataFrame:
+    """Barres téléchargées ramenées aux colonnes OHLC, indexées par date, sans doublon et triées."""
+    df = df[[column for column in OHLC_COLUMNS if column in df.columns]]
+    df.index = pd.to_datetime(df.index)
+    return df[~df.index.duplicated(keep='last')].sort_index()
+
+
+async def store_price_history(ticker: str, exchange: str, interval: str, df: pd.DataFrame):
+    """Enregistre un historique déjà téléchargé, dans sa propre session."""
+    async with get_session_with_context_manager() as session:
+        await save_price_history(session, ticker, exchange, interval, clean_bars(df))
+        await session.commit()
+
+
+async def get_price_history(
+    ticker: str, exchange: str, interval: str, fetch: Callable[[datetime | None], pd.DataFrame | None]
+) -> pd.DataFrame | None:
+    """
+    Historique OHLC de (ticker, exchange, interval), indexé par `datetime`, lu dans `price_history`.
+
+    `fetch(last_date)` ne télécharge que les barres depuis la dernière barre stockée (tout l'historique si rien
+    n'est stocké) ; elles sont enregistrées avant d'être renvoyées avec le reste. Si le téléchargement échoue,
+    l'historique déjà stocké est renvoyé tel quel.
+    """
+    async with get_session_with_context_manager() as session:
+        stored = await load_price_history(session, ticker, exchange, interval)
+        last_date = stored.index[-1].to_pydatetime() if not stored.empty else None
+
+        try:
+            fetched = await asyncio.to_thread(fetch, last_date)  # Téléchargement bloquant hors de la boucle
+        except Exception as err:
+            if stored.empty:
+                raise
+            print(f'[Price History Error] {ticker} ({exchange}) : {err}')
+            fetched = None
+
+        if fetched is not None and not fetched.empty:
+            fetched = clean_bars(fetched)
+            if last_date is not None:
+                fetched = fetched[fetched.index >= last_date]
+
+            await save_price_history(session, ticker, exchange, interval, fetched)
+            await session.commit()
+
+            if not fetched.empty:
+                kept = stored[stored.index < fetched.index[0]]
+                stored = pd.concat([kept, fetched]) if not kept.empty else fetched
+
+    if stored.empty:
+        return None
+
+    stored.index.name = 'datetime'
+    return stored
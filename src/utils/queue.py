@@ -0,0 +1,211 @@
+import asyncio
+import uuid
+
+from src.config import settings
+from src.db.main import get_session_with_context_manager
+
+ASSET_WAIT_TIMEOUT = 10  # Attente maximale (s) de GET /assets?min_version=...
+PNL_TASK_TIMEOUT = 300  # Attente maximale (s) de la fin d'un calcul de PnL avant d'autoriser le suivant
+
+
+class PendingRecompute:
+    """Recalcul d'assets en attente pour un utilisateur : les écritures successives y sont fusionnées."""
+
+    def __init__(self, fiat: str):
+        self.fiat = fiat
+        self.changes: list = []  # (transaction, +1 création / -1 suppression, version du ledger de l'écriture)
+        self.token_ids: set[str] = set()
+
+
+class AssetRecomputeQueue:
+    """
+    File de recalcul des assets, exécutée en tâche de fond dans le process API.
+
+    Les écritures de transactions ne font qu'ajouter leurs modifications au recalcul en attente de l'utilisateur :
+    une rafale d'éditions est appliquée en une seule fois par `AssetService.write_transaction_changes`, dans la
+    même transaction que `users.assets_version`, puis les calculs de PnL sont lancés.
+
+    Une version n'est déclarée reflétée que si toutes les versions précédentes l'ont été : une écriture commitée
+    mais pas encore confiée à la file ne doit pas être masquée par une écriture plus récente. Les modifications
+    d'une version déjà reflétée (reconstruction complète entre-temps) sont ignorées.
+    """
+
+    def __init__(self, session_factory=get_session_with_context_manager):
+        self.session_factory = session_factory
+        self.pending: dict[uuid.UUID, PendingRecompute] = {}
+        self.queue: asyncio.Queue | None = None
+        self.worker: asyncio.Task | None = None
+        self.done: asyncio.Condition | None = None
+        self.versions: dict[uuid.UUID, int] = {}  # Dernière version traitée par utilisateur
+        self.applied: dict[uuid.UUID, set[int]] = {}  # Versions appliquées, en attente d'une version manquante
+        self.gaps: dict[uuid.UUID, set[int]] = {}  # Versions manquantes lors du dernier recalcul
+
+    def start(self):
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue()
+            self.done = asyncio.Condition()
+            for user_id in self.pending:
+                self.queue.put_nowait(user_id)
+            self.worker = asyncio.create_task(self.run())
+
+    async def stop(self):
+        """Termine les recalculs en attente puis arrête la tâche de fond."""
+        if self.worker is None:
+            return
+        await self.queue.join()
+        self.worker.cancel()
+        self.worker = None
+
+    def enqueue(self, user_id: uuid.UUID, changes: list, token_ids: set[str], version: int, fiat: str):
+        self.start()
+        job = self.pending.get(user_id)
+        if job is None:
+            job = self.pending[user_id] = PendingRecompute(fiat)
+            self.queue.put_nowait(user_id)
+
+        job.changes.extend((trx, sign, version) for trx, sign in changes)
+        job.token_ids |= token_ids
+        job.fiat = fiat
+
+    async def wait_for_version(self, user_id: uuid.UUID, version: int, timeout: float = ASSET_WAIT_TIMEOUT) -> bool:
+        """Attend que le recalcul de `version` soit traité par ce process ; False après `timeout`."""
+        if self.done is None:
+            return False
+        async with self.done:
+            try:
+                await asyncio.wait_for(
+                    self.done.wait_for(lambda: self.versions.get(user_id, 0) >= version), timeout=timeout
+                )
+                return True
+            except TimeoutError:
+                return False
+
+    async def run(self):
+        while True:
+            user_id = await self.queue.get()
+            try:
+                job = self.pending.pop(user_id, None)
+                if job is not None:
+                    await self.recompute(user_id, job)
+            except Exception as err:
+                print(f'[Asset Queue Error] {err}')
+            finally:
+                self.queue.task_done()
+
+    async def recompute(self, user_id: uuid.UUID, job: PendingRecompute):
+        from src.services.asset import AssetService
+        from src.utils.cache import get_assets_version, set_assets_version
+
+        async with self.session_factory() as session:
+            try:
+                reflected = await get_assets_version(session, user_id)
+                changes = [(trx, sign) for trx, sign, version in job.changes if version > reflected]
+                applied = self.applied.get(user_id, set()) | {version for _, _, version in job.changes}
+                applied = {version for version in applied if version > reflected}
+
+                version = reflected
+                while version + 1 in applied:
+                    version += 1
+                missing = set(range(version + 1, max(applied, default=version))) - applied
+                if missing & self.gaps.get(user_id, set()):
+                    # Toujours absente après un recalcul complet : écriture perdue avant la file
+                    raise RuntimeError(f'ledger versions {sorted(missing)} never queued')
+
+                # Assets et version écrits dans la même transaction
+                await AssetService(session).write_transaction_changes(user_id, changes, job.token_ids)
+                await set_assets_version(session, user_id, version)
+                await session.commit()
+
+                self.applied[user_id] = {v for v in applied if v > version}
+                self.gaps[user_id] = missing
+            except Exception as err:
+                # Reconstruction complète en dernier recours (elle avance elle-même assets_version)
+                print(f'[Asset Queue Error] {err}')
+                await session.rollback()
+                self.applied.pop(user_id, None)
+                self.gaps.pop(user_id, None)
+                await AssetService(session).update_user_assets(user_id)
+                version = await get_assets_version(session, user_id)
+
+        self.schedule_pnl(user_id, job.fiat)
+
+        async with self.done:
+            self.versions[user_id] = max(self.versions.get(user_id, 0), version)
+            self.done.notify_all()
+
+    def schedule_pnl(self, user_id: uuid.UUID, fiat: str):
+        pnl_scheduler.schedule(user_id, {'fiat_usd', fiat})
+
+
+class PnlScheduler:
+    """
+    Regroupe les demandes de calcul du PnL par utilisateur.
+
+    Chaque demande repousse le lancement de `quiet_window` secondes et ajoute ses fiats au calcul en attente :
+    une rafale d'éditions ne donne qu'une tâche celery, qui calcule tous les fiats demandés. Il y a au plus un
+    calcul en attente et un calcul en cours par utilisateur.
+    """
+
+    def __init__(self, quiet_window: float = settings.PNL_DEBOUNCE_SECONDS):
+        self.quiet_window = quiet_window
+        self.pending: dict[uuid.UUID, set[str]] = {}  # Fiats à calculer au prochain lancement
+        self.deadlines: dict[uuid.UUID, float] = {}
+        self.workers: dict[uuid.UUID, asyncio.Task] = {}
+
+    def schedule(self, user_id: uuid.UUID, fiats: set[str]):
+        loop = asyncio.get_running_loop()
+        self.pending.setdefault(user_id, set()).update(fiats)
+        self.deadlines[user_id] = loop.time() + self.quiet_window
+
+        if user_id not in self.workers:
+            self.workers[user_id] = asyncio.create_task(self.run(user_id))
+
+    async def stop(self):
+        """Lance sans attendre les calculs encore en attente puis arrête les tâches de fond."""
+        for worker in self.workers.values():
+            worker.cancel()
+        self.workers.clear()
+
+        pending, self.pending = self.pending, {}
+        self.deadlines.clear()
+        for user_id, fiats in pending.items():
+            try:
+                self.send(user_id, fiats)
+            except Exception as err:
+                print(f'[PnL Scheduler Error] {err}')
+
+    async def run(self, user_id: uuid.UUID):
+        loop = asyncio.get_running_loop()
+        try:
+            while user_id in self.pending:
+                # Attente de la fin de la rafale (la date limite recule à chaque nouvelle demande)
+                while (delay := self.deadlines[user_id] - loop.time()) > 0:
+                    await asyncio.sleep(delay)
+
+                fiats = self.pending.pop(user_id)
+                del self.deadlines[user_id]
+                try:
+                    await self.dispatch(user_id, fiats)
+                except Exception as err:
+                    print(f'[PnL Scheduler Error] {err}')
+        finally:
+            if self.workers.get(user_id) is asyncio.current_task():
+                del self.workers[user_id]
+
+    def send(self, user_id: uuid.UUID, fiats: set[str]):
+        from src.celery.tasks import get_total_pnls_task
+
+        # USD en premier, comme les appels individuels qu'elle remplace
+        return get_total_pnls_task.delay(user_id=user_id, fiats=sorted(fiats, key=lambda fiat: fiat != 'fiat_usd'))
+
+    async def dispatch(self, user_id: uuid.UUID, fiats: set[str]):
+        """Lance le calcul et attend sa fin : les demandes reçues entre-temps forment le calcul suivant."""
+        from src.celery.tasks import wait_for_celery_result
+
+        async_result = self.send(user_id, fiats)
+        await wait_for_celery_result(async_result.id, timeout=PNL_TASK_TIMEOUT)
+
+
+# Files partagées par tout le process API
+asset_queue = AssetRecomputeQueue()
+pnl_scheduler = PnlScheduler()
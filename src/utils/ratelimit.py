@@ -0,0 +1,33 @@
+import threading
+import time
+
+from src.config import settings
+
+
+class TokenBucket:
+    """Limiteur de débit partagé entre threads : `rate` requêtes par seconde, par rafales d'au plus `capacity`."""
+
+    def __init__(self, rate: float, capacity: int = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Bloque jusqu'à ce qu'une requête soit autorisée."""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# Un limiteur par source de données, partagé par toutes les tâches du process
+tradingview_bucket = TokenBucket(settings.TRADINGVIEW_REQUESTS_PER_SECOND)
+taostats_bucket = TokenBucket(settings.TAOSTATS_REQUESTS_PER_SECOND)
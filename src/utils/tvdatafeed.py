@@ -1,5 +1,10 @@
+import asyncio
+
 import pandas as pd
+from src.config import settings
 from src.utils.decoration import timeit
+from src.utils.price_history import PRICE_HISTORY_BARS, bars_since, get_price_history, store_price_history
+from src.utils.ratelimit import tradingview_bucket
 from tvDatafeed import Interval, TvDatafeed
 
 
@@ -11,6 +16,21 @@ def get_history_ohlc_single_symbol(
     return res
 
 
+async def get_stored_history_ohlc(symbol: str, exchange: str, interval: Interval = Interval.in_daily):
+    """Comme `get_history_ohlc_single_symbol`, mais seules les barres absentes du store local sont téléchargées."""
+    return await get_price_history(
+        symbol,
+        exchange,
+        interval.value,
+        lambda last_date: fetch_history_ohlc(symbol, exchange, bars_since(last_date, interval.value), interval),
+    )
+
+
+def fetch_history_ohlc(symbol: str, exchange: str, n_bars: int, interval: Interval):
+    tradingview_bucket.acquire()
+    return get_history_ohlc_single_symbol(symbol, exchange, n_bars, interval)
+
+
 def get_history_ohlc_mutliple_symbols(
     symbol: list, exchange: list, n_bars: int = 10000, interval: Interval = Interval.in_daily
 ):
@@ -65,11 +85,34 @@ def get_tv_search(symbol: str, exchange: str = ''):
     ]
 
 
-def find_longest_history(exchange_list):
+def probe_histories(symbols: list, exchanges: list, interval: Interval = Interval.in_daily):
+    """Historiques complets des candidats, téléchargés avec une seule instance TvDatafeed et sans être stockés."""
+    tv = TvDatafeed()
+    all_results = []
+    for symb, exch in zip(symbols, exchanges):
+        tradingview_bucket.acquire()
+        try:
+            all_results.append(tv.get_hist(symb, exch, interval, PRICE_HISTORY_BARS))
+        except Exception as err:
+            print(f'Erreur historique {symb} ({exch}) : {err}')
+            all_results.append(None)
+    return all_results
+
+
+async def find_longest_history(exchange_list):
     symbols = [r['symbol'] for r in exchange_list]
     exchanges = [r['exchange'] for r in exchange_list]
     print(f'{len(exchange_list)} exchanges to check...')
-    res = get_history_ohlc_mutliple_symbols(symbols, exchanges)
+
+    # Candidats répartis entre quelques threads (débit global limité par tradingview_bucket)
+    workers = max(1, min(settings.HISTORY_FETCH_CONCURRENCY, len(exchange_list)))
+    chunks = await asyncio.gather(
+        *(asyncio.to_thread(probe_histories, symbols[i::workers], exchanges[i::workers]) for i in range(workers))
+    )
+    res = [None] * len(exchange_list)
+    for i, chunk in enumerate(chunks):
+        res[i::workers] = chunk
+
     max_length = -1
     max_index = -1
 
@@ -86,6 +129,11 @@ def find_longest_history(exchange_list):
         max_symbol = symbols[max_index]
         max_exchange = exchanges[max_index]
         print(f"Le symbol le plus long est {max_symbol} sur l'exchange {max_exchange} avec {max_length} lignes.")
+        # Seul l'historique retenu est stocké : les prochains appels ne téléchargeront que les nouvelles barres
+        try:
+            await store_price_history(max_symbol, max_exchange, Interval.in_daily.value, res[max_index])
+        except Exception as err:
+            print(f'[Price History Error] {max_symbol} ({max_exchange}) : {err}')
         return exchange_list[max_index]
     else:
         print('Aucune donnée historique trouvée.')
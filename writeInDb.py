@@ -2,9 +2,10 @@ import csv
 import uuid
 from datetime import datetime
 
-from pydantic import BaseModel, ConfigDict, field_validator
 from sqlmodel import MetaData, Session, Table, create_engine, delete, select, text
 from src.db.models import Asset, DtaoCgList, FiatHistory, SmallToken, Token, Transaction, User
+from src.schemes.transaction import TransactionCSVModel
+from src.utils.bulk import get_content_hash
 from src.utils.security import hash_password
 
 sqlite_url = 'sqlite:///./src/db/database.sqlite'
@@ -14,37 +15,6 @@ with engine.begin() as conn:
     conn.execute(text('PRAGMA foreign_keys=ON'))  # for SQLite only
 
 
-class TransactionCSVModel(BaseModel):
-    date: datetime
-    type: str
-    actif_a_id: str
-    qty_a: float
-    actif_v_id: str | None = None
-    price: float | None = None
-    qty_v: float | None = None
-    destination: str
-    origin: str | None = None
-    actif_f_id: str | None = None
-    qty_f: float | None = None
-    value_f: float | None = None
-    value_a: float | None = None
-    id: int | None = None
-
-    @field_validator('date', mode='before')
-    @classmethod
-    def parse_date(cls, v):
-        return datetime.strptime(v.strip(), '%d-%m-%y %H:%M:%S')
-
-    @field_validator('*', mode='before')
-    @classmethod
-    def empty_str_to_none(cls, v):
-        if isinstance(v, str) and v.strip() == '':
-            return None
-        return v
-
-    model_config = ConfigDict(extra='ignore')
-
-
 def convert_transaction(tx_dict: dict) -> dict:
     validated = TransactionCSVModel(**tx_dict)
     return validated.model_dump(exclude={'id'})  # on enlève `id` s'il ne sert pas
@@ -113,7 +83,9 @@ def resetTransactions():
                 return
 
             trx['user_id'] = fkaisin_uid
-            session.add(Transaction(**trx))
+            db_trx = Transaction(**trx)
+            db_trx.content_hash = get_content_hash(db_trx)
+            session.add(db_trx)
         session.commit()
 
 